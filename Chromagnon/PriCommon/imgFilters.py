@@ -5,8 +5,9 @@ try:
 except ValueError:
     from Priithon.all import N, U, Y, F, Mrc
 from scipy import optimize
-from . import imgFit
-import os
+from . import imgFit, kernelCache
+import os, threading
+from collections import OrderedDict
 #try:
 #    from packages import Eext
 #except:
@@ -55,14 +56,16 @@ def arr_histStretch(img, imgMin=None, imgMax=None, scaleMax=None):
 
     return N.asarray(ratio * img, img.dtype.type)
 
+def _edgeKernel(shape, sigma):
+    return F.shift(gaussianArrND(shape, sigma))
+
 def arr_edgeFilter(img, sigma=1.5):
     """
     average-deviation with a gaussian prefilter
     img must be in an even shape
     """
     if sigma:
-        g = gaussianArrND(img.shape, sigma)
-        g = F.shift(g)
+        g = kernelCache.getKernel('edge', img.shape, (sigma,), _edgeKernel, img.shape, sigma)
         img = F.convolve(img.astype(N.float32), g)
     gr = N.gradient(img.astype(N.float32))
     ff = N.sum(N.power(gr, 2), 0)
@@ -202,9 +205,6 @@ forceSecondPeak=None, acceptOrigin=True, maskSigmaFact=1., removeY=None, removeX
     else:
         return yx, c
 
-_G = None
-_G_SHAPE = None
-
 def highPassF(af, highpassSigma=2.5, wiener=0.2, cutoffFreq=3):
     """
     fourie space operations
@@ -218,20 +218,14 @@ def highPassF(af, highpassSigma=2.5, wiener=0.2, cutoffFreq=3):
 
     WARNING: af will be changed, so use copy() if necessary
     """
-    global _G, _G_SHAPE
     if highpassSigma:
        # if half_nyx is None:
         ny, nx = af.shape
         sy2 = ny / 2.
         sx2 = nx - 1
         shape = (sy2*2,sx2+1)
-        if _G is not None and N.alltrue(_G_SHAPE == shape):
-            g = _G
-        else:
-            g = gaussianArr2D(shape, highpassSigma, peakVal=1, orig=(sy2,0))
-            _G = g
-            _G_SHAPE = N.asarray(shape)
-        g += wiener
+        g = kernelCache.getKernel('highpass2D', shape, (highpassSigma,), gaussianArr2D, shape, highpassSigma, peakVal=1, orig=(sy2,0))
+        g = g + wiener
         af[:sy2] /= g[sy2:]
         af[sy2:] /= g[:sy2]
 
@@ -243,7 +237,6 @@ def highPassF(af, highpassSigma=2.5, wiener=0.2, cutoffFreq=3):
     
     return af
 
-_F = None
 def fourierFilterF(af, func='gaussian', radius=1, operation='+', kwd={}, wiener=0.2, copy=True):
     """
     fourie space operations
@@ -259,28 +252,33 @@ def fourierFilterF(af, func='gaussian', radius=1, operation='+', kwd={}, wiener=
 
     WARNING: af will be changed, so use copy() if necessary
     """
-    global _F
     shape = af.shape
     sy2 = shape[-2] / 2.
     if copy:
         af = af.copy()
 
+    kwd = dict(kwd)
     kwd['orig'] = (sy2,0)
     if type(func) in [type(''), type('')]:
         if func.startswith('g'):
-            g = gaussianArr2D(shape, radius, peakVal=1, **kwd)
+            kwd['peakVal'] = 1
+            func = gaussianArr2D
         else:
             if func[-3:] != 'Arr':
                 func += 'Arr'
-            try:
-                exec('g = F.%s(shape, radius, **kwd)' % func)
-            except:
+            if not hasattr(F, func):
                 raise ValueError('%s is not recognized' % func)
-    else:
+            func = getattr(F, func)
+
+    try:
+        params = (func, radius, tuple(sorted(kwd.items())))
+        hash(params)
+    except TypeError: # unhashable keywords
         g = func(shape, radius, **kwd)
+    else:
+        g = kernelCache.getKernel('fourier', shape, params, func, shape, radius, **kwd)
 
-    g += wiener
-    _F = g
+    g = g + wiener
     exec('af[:sy2] %s= g[sy2:]' % operation)
     exec('af[sy2:] %s= g[:sy2]' % operation)
     
@@ -383,19 +381,54 @@ def pointsCutOutND(arr, posList, windowSize=100, sectWise=None, interpolate=True
 
     return arrList
 
-def paddingValue(img, shape, value=0, shift=None, smooth=0, interpolate=True):
+# number of pixels above which the median for padding is estimated from a subsample
+MEDIAN_MAXPXLS = 2**18
+# number of workspace arrays kept by each thread
+WORKSPACE_SIZE = 8
+# bytes of workspace arrays kept by each thread, larger arrays (eg. 3D stacks) are not kept
+WORKSPACE_MAXBYTES = 2**25
+
+_WORKSPACE = threading.local()
+
+def getWorkspace(name, shape, dtype=N.float32):
+    """
+    return a reusable array for the calling thread, values are not initialized
+    the same array is returned for the same (name, shape, dtype), so use it only as a temporary buffer
+    arrays larger than WORKSPACE_MAXBYTES are newly made every time
+    """
+    bufs = getattr(_WORKSPACE, 'bufs', None)
+    if bufs is None:
+        bufs = _WORKSPACE.bufs = OrderedDict()
+    key = (name, tuple([int(s) for s in shape]), N.dtype(dtype).str)
+    if key in bufs:
+        buf = bufs.pop(key)
+    else:
+        buf = N.empty(key[1], dtype)
+        if buf.nbytes > WORKSPACE_MAXBYTES:
+            return buf
+    bufs[key] = buf
+    nbytes = sum([b.nbytes for b in bufs.values()])
+    while len(bufs) > WORKSPACE_SIZE or nbytes > WORKSPACE_MAXBYTES:
+        nbytes -= bufs.popitem(last=False)[1].nbytes
+    return buf
+
+def paddingValue(img, shape, value=0, shift=None, smooth=0, interpolate=True, out=None):
     """
     shape:       in the same dimension as img
     value:       value in padded region, can be scaler or array with the shape
     shift:       scaler or in the same dimension as img and shape (default 0)
     smooth:      scaler value to smoothen border (here value must be scaler)
     interpolate: shift array by subpixel interpolation to adjust center
+    out:         array with shape and the dtype of img to write the result (eg. getWorkspace())
 
     return:      padded array with shape
     """
     # create buffer
     dtype = img.dtype.type
-    canvas = N.empty(shape, dtype)
+    if out is None:
+        canvas = N.empty(shape, dtype)
+    else:
+        canvas = out
     canvas[:] = value
 
     # calculate position
@@ -408,7 +441,7 @@ def paddingValue(img, shape, value=0, shift=None, smooth=0, interpolate=True):
     #start, stop = (shapeL - shapeS)/2., (shapeL + shapeS)/2.
     start = N.round_((shapeL - shapeS)/2.).astype(N.int)
     stop = shapeS + start
-    slc = [slice(start[d], stop[d], None) for d in range(img.ndim)]
+    slc = tuple([slice(start[d], stop[d], None) for d in range(img.ndim)])
 
     #slc = [slice(int(round(start[d])), int(round(stop[d])), None) for d in range(img.ndim)]
     #print slc, shapeS, shapeL
@@ -422,13 +455,19 @@ def paddingValue(img, shape, value=0, shift=None, smooth=0, interpolate=True):
     canvas[slc] = img
     if smooth:
         canvas = _smoothBorder(canvas, start, stop, smooth, value)
-    canvas = N.ascontiguousarray(canvas)
+    if out is None:
+        canvas = N.ascontiguousarray(canvas)
     #print shapeS, shapeL, slc
     return canvas
 
+def _smoothRamp(smooth, dtype):
+    return N.arange(1, smooth+1).astype(dtype)
+
 def _smoothBorder(arr, start, stop, smooth, value):
     """
     start, stop: [z,y,x]
+
+    the border is changed in place, each dimension at once with a linear ramp
     """
     # prepare coordinates
     shape = N.array(arr.shape)
@@ -440,41 +479,25 @@ def _smoothBorder(arr, start, stop, smooth, value):
     smooth_stop = N.where(smooth_stop > shape, shape, smooth_stop)
     #print smooth_start, smooth_stop
 
-    import copy
-    sliceTemplate = [slice(None,None,None)] * arr.ndim
-    shapeTemplate = list(shape)
     for d in range(arr.ndim):
-        smooth_shape = shapeTemplate[:d] + shapeTemplate[d+1:]
-
-        # make an array containing the edge value
-        edges = N.empty([2] + smooth_shape, N.float32)
-        # start side
-        slc = copy.copy(sliceTemplate)
-        slc[d] = slice(start[d], start[d]+1, None)
-        edges[0] = arr[slc].reshape(smooth_shape)
+        # the edge value, and the ramp along this dimension to be broadcasted
+        before = (slice(None),) * d
+        after = (None,) * (arr.ndim - d - 1)
+        edge0 = (arr[before + (slice(start[d], start[d]+1),)].astype(N.float32) - value) / float(smooth + 1)
+        edge1 = (arr[before + (slice(stop[d]-1, stop[d]),)].astype(N.float32) - value) / float(smooth + 1)
+        ramp = kernelCache.getKernel('smoothBorder', (smooth,), (edge0.dtype.str,), _smoothRamp, smooth, edge0.dtype)
+
+        # start side: the ramp goes down from smooth next to the edge
+        n = start[d] - smooth_start[d]
+        if n > 0:
+            slc = before + (slice(smooth_start[d], start[d]),)
+            arr[slc] = arr[slc] + edge0 * ramp[smooth-n:][(Ellipsis,) + after]
         # stop side
-        slc = copy.copy(sliceTemplate)
-        slc[d] = slice(stop[d]-1, stop[d], None)
-        edges[1] = arr[slc].reshape(smooth_shape)
-
-        edges = (edges - value) / float(smooth + 1) # this value can be array??
-
-        # both side
-        for s, side in enumerate([start, stop]):
-            if s == 0:
-                rs = list(range(smooth_start[d], start[d]))
-                rs.sort(reverse=True)
-            elif s == 1:
-                rs = list(range(stop[d], smooth_stop[d]))
-            # smoothing
-            for f,i in enumerate(rs):
-                slc = copy.copy(sliceTemplate)
-                slc[d] = slice(i,i+1,None)
-                edgeArr = edges[s].reshape(arr[slc].shape)
-                #arr[slc] += edgeArr * (smooth - f) 
-                arr[slc] = arr[slc] + edgeArr * (smooth - f) # casting rule
-
-    arr = N.ascontiguousarray(arr)
+        n = smooth_stop[d] - stop[d]
+        if n > 0:
+            slc = before + (slice(stop[d], smooth_stop[d]),)
+            arr[slc] = arr[slc] + edge1 * ramp[::-1][:n][(Ellipsis,) + after]
+
     return arr
 
 def paddingFourier(arr, shape, value=0, interpolate=True):
@@ -532,16 +555,30 @@ def paddingFourier(arr, shape, value=0, interpolate=True):
     return canvas
 
 
-def paddingMed(img, shape, shift=None, smooth=10):
+def fastMedian(img, maxpxls=MEDIAN_MAXPXLS):
+    """
+    return median of img
+    if img has more than maxpxls pixels, the median is estimated from evenly spaced maxpxls pixels
+    """
+    flat = img.ravel()
+    if flat.size > maxpxls:
+        flat = flat[::flat.size // maxpxls]
+    if N.issubdtype(flat.dtype, N.floating) and N.isnan(flat).any():
+        return N.nan
+    n = flat.size
+    half = n // 2
+    if n % 2:
+        return N.mean(N.partition(flat, half)[half:half+1])
+    part = N.partition(flat, (half - 1, half))
+    return N.mean(part[half-1:half+1])
+
+def paddingMed(img, shape, shift=None, smooth=10, out=None):
     """
     pad with median
     see doc for paddingValue
     """
-    try:
-        med = N.median(img, axis=None)
-    except TypeError: # numpy version < 1.1
-        med = U.median(img)
-    return paddingValue(img, shape, med, shift, smooth)
+    med = fastMedian(img)
+    return paddingValue(img, shape, med, shift, smooth, out=out)
 
 def evenShapeArr(a):
     """
@@ -3,8 +3,7 @@ try:
 except ValueError:
     from Priithon.all import U, N
 
-from . import ppro26 as ppro
-NCPU = ppro.NCPU
+from . import ppro26 as ppro, sharedArr
 
 import scipy.ndimage.interpolation as ndii
 
@@ -22,8 +21,12 @@ METHODS = {'0nearest': 0,
 # a : 7.9
 
 ORDER=3
+FUSED=True # transformation along Z is done together with YX in one 3D interpolation
+SLAB_NZ=8 # max number of sections interpolated at once by the fused transformation
 
-def trans3D(arr, tzyx=(0,0,0), r=0, mag=1, dzyx=(0,0,0), rzy=0, method='a', ncpu=NCPU):#, **splinekwds):
+def trans3D(arr, tzyx=(0,0,0), r=0, mag=1, dzyx=(0,0,0), rzy=0, method='a', ncpu=None):#, **splinekwds):
+    if ncpu is None:
+        ncpu = ppro.NCPU
     order = METHODS.get(method, 3)
     if order == 1:
         func = trans3D_bilinear
@@ -48,12 +51,16 @@ def trans3D(arr, tzyx=(0,0,0), r=0, mag=1, dzyx=(0,0,0), rzy=0, method='a', ncpu
 ## Note: rotation matrix rotates theta in clockwise; but here because we do [y, x], not [x, y],
 ## somehow it turns out right if one thinks of rot as counter-clockwise
 
-def trans3D_affine(arr, tzyx=(0,0,0), r=0, mag=1, dzyx=(0,0,0), rzy=0, ncpu=NCPU, order=ORDER):#**kwds):
+def trans3D_affine(arr, tzyx=(0,0,0), r=0, mag=1, dzyx=(0,0,0), rzy=0, ncpu=None, order=ORDER, fused=FUSED):#**kwds):
     """
+    ncpu:  number of processes, if None, ppro26.NCPU
+    fused: if Z is transformed, do it with YX in a single 3D interpolation (see trans3D_affineFused)
+
     return array 
     """    
+    if ncpu is None:
+        ncpu = ppro.NCPU
     dtype = arr.dtype.type
-    arr = arr.astype(N.float32)
     
     ndim = arr.ndim
     if ndim == 2:
@@ -74,6 +81,15 @@ def trans3D_affine(arr, tzyx=(0,0,0), r=0, mag=1, dzyx=(0,0,0), rzy=0, ncpu=NCPU
     except TypeError:
         pass
 
+    if fused and ndim == 3 and (magz != 1 or tzyx[-3] or rzy):
+        try:
+            mag = (magz,) + tuple(mag)
+        except TypeError:
+            mag = (magz, mag, mag)
+        return trans3D_affineFused(arr, tzyx, r, mag, dzyx, rzy, ncpu, order)
+
+    arr = arr.astype(N.float32)
+
     if ndim == 3 and (magz != 1 or tzyx[-3] or rzy):
         #print magz, arr.shape
         # because, mergins introduced after 2D transformation may interfere the result of this vertical transform, vertical axis was processed first, since rzy is 0 usually.
@@ -84,9 +100,7 @@ def trans3D_affine(arr, tzyx=(0,0,0), r=0, mag=1, dzyx=(0,0,0), rzy=0, ncpu=NCPU
         dzy = (dzyx[-2], dzyx[-3])
 
         #if ncpu > 1 and mp:
-        ret = ppro.pmap(_dothat, arrT, ncpu, tzy, rzy, magzz, dzy, order)
-        for x, a in enumerate(ret):
-            canvas[x] = a
+        ppro.pmapArr(_dothat, arrT, canvas, ncpu, tzy, rzy, magzz, dzy, order)
         #else:
         #    for x, a in enumerate(arrT):
         #        canvas[x] = _dothat(a, tzy, rzy, magzz, dzy, order)
@@ -100,9 +114,7 @@ def trans3D_affine(arr, tzyx=(0,0,0), r=0, mag=1, dzyx=(0,0,0), rzy=0, ncpu=NCPU
         if ndim == 3:# and ncpu > 1 and mp:
             # dividing XY into pieces did not work for rotation and magnification
             # here parallel processing is done section-wise since affine works only for 2D
-            ret = ppro.pmap(_dothat, arr, ncpu, tzyx[-2:], r, mag, dzyx[-2:], order)
-            for z, a in enumerate(ret):
-                canvas[z] = a
+            ppro.pmapArr(_dothat, arr, canvas, ncpu, tzyx[-2:], r, mag, dzyx[-2:], order)
         else:
             for z, a in enumerate(arr):
                 canvas[z] = _dothat(a, tzyx[-2:], r, mag, dzyx[-2:], order)
@@ -118,6 +130,111 @@ def trans3D_affine(arr, tzyx=(0,0,0), r=0, mag=1, dzyx=(0,0,0), rzy=0, ncpu=NCPU
     return arr.astype(dtype)
 
 
+def trans3D_affineFused(arr, tzyx=(0,0,0), r=0, mag=(1,1,1), dzyx=(0,0,0), rzy=0, ncpu=None, order=ORDER, shape=None, zin=0, zout=None):
+    """
+    single pass version of trans3D_affine for 3D arr
+    the stack is spline-prefiltered once, and slabs of SLAB_NZ sections are
+    interpolated (in parallel) into the output of the original dtype
+
+    mag:   (mz,my,mx)
+    shape: shape of the whole stack, if arr is a part of it (default arr.shape)
+    zin:   z index of arr[0] in the whole stack
+    zout:  (start, stop) of the output sections in the whole stack (default all)
+           see inputRangeZ() to find sections required for zout
+
+    return array
+    """
+    if ncpu is None:
+        ncpu = ppro.NCPU
+    dtype = arr.dtype.type
+    if shape is None:
+        shape = arr.shape
+    if zout is None:
+        zout = (0, shape[0])
+    invmat, offset = transformMatrix3D(shape, tzyx, r, mag, dzyx, rzy)
+    offset[0] -= zin
+    cval = arr.min()
+    if order > 1:
+        arr = U.nd.spline_filter(arr, order, output=N.float32)
+
+    nz = zout[1] - zout[0]
+    nslab = max(1, min(SLAB_NZ, -(-nz // max(1, ncpu))))
+    slabs = [(z, min(z + nslab, zout[1])) for z in range(zout[0], zout[1], nslab)]
+    outshape = (nz,) + arr.shape[1:]
+
+    if ncpu > 1 and len(slabs) > 1 and sharedArr.shared_memory is not None:
+        sarr = sharedArr.SharedArray(arr)
+        sout = sharedArr.empty(outshape, dtype)
+        try:
+            ppro.pmap(_affineSlab, slabs, ncpu, sarr, sout, invmat, offset, order, cval, zout[0])
+            out = sout.asarray().copy()
+        finally:
+            sharedArr.release((sarr, sout))
+    else:
+        out = N.empty(outshape, dtype)
+        for slab in slabs:
+            _affineSlab(slab, arr, out, invmat, offset, order, cval, zout[0])
+    return out
+
+def inputRangeZ(shape, zout, tzyx=(0,0,0), r=0, mag=(1,1,1), dzyx=(0,0,0), rzy=0, order=ORDER, margin=8):
+    """
+    shape: shape of the whole stack
+    zout:  (start, stop) of the output sections
+    margin: additional sections for the spline prefilter
+
+    return (start, stop) of the input sections required to make zout by trans3D_affineFused
+    """
+    invmat, offset = transformMatrix3D(shape, tzyx, r, mag, dzyx, rzy)
+    corners = N.array([(z, y, x) for z in (zout[0], zout[1]-1) for y in (0, shape[1]-1) for x in (0, shape[2]-1)], N.float64)
+    zs = N.dot(corners, invmat[0]) + offset[0]
+    if order > 1:
+        margin += order
+    else:
+        margin = 1
+    start = min(max(0, int(N.floor(zs.min())) - margin), shape[0] - 1)
+    stop = max(min(shape[0], int(N.ceil(zs.max())) + 1 + margin), start + 1)
+    return start, stop
+
+def _affineSlab(slab, arr, out, invmat, offset, order, cval, zout0=0):
+    """
+    interpolate sections slab=(start, stop) of the output from prefiltered arr
+    out[0] is the section at zout0
+    """
+    z0, z1 = slab
+    offset = offset + invmat[:,0] * z0
+    ret = U.nd.affine_transform(arr, invmat, offset, output_shape=(z1-z0,)+arr.shape[1:],
+                                output=N.float32, cval=cval, order=order, prefilter=False)
+    if out.dtype.type in (N.int, N.uint8, N.uint16, N.uint32):
+        ret = N.where(ret < 0, 0, ret)
+    out[z0-zout0:z1-zout0] = ret
+
+def transformMatrix3D(shape, tzyx=(0,0,0), r=0, mag=(1,1,1), dzyx=(0,0,0), rzy=0):
+    """
+    combine the vertical (ZY) and the section-wise (YX) transformations of trans3D_affine
+    shape: (nz,ny,nx)
+    mag: (mz,my,mx)
+
+    return invmat, offset (for affine_transform of 3D array)
+    """
+    nz, ny, nx = shape
+    # section-wise YX
+    inv2 = transformMatrix(r, mag[1:])
+    off2 = getOffset((ny, nx), inv2, tzyx[-2], tzyx[-1], (dzyx[-2], dzyx[-1]))
+    m2 = N.identity(3)
+    m2[1:,1:] = inv2
+    o2 = N.zeros((3,))
+    o2[1:] = off2
+
+    # vertical, done in the YZ plane
+    inv1 = transformMatrix(rzy, (1, mag[0]))
+    off1 = getOffset((ny, nz), inv1, 0, tzyx[-3], (dzyx[-2], dzyx[-3]))
+    m1 = N.identity(3)
+    m1[:2,:2] = inv1[::-1,::-1] # yz -> zy
+    o1 = N.zeros((3,))
+    o1[:2] = off1[::-1]
+
+    return N.dot(m1, m2), N.dot(m1, o2) + o1
+
 def _dothat(arr2D, tyx, r, mag, dyx, order=ORDER):
     invmat = transformMatrix(r, mag)
     offset = getOffset(arr2D.shape, invmat, tyx[-2], tyx[-1], (dyx[-2], dyx[-1]))
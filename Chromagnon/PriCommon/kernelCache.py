@@ -0,0 +1,79 @@
+### cache of filter kernels shared by the Fourier-domain filters
+from __future__ import print_function
+import threading
+from collections import OrderedDict
+import numpy as N
+
+# number of kernels kept in the cache
+MAXSIZE = 32
+
+class ArrayCache(object):
+    """
+    least-recently-used cache of read-only arrays, such as filter kernels keyed by (kind, shape, parameters)
+    the cache is shared by threads
+    an item can also be a list of arrays
+    """
+    def __init__(self, maxsize=MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, func, *args, **kwds):
+        """
+        return the array of the key, or make it by func(*args, **kwds) if not cached
+        """
+        with self._lock:
+            if key in self._cache:
+                arr = self._cache.pop(key)
+                self._cache[key] = arr
+                self.hits += 1
+                return arr
+
+        # arrays are made outside of the lock so that other threads are not blocked
+        arr = func(*args, **kwds)
+        for a in (arr if isinstance(arr, list) else [arr]):
+            a.flags.writeable = False
+
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = arr
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return arr
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        return dictionary of hits, misses, size, maxsize and nbytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._cache), 'maxsize': self.maxsize,
+                    'nbytes': sum([N.sum([a.nbytes for a in arr]) if isinstance(arr, list) else arr.nbytes for arr in self._cache.values()])}
+
+KERNELS = ArrayCache()
+
+def getKernel(kind, shape, params, func, *args, **kwds):
+    """
+    kind:   name of the filter
+    shape:  shape of the kernel
+    params: tuple of other parameters that change the kernel
+    func:   function to make the kernel with *args, **kwds
+
+    return the cached kernel (read-only)
+    """
+    key = (kind, tuple([int(s) for s in shape]), params)
+    return KERNELS.get(key, func, *args, **kwds)
+
+def stats():
+    return KERNELS.stats()
+
+def clear():
+    KERNELS.clear()
@@ -1,5 +1,11 @@
 
-import multiprocessing as mp, sys
+import multiprocessing as mp, sys, atexit
+try:
+    from . import sharedArr
+except ValueError:
+    from PriCommon import sharedArr
+except ImportError: # python 2
+    import sharedArr
 
 #from Priithon.all import Y
 
@@ -9,42 +15,156 @@ else:
     NCPU=mp.cpu_count()
     #import multiprocessing.dummy as mp
 
+# a single process pool is kept until exit and re-created only when the number of processes changes
+# Use initPool() at the start of the program, since forking a process that already runs threads
+# (GUI, thread pools, java VM) may deadlock the children
+POOL = None
+POOL_SIZE = None
+
+def initPool(limit=None):
+    """
+    start the process pool with "limit" processes, if None, NCPU
+    """
+    if limit is None:
+        limit = NCPU
+    if limit > 1:
+        getPool(limit)
+
+def getPool(limit=None):
+    """
+    return the process pool with "limit" processes, if None, NCPU
+    the pool is re-used as long as the limit is the same
+    """
+    global POOL, POOL_SIZE
+    if limit is None:
+        limit = NCPU
+    if POOL is not None and POOL_SIZE != limit:
+        closePools()
+    if POOL is None:
+        POOL = mp.Pool(processes=limit)
+        POOL_SIZE = limit
+    return POOL
+
+def closePools():
+    """
+    terminate the process pool
+    """
+    global POOL, POOL_SIZE
+    if POOL is not None:
+        POOL.terminate()
+        POOL.join()
+    POOL = None
+    POOL_SIZE = None
+
+atexit.register(closePools)
+
 def funcWrap(args):
     """
     return (i, result)
     """
 
     callable, i, kwds = args[:3]
-    
-    ret = callable(*args[3:], **kwds)
+
+    args = [sharedArr.restore(arg) for arg in args[3:]]
+    kwds = dict([(key, sharedArr.restore(val)) for key, val in kwds.items()])
+    try:
+        ret = callable(*args, **kwds)
+    finally:
+        del args, kwds
+        sharedArr.detach()
     return i, ret
 
-def pmap(callable, sequence, limit=NCPU, *args, **kwds):
+def pmap(callable, sequence, limit=None, *args, **kwds):
     """
     map function for parallel processing accepting args, kwds
     callable: the first arg must accept items of "sequence"
-    limit: number of cpu to use, if None, uses all available CPU
+    limit: number of cpu to use, if None, uses NCPU
+
+    large arrays in args and kwds are placed in shared memory once instead of pickled for each item
     
     return list of results
     """
+    if limit is None:
+        limit = NCPU
     if limit > 1:
+        origs = list(args) + list(kwds.values())
+        args = [sharedArr.share(arg) for arg in args]
+        kwds = dict([(key, sharedArr.share(val)) for key, val in kwds.items()])
+        try:
+            pool = getPool(limit)
+            args0 = []
+            for i, item in enumerate(sequence):
+                args0.append([callable, i, kwds, item] + list(args))
 
-        pool = mp.Pool(processes=limit)
-        args0 = []
-        for i, item in enumerate(sequence):
-            args0.append([callable, i, kwds, item] + list(args))
-
-        results = pool.map(funcWrap, args0)
-        pool.terminate()
-        # re-ordering
-        # result contains sequential number
-        results.sort()
+            # imap returns results in order
+            chunk = max(1, len(args0) // (limit * 4))
+            results = list(pool.imap(funcWrap, args0, chunk))
+        finally:
+            sharedArr.release(list(args) + list(kwds.values()), origs)
         # remove number
         return [result[1] for result in results]
     else:
-
+        args = [sharedArr.restore(arg) for arg in args]
+        kwds = dict([(key, sharedArr.restore(val)) for key, val in kwds.items()])
         return [callable(x, *args, **kwds) for x in sequence]
 
+def funcArrWrap(args):
+    """
+    process sections start:stop of the shared input array and write to the shared output array
+    """
+    callable, sarr, sout, start, stop, kwds = args[:6]
+
+    arr = sarr.asarray()
+    out = sout.asarray()
+    args = [sharedArr.restore(arg) for arg in args[6:]]
+    try:
+        for i in range(start, stop):
+            out[i] = callable(arr[i], *args, **kwds)
+    finally:
+        del arr, out, args
+        sharedArr.detach()
+
+def pmapArr(callable, arr, out, limit=None, *args, **kwds):
+    """
+    parallel version of
+    for i, a in enumerate(arr):
+        out[i] = callable(a, *args, **kwds)
+
+    arr and out are exchanged with the worker processes through shared memory,
+    so that the sections are not pickled
+    callable: the first arg must accept arr[i], and returns an array of out[i]
+    out: preallocated output array, len(out) == len(arr)
+    limit: number of cpu to use, if None, uses NCPU
+
+    return out
+    """
+    if limit is None:
+        limit = NCPU
+    if limit > 1 and len(arr) > 1 and sharedArr.shared_memory is not None:
+        sarr = sharedArr.SharedArray(arr)
+        sout = sharedArr.empty(out.shape, out.dtype)
+        origs = list(args)
+        args = [sharedArr.share(arg) for arg in args]
+        try:
+            pool = getPool(limit)
+            nsec = len(arr)
+            chunk = max(1, nsec // (limit * 4))
+            args0 = []
+            for start in range(0, nsec, chunk):
+                args0.append([callable, sarr, sout, start, min(start + chunk, nsec), kwds] + list(args))
+
+            pool.map(funcArrWrap, args0)
+            out[:] = sout.asarray()
+        finally:
+            sharedArr.release([sarr, sout] + list(args), [None, None] + origs)
+    elif limit > 1:
+        for i, a in enumerate(pmap(callable, arr, limit, *args, **kwds)):
+            out[i] = a
+    else:
+        for i, a in enumerate(arr):
+            out[i] = callable(a, *args, **kwds)
+    return out
+
 pmapLarge = pmap
  
 def funcMrcFile2D(func, fn, lock, t, w, z, *args, **kwds):
@@ -0,0 +1,147 @@
+### numpy arrays in shared memory for multiprocessing
+from __future__ import print_function
+import numpy as N
+try:
+    from multiprocessing import shared_memory
+except ImportError: # python < 3.8
+    shared_memory = None
+
+# smaller arrays are simply pickled
+MINBYTES = 2**16
+
+# shared memory blocks attached by a worker during a task
+_ATTACHED = {}
+# blocks unlinked by the owner while ndarray views were still alive, closed later
+_UNCLOSED = []
+
+def isLarge(a):
+    """
+    return True if a is an ndarray worth sending through shared memory
+    """
+    return (shared_memory is not None and isinstance(a, N.ndarray)
+            and not a.dtype.hasobject and a.nbytes >= MINBYTES)
+
+def _attach(name):
+    """
+    return SharedMemory of the name, re-using the block already attached during the task
+    """
+    shm = _ATTACHED.get(name)
+    if shm is None:
+        try: # python >= 3.13, the owner process takes care of unlinking
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+        _ATTACHED[name] = shm
+    return shm
+
+def detach():
+    """
+    close the shared memory blocks attached by this process
+    workers call this at the end of each task, so that the blocks unlinked by the owner are freed
+    blocks still in use (eg. by the result of the task) are closed at the next call
+    """
+    for name, shm in list(_ATTACHED.items()):
+        # a block still in use cannot be attached again, since close() released its buffer
+        del _ATTACHED[name]
+        _close(shm)
+
+def _close(shm=None):
+    """
+    close shm and the blocks that could not be closed before
+    a block viewed by ndarrays raises BufferError, and is kept until a later call
+    """
+    if shm is not None:
+        _UNCLOSED.append(shm)
+    for shm in list(_UNCLOSED):
+        try:
+            shm.close()
+        except BufferError: # still viewed
+            continue
+        _UNCLOSED.remove(shm)
+
+class SharedArray(object):
+    """
+    an ndarray in shared memory
+    only name, shape and dtype are pickled, so that workers attach the same memory without copying
+
+    arr:   array to be copied into the shared memory
+    shape, dtype: used if arr is None, to make an empty array (eg. output canvas)
+
+    the process that made the SharedArray must call unlink() when done
+    """
+    def __init__(self, arr=None, shape=None, dtype=N.float32):
+        if arr is not None:
+            arr = N.asarray(arr)
+            shape = arr.shape
+            dtype = arr.dtype
+        self.shape = tuple(shape)
+        self.dtype = N.dtype(dtype)
+        nbytes = int(N.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        self.name = self.shm.name
+        self.owner = True
+        if arr is not None:
+            self.asarray()[:] = arr
+
+    def __getstate__(self):
+        return self.name, self.shape, self.dtype.str
+
+    def __setstate__(self, state):
+        self.name, self.shape, dtype = state
+        self.dtype = N.dtype(dtype)
+        self.shm = None
+        self.owner = False
+
+    def asarray(self):
+        """
+        return ndarray view of the shared memory
+        """
+        # workers attach the block for each task, see detach()
+        shm = self.shm if self.owner else _attach(self.name)
+        # frombuffer keeps the buffer exported, so that the block is not closed under the views
+        # (ndarray(buffer=...) does not, and closing would leave the views dangling)
+        return N.frombuffer(shm.buf, self.dtype, int(N.prod(self.shape))).reshape(self.shape)
+
+    def unlink(self):
+        """
+        release the shared memory (only by the owner)
+        the memory is freed when the arrays from asarray() are gone
+        """
+        if self.owner and self.shm is not None:
+            # the name is removed first, closing waits for the views if any
+            self.shm.unlink()
+            _close(self.shm)
+            self.shm = None
+
+def empty(shape, dtype=N.float32):
+    """
+    return SharedArray with shape and dtype, the values are not initialized
+    """
+    return SharedArray(shape=shape, dtype=dtype)
+
+def share(arg):
+    """
+    return SharedArray if arg is a large ndarray, otherwise arg
+    """
+    if isLarge(arg):
+        return SharedArray(arg)
+    return arg
+
+def restore(arg):
+    """
+    return ndarray if arg is SharedArray, otherwise arg
+    """
+    if isinstance(arg, SharedArray):
+        return arg.asarray()
+    return arg
+
+def release(args, originals=None):
+    """
+    unlink SharedArrays in args
+    originals: the arguments given to share(), SharedArrays found in originals are left to their owner
+    """
+    if originals is None:
+        originals = [None] * len(args)
+    for arg, orig in zip(args, originals):
+        if isinstance(arg, SharedArray) and arg is not orig:
+            arg.unlink()
@@ -7,17 +7,21 @@ try:
     from ..Priithon.all import N, U, F
 except ValueError:
     from Priithon.all import N, U, F
-from . import imgFilters, imgFit, imgGeo
+from scipy import ndimage
+from . import imgFilters, imgFit, imgGeo, kernelCache
 
 # cross-correlation
 PHASE=True
 NYQUIST=0.2#0.6
 
 
-def _findMaxXcor(c, win, gFit=True, niter=2):
+def _findMaxXcor(c, win, gFit=True, niter=2, vzyx=None):
+    """
+    vzyx: (value, z, y, x) of the maximum if already known
+    """
     if gFit:
         for i in range(niter):
-            v, zyx, s = findMaxWithGFit(c, win=win+(i*2))
+            v, zyx, s = findMaxWithGFit(c, win=win+(i*2), vzyx=vzyx)
             if v:
                 if N.any(zyx > N.array(c.shape)) or N.any(zyx < 0):
                     vzyx = N.array(U.findMax(c))#continue
@@ -30,14 +34,16 @@ def _findMaxXcor(c, win, gFit=True, niter=2):
         if not v:
             v = U.findMax(c)[0]
     else:
-        vzyx = U.findMax(c)
+        if vzyx is None:
+            vzyx = U.findMax(c)
         v = vzyx[0]
         zyx = N.array(vzyx[-c.ndim:]) + 0.5 # pixel center
         s = 2.5
     return v, zyx, s
 
-_G = None
-_G_SHAPE = None
+def _highPassKernel(shape, highpassSigma, nx):
+    g = imgFilters.gaussianArrND(shape, highpassSigma, peakVal=1, orig=shape / 2.)
+    return F.shift(g)[...,:nx]
 
 def highPassF(af, highpassSigma=2.5, wiener=0.2, cutoffFreq=3):
     """
@@ -52,22 +58,12 @@ def highPassF(af, highpassSigma=2.5, wiener=0.2, cutoffFreq=3):
 
     WARNING: af will be changed, so use copy() if necessary
     """
-    global _G, _G_SHAPE
     if highpassSigma:
         shape = N.array(af.shape)
         shape[-1] = (shape[-1] - 1) * 2
-        szyx = shape / 2.
-
-        if _G is not None and N.alltrue(_G_SHAPE == shape):
-            g = _G
-        else:
-            g = imgFilters.gaussianArrND(shape, highpassSigma, peakVal=1, orig=szyx)
-            g = F.shift(g)[...,:af.shape[-1]]
 
-            _G = g
-            _G_SHAPE = N.asarray(g.shape)
-        g += wiener
-        af /= g
+        g = kernelCache.getKernel('highpass', shape, (highpassSigma,), _highPassKernel, shape, highpassSigma, af.shape[-1])
+        af /= (g + wiener)
 
     # kill DC
     af.flat[0] = 0
@@ -78,16 +74,19 @@ def highPassF(af, highpassSigma=2.5, wiener=0.2, cutoffFreq=3):
     
     return af
 
-def findMaxWithGFit(img, sigma=0.5, win=11):
+def findMaxWithGFit(img, sigma=0.5, win=11, vzyx=None):
     '''
     find sub-pixel peaks from input img using n-dimensional Guassian fitting
 
     sigma: scaler or [simgaZ,sigmaY..]
     window: a window where the Guassian fit is performed on
+    vzyx: (value, z, y, x) of the maximum if already known
 
     return [v, zyx, sigma]
     '''
-    vzyx = N.array(U.findMax(img))
+    if vzyx is None:
+        vzyx = U.findMax(img)
+    vzyx = N.array(vzyx)
     ndim = img.ndim
     try:
         ret, check = imgFit.fitGaussianND(img, vzyx[-ndim:], sigma, win)
@@ -142,24 +141,18 @@ def bandStopFilter(arr, x=4):
     fa[-x:,1:] = 0
     return F.irfft2d(fa)
 
+def _mexhatKernel(shape, mexSize):
+    shape = N.asarray(shape, N.int)#N.float32)
+    mexhatC = F.shift(F.mexhatArr(shape, scaleHalfMax=mexSize, orig=None)) # orig 0.5 pixel does not work...
+    return F.rfft(mexhatC) / N.multiply.reduce( shape )
+
 def mexhatFilter(a, mexSize=1):#, trimRatio=0.9):
     """
     returned array is trimmed to remove edge
     """
-    global mexhatC, mexhatC_size, mexhatCf
-
     a = imgFilters.evenShapeArr(a)
     from Priithon.all import F as fftw
-    try:
-        if mexhatC.shape != a.shape:
-            raise ValueError('go to except')
-        if mexhatC_size != mexSize:
-            raise ValueError('go to except')
-    except NameError as ValueError:
-        mexhatC_size = mexSize
-        shape = N.asarray(a.shape, N.int)#N.float32)
-        mexhatC = F.shift(F.mexhatArr(shape, scaleHalfMax=mexhatC_size, orig=None)) # orig 0.5 pixel does not work...
-        mexhatCf = fftw.rfft(mexhatC) / N.multiply.reduce( shape )
+    mexhatCf = kernelCache.getKernel('mexhat', a.shape, (mexSize,), _mexhatKernel, a.shape, mexSize)
 
     ar = fftw.irfft( fftw.rfft(a.astype(N.float32)) * mexhatCf )
     
@@ -168,12 +161,21 @@ def mexhatFilter(a, mexSize=1):#, trimRatio=0.9):
     #ar = imgFilters.maskEdgeWithValue2D(ar) # 2 pixels at the edges
     return ar
 
-GAUSS=None
+def _phaseContrastKernel(gshape, nyquist, nx):
+    #sigma = af.shape[-1] * nyquist
+    #gf = F.gaussianArr(afa.shape, sigma, peakVal=1, orig=0, wrap=(1,)*(afa.ndim-1)+(0,))#, dtype=afa.dtype.type)
+    sigma = gshape * nyquist
+    gf = imgFilters.gaussianArrND(gshape, sigma, peakVal=1)
+    return N.fft.fftshift(gf)[Ellipsis, :nx]
 
-def phaseContrastFilter(a, inFourier=False, removeNan=True, nyquist=0.6):
-    global GAUSS
+def phaseContrastFilter(a, inFourier=False, removeNan=True, nyquist=0.6, stack=False):
+    """
+    stack: a is a stack of 2D images (n,y,x), each section is filtered separately
+    """
     if inFourier:
         af = a.copy()
+    elif stack:
+        af = F.rfft2d(a)
     else:
         af = F.rfft(a)
 
@@ -181,28 +183,27 @@ def phaseContrastFilter(a, inFourier=False, removeNan=True, nyquist=0.6):
     amp = N.abs(af)
     afa = af / amp
 
-    if removeNan:
+    if removeNan and stack:
+        afa = N.array([nanFilter(aa) for aa in afa])
+    elif removeNan:
         afa = nanFilter(afa)
 
     # lowpass gaussian filter of phase image
+    if stack:
+        fshape = afa.shape[-2:]
+    else:
+        fshape = afa.shape
     if nyquist: # since this takes long time, gaussian array is re-used if possible
-        if GAUSS is not None and GAUSS[0] == nyquist and GAUSS[1].shape == afa.shape:
-            nq, gf = GAUSS
-        else:
-            #sigma = af.shape[-1] * nyquist
-            #gf = F.gaussianArr(afa.shape, sigma, peakVal=1, orig=0, wrap=(1,)*(afa.ndim-1)+(0,))#, dtype=afa.dtype.type)
-            gshape = N.array(af.shape)
-            if inFourier:
-                gshape[-1] *= 2
-            sigma = gshape * nyquist
-            gf = imgFilters.gaussianArrND(gshape, sigma, peakVal=1)
-            gf = N.fft.fftshift(gf)[Ellipsis, :af.shape[-1]]
-            
-            GAUSS = (nyquist, gf)
+        gshape = N.array(fshape)
+        if inFourier:
+            gshape[-1] *= 2
+        gf = kernelCache.getKernel('phaseContrast', gshape, (nyquist, af.shape[-1]), _phaseContrastKernel, gshape, nyquist, af.shape[-1])
         afa *= gf
 
     if inFourier:
         ap = afa
+    elif stack:
+        ap = F.irfft2d(afa, preserve=False)
     else:
         ap = F.irfft(afa)
     return ap
@@ -234,13 +235,13 @@ def Xcorr(a, b, phaseContrast=PHASE, nyquist=NYQUIST, gFit=True, win=11, ret=Non
     #nyx = max(shape[-2:])
     #pshape = N.array(a.shape[:-2] + (nyx,nyx))
 
-    # apodize
-    a = paddAndApo(a, npad)#, pshape) #apodize(a)
-    b = paddAndApo(b, npad)#, pshape) #apodize(b)
+    # apodize (into the buffers of this thread, since they are copied into the fft plan)
+    a = paddAndApo(a, npad, out=imgFilters.getWorkspace('xcorr_a', shape + (npad * 2), N.float32))#, pshape) #apodize(a)
+    b = paddAndApo(b, npad, out=imgFilters.getWorkspace('xcorr_b', shape + (npad * 2), N.float32))#, pshape) #apodize(b)
 
     # fourier transform
-    af = F.rfft(a.astype(N.float32))
-    bf = F.rfft(b.astype(N.float32))
+    af = F.rfft(a)
+    bf = F.rfft(b)
     del a, b
 
     # phase contrast filter (removing any intensity information)
@@ -284,33 +285,133 @@ def Xcorr(a, b, phaseContrast=PHASE, nyquist=NYQUIST, gFit=True, win=11, ret=Non
     else:
         return zyx, c
 
+def prepareStack(a, phaseContrast=PHASE, nyquist=NYQUIST, npad=4):
+    """
+    apodize and Fourier transform a stack of 2D images (n,y,x) as XcorrStack does
+
+    return the spectrum that can be given to XcorrStack as "af"
+    """
+    a = _evenShapeStack(N.asarray(a))
+
+    # apodize
+    a = paddAndApoStack(a, npad)
+
+    # fourier transform
+    af = F.rfft2d(a)
+    del a
+
+    # phase contrast filter (removing any intensity information)
+    if phaseContrast:
+        af = phaseContrastFilter(af, True, nyquist=nyquist, stack=True)
+    return af
+
+def XcorrStack(a, b, phaseContrast=PHASE, nyquist=NYQUIST, gFit=True, win=11, ret=None, searchRad=None, npad=4, af=None, bf=None):
+    """
+    cross correlation of a stack of 2D image pairs of the same shape
+    all pairs are Fourier transformed at once and the peaks are searched in a vectorized way,
+    only the sub-pixel Gaussian fit is done pair by pair.
+
+    a, b: stacks of 2D images with shape (n,y,x)
+    af:   spectrum of a made by prepareStack with the same parameters,
+          if given, a is not used (can be None)
+    bf:   spectrum of b as af
+    other parameters are the same as Xcorr
+
+    if ret is None:
+        return yxs, xcfs
+    elif ret is 2:
+        return ss, vs, yxs, xcfs
+    elif ret:
+        return vs, yxs, xcfs
+    """
+    if af is None:
+        afa = prepareStack(a, phaseContrast, nyquist, npad)
+    else:
+        afa = af
+
+    # padded shape of the even shaped images
+    targetShape = N.array((afa.shape[-2], (afa.shape[-1] - 1) * 2))
+
+    # shift array
+    delta = targetShape / 2.
+    shiftarr = F.fourierRealShiftArr(tuple(targetShape), delta)
+    if bf is None:
+        bfa = prepareStack(b, phaseContrast, nyquist, npad)
+        bfa *= shiftarr
+    else:
+        bfa = bf * shiftarr
+
+    # cross correlation
+    bfa = bfa.conjugate()
+    c = cc = F.irfft2d(afa * bfa, preserve=False)
+
+    center = N.divide(c.shape[-2:], 2)
+    if searchRad:
+        slc = tuple(imgGeo.nearbyRegion(c.shape[-2:], center, searchRad)) # starts with Ellipsis
+        cc = N.zeros_like(c)
+        cc[slc] = c[slc]
+
+    # peaks of all pairs
+    n = cc.shape[0]
+    idx = N.argmax(cc.reshape((n, -1)), axis=1)
+    ys, xs = N.unravel_index(idx, cc.shape[-2:])
+    vs = cc.reshape((n, -1))[N.arange(n), idx]
+
+    yxs = N.empty((n, 2), N.float64)
+    ss = []
+    for i in range(n):
+        v, yx, s = _findMaxXcor(cc[i], win, gFit=gFit, vzyx=(vs[i], 0, ys[i], xs[i]))
+        yxs[i] = yx
+        vs[i] = N.ravel(v)[0]
+        ss.append(s)
+    yxs -= center
+
+    c = c[:, npad:c.shape[-2]-npad, npad:c.shape[-1]-npad]
+
+    if ret == 2:
+        return ss, vs, yxs, c
+    elif ret:
+        return vs, yxs, c
+    else:
+        return yxs, c
+
+def _evenShapeStack(a):
+    """
+    return a stack of 2D images (n,y,x) cropped to even shape in YX as evenShapeArr does
+    """
+    if a.shape[-2] % 2:
+        a = a[:, 1:]
+    if a.shape[-1] % 2:
+        a = a[:, :, 1:]
+    return a
+
 def nanFilter(af, kernel=3):
     """
     3D phase contrast filter often creates 'nan'
     this filter removes nan by averaging surrounding pixels
+
+    all nan pixels are filled at once from the surrounding pixels that were not nan,
+    unlike the former pixel-by-pixel filter which used the values already filled for nan pixels next to each other
+    (the results are the same for isolated nan pixels)
+
     return af
     """
     af = af.copy()
-    shape = N.array(af.shape)
-    radius = N.subtract(kernel, 1) // 2
-    box = kernel * af.ndim
     nan = N.isnan(af)
-    nids = N.array(N.nonzero(nan)).T
-    for nidx in nids:
-        slc = [slice(idx,idx+1) for idx in nidx]
-        slices = []
-        for dim in range(af.ndim):
-            slc2 = slice(slc[dim].start - radius, slc[dim].stop + radius)
-            while slc2.start < 0:
-                slc2 = slice(slc2.start + 1, slc2.stop)
-            while slc2.stop > shape[dim]:
-                slc2 = slice(slc2.start, slc2.stop -1)
-            slices.append(slc2)
-            
-        val = af[slices]
-        nanlocal = N.isnan(val)
-        ss = N.sum(N.where(nanlocal, 0, val)) / float((box - N.sum(nanlocal)))
-        af[slc] = ss
+    if not nan.any():
+        return af
+
+    # normalized convolution: sum of the valid neighbors divided by the number of the valid ones
+    # pixels outside count as valid with the value 0, and "box" is kept as the former filter
+    box = kernel * af.ndim
+    window = N.ones((kernel,) * af.ndim, N.float32)
+    valid = N.where(nan, 0, af)
+    if N.iscomplexobj(af):
+        ssum = ndimage.correlate(valid.real, window, mode='constant') + 1j * ndimage.correlate(valid.imag, window, mode='constant')
+    else:
+        ssum = ndimage.correlate(valid, window, mode='constant')
+    nnan = ndimage.correlate(nan.astype(N.int32), window.astype(N.int32), mode='constant')
+    af[nan] = ssum[nan] / (box - nnan[nan]).astype(N.float32)
     return af
 
 def normalizedXcorr(a, b):
@@ -322,12 +423,46 @@ def normalizedXcorr(a, b):
     
     return c
 
-def paddAndApo(img, npad=4, shape=None):
+def paddAndApo(img, npad=4, shape=None, out=None):
+    """
+    the image is padded with its median (imgFilters.fastMedian) on a float32 canvas
+    out: float32 array to write the result (see imgFilters.paddingValue)
+    """
     if shape is None:
         shape = N.array(img.shape)
     else:
         shape = N.array(shape)
-    return imgFilters.paddingMed(img, shape + (npad * 2), smooth=npad)
+    img = N.asarray(img, N.float32)
+    return imgFilters.paddingMed(img, shape + (npad * 2), smooth=npad, out=out)
+
+def paddAndApoStack(a, npad=4):
+    """
+    paddAndApo for a stack of even shaped 2D images (n,y,x)
+    all sections are padded with their own median and apodized at once
+
+    return float32 array (n,y+npad*2,x+npad*2)
+    """
+    n, ny, nx = a.shape
+    med = N.array([imgFilters.fastMedian(sec) for sec in a], N.float32)[:,None,None]
+    canvas = N.empty((n, ny + npad * 2, nx + npad * 2), N.float32)
+    canvas[:] = med
+    canvas[:,npad:npad+ny,npad:npad+nx] = a
+    if npad:
+        # linear ramp from the edge value to the median as in imgFilters._smoothBorder
+        ramp = N.arange(1, npad+1, dtype=N.float32) / (npad + 1)
+        canvas[:,:npad] = med + (canvas[:,npad:npad+1] - med) * ramp[:,None]
+        canvas[:,-npad:] = med + (canvas[:,-npad-1:-npad] - med) * ramp[::-1,None]
+        canvas[:,:,:npad] = med + (canvas[:,:,npad:npad+1] - med) * ramp
+        canvas[:,:,-npad:] = med + (canvas[:,:,-npad-1:-npad] - med) * ramp[::-1]
+    return canvas
+
+def warmupFFT(shapes, npad=4):
+    """
+    make fft plans for Xcorr of images of shapes in advance
+    plans are kept per thread, and are made for the calling thread
+    """
+    for shape in shapes:
+        F.fftw.warmup(imgGeo.evenShape(shape) + (npad * 2))
 
 
 def apodize(img, napodize=10, doZ=True):
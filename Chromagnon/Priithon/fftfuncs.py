@@ -932,18 +932,17 @@ def rfft2d(a, minFdtype=fftw.RTYPE, nthreads=fftw.ncpu):
     nx = a.shape[-1]
     if nx % 2:
         raise ValueError("a must be even sized in last dimension")
-    s2 = a.shape[:-1]+(nx//2+1,)
-
     
     if aDtype == N.float32:
-        af = N.empty(shape=s2, dtype=N.complex64)
+        afDtype = N.complex64
     elif aDtype == N.float64:
-        af = N.empty(shape=s2, dtype=N.complex128)
+        afDtype = N.complex128
     else:
         raise TypeError("a must be of dtype float32 or float64 (%s given)"%a.dtype) 
-    for tup in N.ndindex(a.shape[:-2]):
-        af[tup] = fftw.rfft(N.asarray(a[tup], aDtype), nthreads=nthreads)
-    return af
+
+    # all sections are transformed by a single multi-axis call
+    af = fftw.rfft(N.asarray(a, aDtype), nthreads=nthreads, axes=(-2,-1))
+    return N.asarray(af, afDtype)
 
 def irfft2d(af, preserve=True, minCdtype=fftw.CTYPE, nthreads=fftw.ncpu):#normalize=True, minCdtype=fftw.CTYPE, nthreads=fftw.ncpu):
     """
@@ -966,23 +965,21 @@ def irfft2d(af, preserve=True, minCdtype=fftw.CTYPE, nthreads=fftw.ncpu):#normal
         afDtype = minCdtype
     else:
         afDtype = af.dtype.type # ensures native byte-order ?
-    
-    shape = af.shape[:-1] + ((af.shape[-1]-1)*2,)
 
     if   afDtype == N.complex64:
-        a = N.empty(shape=shape, dtype=N.float32)
+        aDtype = N.float32
     elif afDtype == N.complex128:
-        a = N.empty(shape=shape, dtype=N.float64)
+        aDtype = N.float64
     else:
         raise TypeError("af must be of dtype complex64 or complex128 (%s given)"%af.dtype) 
 
-    for tup in N.ndindex(af.shape[:-2]):
-        if preserve :
-            myAF = N.array(af[tup], afDtype, copy=1)
-        else:
-            myAF = N.asarray(af[tup], afDtype)
-        a[tup] = fftw.irfft(myAF, nthreads=nthreads)#), normalize=normalize, nthreads=nthreads)
-    return a
+    if preserve :
+        myAF = N.array(af, afDtype, copy=1)
+    else:
+        myAF = N.asarray(af, afDtype)
+    # all sections are transformed by a single multi-axis call
+    a = fftw.irfft(myAF, nthreads=nthreads, axes=(-2,-1))#), normalize=normalize, nthreads=nthreads)
+    return N.asarray(a, aDtype)
 
 '''
 def fft1d(a, n=None, axis=-1):
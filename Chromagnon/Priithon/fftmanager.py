@@ -4,6 +4,8 @@ if sys.version_info.major >= 3:
     from importlib import reload
 import multiprocessing as mp
 import threading as th
+import pickle
+from collections import OrderedDict
 
 ## ----- default numpy fft -----
 import numpy as N
@@ -76,8 +78,69 @@ print('REIK: ', REIK)
 # disable GPU functions
 SCIK = False
 REIK = False
+
+## ------ fftw plan cache ------
+# number of plans (with their aligned buffers) kept per thread
+PLAN_CACHE_SIZE = 32
+# plans for arrays larger than this (bytes) are not kept
+PLAN_CACHE_MAXBYTES = 2**28
+# total bytes of the buffers of the plans kept per thread
+PLAN_CACHE_BYTES = 2**29
+# planning takes longer than FFTW_ESTIMATE, but plans are re-used and can be saved as wisdom
+PLANNER_EFFORT = 'FFTW_MEASURE'
+# plans that are not kept are used once, and FFTW_MEASURE would not pay off
+PLANNER_EFFORT_UNCACHED = 'FFTW_ESTIMATE'
+WISDOM_FN = 'pyfftw.wisdom'
+
 ## ------ funcs and classes -----------
 
+def getWisdomPath(fn=None):
+    """
+    return hidden wisdom file at the home directory
+    """
+    if not fn:
+        fn = WISDOM_FN
+    if sys.platform.startswith('win'):
+        ofn = os.path.join(os.getenv('APPDATA'), fn)
+    else:
+        ofn = os.path.join(os.path.expanduser('~'), '.' + fn)
+    return ofn
+
+def saveWisdom(fn=None):
+    """
+    save fftw wisdom accumulated in this process into a file
+    fn: if None, use getWisdomPath()
+
+    return True if saved
+    """
+    if not FFTW:
+        return False
+    if not fn:
+        fn = getWisdomPath()
+    with open(fn, 'wb') as h:
+        pickle.dump(pyfftw.export_wisdom(), h, protocol=2)
+    return True
+
+def loadWisdom(fn=None):
+    """
+    load fftw wisdom saved by saveWisdom()
+    fn: if None, use getWisdomPath()
+
+    return True if loaded
+    """
+    if not FFTW:
+        return False
+    if not fn:
+        fn = getWisdomPath()
+    if not os.path.isfile(fn):
+        return False
+    try:
+        with open(fn, 'rb') as h:
+            wisdom = pickle.load(h)
+        return any(pyfftw.import_wisdom(wisdom))
+    except (IOError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        return False
+
 def register():
     thread = th.current_thread()
     thread.fftmanager = FFTManager()
@@ -91,6 +154,11 @@ class FFTManager(object):
         self.ncpu = mp.cpu_count()
 
         self.init = False
+
+        # fftw plans are not thread safe, each thread keeps its own cache
+        self._plans = th.local()
+        self.hits = 0
+        self.misses = 0
         
         self.make_cuda_context()
         self.init_reikna()
@@ -185,15 +253,103 @@ class FFTManager(object):
         return a
 
     ### -----fftw -----
-    def _fftw(self, a, func, nthreads=ncpu):
+    def _fftw(self, a, func, nthreads=ncpu, axes=None):
         if 0 in a.shape:
             raise ValueError('This array cannot be transformed, shape: %s' % str(a.shape))
 
-        axes = [i - a.ndim for i in range(a.ndim)]
-        af = pyfftw.empty_aligned(a.shape, dtype=a.dtype.type.__name__)
-        plan = func(af, axes=axes, threads=nthreads)
-        af[:] = a[:]
-        return plan()
+        if axes is None:
+            axes = [i - a.ndim for i in range(a.ndim)]
+        plan, cached = self.get_plan(a.shape, a.dtype, func, axes, nthreads)
+        plan.input_array[:] = a
+        if cached:
+            # the output buffer of a cached plan is overwritten by the next call with the same key,
+            # and callers of rfft, irfft... keep the result (eg. as a reference image),
+            # so a copy is returned. Its cost is small compared with the transform itself.
+            return plan().copy()
+        else:
+            return plan()
+
+    def _plan_cache(self):
+        cache = getattr(self._plans, 'cache', None)
+        if cache is None:
+            cache = self._plans.cache = OrderedDict()
+            self._plans.nbytes = 0
+        return cache
+
+    def cached_bytes(self):
+        """
+        return total bytes of the buffers of the plans cached by the current thread
+        """
+        self._plan_cache()
+        return self._plans.nbytes
+
+    def get_plan(self, shape, dtype, func, axes, nthreads=ncpu):
+        """
+        return (plan, cached)
+
+        plans and their aligned buffers are kept in a LRU cache
+        keyed on (shape, dtype, direction, axes, threads),
+        limited to PLAN_CACHE_SIZE plans and PLAN_CACHE_BYTES per thread
+        """
+        dtype = N.dtype(dtype)
+        axes = tuple([ax % len(shape) - len(shape) for ax in axes])
+        maxthreads = getattr(self._plans, 'maxthreads', None)
+        if maxthreads and nthreads > maxthreads:
+            nthreads = maxthreads
+        key = (tuple(shape), dtype.str, func.__name__, axes, nthreads)
+        cache = self._plan_cache()
+        if key in cache:
+            self.hits += 1
+            plan, nbytes = cache.pop(key)
+            cache[key] = (plan, nbytes) # move to the end
+            return plan, True
+
+        self.misses += 1
+        # input and output buffers, the output of complex-real transforms is about the same size
+        nbytes = 2 * int(N.prod(shape)) * dtype.itemsize
+        cached = nbytes <= min(PLAN_CACHE_MAXBYTES, PLAN_CACHE_BYTES) and PLAN_CACHE_SIZE > 0
+
+        af = pyfftw.empty_aligned(shape, dtype=dtype.name)
+        effort = PLANNER_EFFORT if cached else PLANNER_EFFORT_UNCACHED
+        plan = func(af, axes=axes, threads=nthreads, planner_effort=effort)
+
+        if not cached:
+            return plan, False
+
+        cache[key] = (plan, nbytes)
+        self._plans.nbytes += nbytes
+        while len(cache) > PLAN_CACHE_SIZE or self._plans.nbytes > PLAN_CACHE_BYTES:
+            self._plans.nbytes -= cache.popitem(last=False)[1][1]
+        return plan, True
+
+    def set_max_threads(self, nthreads=None):
+        """
+        limit the number of fftw threads used by the current thread, None for no limit
+        eg. 1 for workers of a thread pool, so that the cpus are not oversubscribed
+        """
+        self._plans.maxthreads = nthreads
+
+    def clear_plans(self):
+        """
+        remove plans cached by the current thread
+        """
+        self._plan_cache().clear()
+        self._plans.nbytes = 0
+
+    def warmup(self, shape, dtype=RTYPE, axes=None, nthreads=ncpu):
+        """
+        make rfft and irfft plans for a real array of shape in advance
+        axes: axes to be transformed, if None, all axes are transformed
+        """
+        if not FFTW:
+            return
+        shape = tuple([int(s) for s in shape])
+        if axes is None:
+            axes = [i - len(shape) for i in range(len(shape))]
+        ctype = {N.dtype(N.float32): N.complex64, N.dtype(N.float64): N.complex128}[N.dtype(dtype)]
+        cshape = shape[:-1] + (shape[-1]//2 + 1,)
+        self.get_plan(shape, dtype, pyfftw.builders.rfftn, axes, nthreads)
+        self.get_plan(cshape, ctype, pyfftw.builders.irfftn, axes, nthreads)
 
     # ---- scikit cuda -----
     def _fft_scik(self, a, func, shape, dtype):
@@ -205,17 +361,20 @@ class FFTManager(object):
 
     # ---- fft funcs ----------
     
-    def rfft(self, a, nthreads=ncpu):
+    def rfft(self, a, nthreads=ncpu, axes=None):
+        """
+        axes: axes to be transformed, if None, all axes are transformed
+        """
         a = self.check_array(a, RTYPES, RTYPE)
         
-        if SCIK and self.is_gpu_memory_enough(a):
+        if SCIK and axes is None and self.is_gpu_memory_enough(a):
             shape = [s for s in a.shape]
             shape[-1] = shape[-1]//2 + 1
             dtype = G_RTYPES[a.dtype.type]
             func = fft.fft
             af = self._fft_scik(a, func, shape, dtype)
             
-        elif REIK and self.is_gpu_memory_enough(a):
+        elif REIK and axes is None and self.is_gpu_memory_enough(a):
             thr = self.api.Thread(self.dev)
 
             plan  = FFT(Type(complex_for(a.dtype), a.shape))
@@ -241,16 +400,19 @@ class FFTManager(object):
         elif FFTW:
             func = pyfftw.builders.rfftn
 
-            af = self._fftw(a, func, nthreads)
+            af = self._fftw(a, func, nthreads, axes)
         else:
-            af = N.fft.rfftn(a)
+            af = N.fft.rfftn(a, axes=axes)
 
         return af
         
-    def irfft(self, a, nthreads=0):
+    def irfft(self, a, nthreads=0, axes=None):
+        """
+        axes: axes to be transformed, if None, all axes are transformed
+        """
         a = self.check_array(a, CTYPES, CTYPE)
         
-        if SCIK and is_memory_enough(a):
+        if SCIK and axes is None and is_memory_enough(a):
             shape = [s for s in a.shape]
             shape[-1] = (shape[-1]-1)*2
             dtype = G_CTYPES[a.dtype.type]
@@ -261,10 +423,10 @@ class FFTManager(object):
         elif FFTW:
             func = pyfftw.builders.irfftn
                 
-            af = self._fftw(a, func, nthreads=nthreads)
+            af = self._fftw(a, func, nthreads=nthreads, axes=axes)
 
         else:
-            af = N.fft.irfftn(a)
+            af = N.fft.irfftn(a, axes=axes)
 
         return af
 
@@ -294,14 +456,20 @@ class FFTManager(object):
 
 man = FFTManager()
 
-def rfft(a, nthreads=ncpu):
-    return man.rfft(a, nthreads)
+def rfft(a, nthreads=ncpu, axes=None):
+    return man.rfft(a, nthreads, axes)
 
-def irfft(a, nthreads=ncpu):
-    return man.irfft(a, nthreads)
+def irfft(a, nthreads=ncpu, axes=None):
+    return man.irfft(a, nthreads, axes)
 
 def fft(a, nthreads=ncpu):
     return man.fft(a, nthreads)
 
 def ifft(a, nthreads=ncpu):
     return man.ifft(a, nthreads)
+
+def warmup(shape, dtype=RTYPE, axes=None, nthreads=ncpu):
+    return man.warmup(shape, dtype, axes, nthreads)
+
+def setMaxThreads(nthreads=None):
+    return man.set_max_threads(nthreads)
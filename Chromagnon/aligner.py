@@ -1,14 +1,16 @@
 from __future__ import print_function
-import os
+import os, sys, threading
+import six
+from six.moves import queue
 import numpy as N
 from scipy import ndimage as nd
 
 try:
-    from PriCommon import imgGeo, imgFilters, xcorr, fntools
+    from PriCommon import imgGeo, imgFilters, xcorr, fntools, imgResample
     from Priithon.all import Mrc, U
     import imgio
 except ImportError:
-    from Chromagnon.PriCommon import imgGeo, imgFilters, xcorr, fntools
+    from Chromagnon.PriCommon import imgGeo, imgFilters, xcorr, fntools, imgResample
     from Chromagnon.Priithon.all import Mrc, U
     from Chromagnon import imgio
     
@@ -32,6 +34,14 @@ ZYXRM_ENTRY=['tz','ty','tx','r','mz','my','mx']
 NUM_ENTRY=len(ZYXRM_ENTRY)
 
 ZMAG_CHOICE = ['Auto', 'Always', 'Never']
+LOCAL_CHOICE = ['None', 'Projection']#, 'Section-wise']
+
+# number of sections read and transformed at once when saving
+SAVE_SLAB_NZ = 16
+# read, transform and write in separate threads when saving
+PIPELINE = True
+# number of slabs waiting in each queue of the pipeline
+PIPELINE_DEPTH = 2
 
 # file extention
 IMG_SUFFIX='_ALN'
@@ -40,6 +50,82 @@ WRITABLE_FORMATS = ['tif', 'dv', 'ome.tif']
 # chromagnon file format
 IDTYPE = 101
 
+def runPipeline(items, func, writer, depth=PIPELINE_DEPTH):
+    """
+    items:  iterable (eg. generator reading images), iterated in a reader thread
+    func:   function applied to each item in the calling thread
+    writer: function called with each result of func in a writer thread
+
+    items are processed in order, and each queue holds at most "depth" items
+    exceptions in any of the threads are raised in the calling thread
+    """
+    END = object()
+    stop = threading.Event()
+    qin = queue.Queue(depth)
+    qout = queue.Queue(depth)
+    errs = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+    def read():
+        try:
+            for item in items:
+                if not put(qin, (item, None)):
+                    return
+        except:
+            put(qin, (END, sys.exc_info()))
+        else:
+            put(qin, (END, None))
+
+    def write():
+        while True:
+            item = qout.get()
+            if item is END:
+                return
+            if not errs:
+                try:
+                    writer(item)
+                except:
+                    errs.append(sys.exc_info())
+                    stop.set()
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    writer_thread = threading.Thread(target=write)
+    writer_thread.daemon = True
+    reader.start()
+    writer_thread.start()
+
+    try:
+        while not stop.is_set():
+            try:
+                item, exc = qin.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is END:
+                if exc:
+                    six.reraise(*exc)
+                break
+            if not put(qout, func(item)):
+                break
+    except:
+        stop.set()
+        raise
+    finally:
+        qout.put(END) # the writer keeps taking items until END
+        writer_thread.join()
+        stop.set()
+        reader.join()
+
+    if errs:
+        six.reraise(*errs[0])
+
 class Chromagnon(object):
 
     def __init__(self, fn):
@@ -415,6 +501,10 @@ class Chromagnon(object):
         else:
             doXcorr = True
 
+        # the reference quadrants are prepared once for all channels
+        prepyz = af.PreparedRef(self.refyz)
+        prepyx = af.PreparedRef(self.refyx)
+
         for w in range(self.img.nw):
             if (doWave and w == self.refwave) or (not doWave and w != self.refwave):
                 continue
@@ -459,7 +549,7 @@ class Chromagnon(object):
                     else:
                         if_failed = af.IF_FAILED[-1] # 'terminate' -> xcorr
                     
-                    val, check = af.iteration(imgyz, self.refyz, maxErr=(self.maxErrYX, self.maxErrZ), niter=self.niter, phaseContrast=self.phaseContrast, initguess=initguess, echofunc=self.echofunc, max_shift_pxl=self.max_shift_pxl, cqthre=af.CTHRE/20., if_failed=if_failed)
+                    val, check = af.iteration(imgyz, prepyz, maxErr=(self.maxErrYX, self.maxErrZ), niter=self.niter, phaseContrast=self.phaseContrast, initguess=initguess, echofunc=self.echofunc, max_shift_pxl=self.max_shift_pxl, cqthre=af.CTHRE/20., if_failed=if_failed)
 
                     #if check:# is not None:
                     ty2,tz,_,_,mz = val#check
@@ -491,10 +581,10 @@ class Chromagnon(object):
             initguess[:3] = ret[w,1:4] # ty,tx,r
             initguess[3:] = ret[w,5:7] # my, mx
             try:
-                val, check = af.iteration(imgyx, self.refyx, maxErr=self.maxErrYX, niter=self.niter, phaseContrast=self.phaseContrast, initguess=initguess, echofunc=self.echofunc, max_shift_pxl=self.max_shift_pxl, if_failed=self.if_failed)
+                val, check = af.iteration(imgyx, prepyx, maxErr=self.maxErrYX, niter=self.niter, phaseContrast=self.phaseContrast, initguess=initguess, echofunc=self.echofunc, max_shift_pxl=self.max_shift_pxl, if_failed=self.if_failed)
             except ZeroDivisionError:
                 if self.phaseContrast:
-                    val, check = af.iteration(imgyx, self.refyx, maxErr=self.maxErrYX, niter=self.niter, phaseContrast=False, initguess=initguess, echofunc=self.echofunc, max_shift_pxl=self.max_shift_pxl, if_failed=self.if_failed)
+                    val, check = af.iteration(imgyx, prepyx, maxErr=self.maxErrYX, niter=self.niter, phaseContrast=False, initguess=initguess, echofunc=self.echofunc, max_shift_pxl=self.max_shift_pxl, if_failed=self.if_failed)
                 else: # XY alignment failed
                     raise
             ty,tx,r,my,mx = val
@@ -558,6 +648,10 @@ class Chromagnon(object):
         else:
             self.mapyx = imgFilters.paddingValue(self.mapyx, shape=self.img.shape[-2:], value=0)
 
+        # the reference tiles are prepared once for all channels
+        self.refyx = self.refyx.astype(N.float32)
+        prepyx = af.PreparedRef(self.refyx)
+
         # calculation
         for w in range(self.img.nw):
             if w == self.refwave:
@@ -584,9 +678,8 @@ class Chromagnon(object):
             affine = self.alignParms[t,w]
 
             imgyx = imgyx.astype(N.float32)
-            self.refyx = self.refyx.astype(N.float32)
             
-            yxs, regions, arr2 = af.iterWindowNonLinear(imgyx, self.refyx, npxls, affine=affine, initGuess=self.mapyx[t,w], phaseContrast=self.phaseContrast, maxErr=self.maxErrYX, cthre=self.cthre, echofunc=self.echofunc)
+            yxs, regions, arr2 = af.iterWindowNonLinear(imgyx, prepyx, npxls, affine=affine, initGuess=self.mapyx[t,w], phaseContrast=self.phaseContrast, maxErr=self.maxErrYX, cthre=self.cthre, echofunc=self.echofunc)
 
             self.mapyx[t,w] = yxs
             if self.regions is None or self.regions.shape[-2:] != regions.shape:
@@ -902,21 +995,132 @@ class Chromagnon(object):
         return des
         
 
-    def min_is_zero(self):
+    def min_is_zero(self, mins={}):
         """
+        mins: minimum of the sections already known as {(t, w): {z: min}},
+              the other sections are read one by one
+
         return True if minimum of all sections is 0
         """
         if self.dtype == N.float32:
+            if any(N.min(list(known.values())) < 0 for known in mins.values() if known):
+                return
             for t in range(self.img.nt):
                 for w in range(self.img.nw):
-                    arr = self.img.get3DArr(w=w, t=t)
-                    if arr.min() != 0:
+                    known = mins.get((t, w), {})
+                    secmin = [known[z] if z in known else self.img.getArr(t=t, z=z, w=w).min() for z in range(self.img.nz)]
+                    if N.min(secmin) != 0:
                         return
             return True
 
-    def saveAlignedImage(self, fn=None):
+    def _alignMode(self, w=0, t=0):
+        """
+        return (copy, remap, doZ, mapyx)
+        """
+        parm = self.alignParms[t,w]
+        copy = w == self.refwave and self.nt == 1
+        remap = not copy and self.mapyx is not None
+        doZ = not copy and bool(parm[0] or parm[4] != 1)
+        mapyx = None
+        if remap:
+            mapyx = self.mapyx[t,w]
+            if mapyx.ndim == 4 and mapyx.shape[0] == 1:
+                mapyx = mapyx[0]
+            elif mapyx.ndim == 4: # section-wise map, sliced by the output Z range in transformAligned()
+                mapyx = af.resizeLocal3D(mapyx, (self.img.nz, self.img.ny, self.img.nx))
+        return copy, remap, doZ, mapyx
+
+    def _zParms(self, w=0, t=0):
+        """
+        return (tzyx, r, mag, parm) for trans3D_affineFused and the remaining parameter for remapping
+        """
+        copy, remap, doZ, mapyx = self._alignMode(w, t)
+        parm = self.alignParms[t,w]
+        if remap: # only Z is transformed by trans3D_affineFused, and then remapped section-wise
+            tzyx = (parm[0], 0, 0)
+            r = 0
+            mag = (parm[4], 1, 1)
+            parm = parm.copy()
+            parm[0] = 0
+            parm[4] = 1
+        else:
+            tzyx = parm[:3]
+            r = parm[3]
+            mag = parm[4:]
+        return tzyx, r, mag, parm
+
+    def iterInputAligned(self, w=0, t=0, slab=SAVE_SLAB_NZ):
+        """
+        use self.setRegionCutOut() prior to calling this function if the img is to be cutout
+
+        read the image in Z slabs of at most "slab" sections,
+        or section by section if only XY is transformed
+
+        yield (zout_start, zout_stop, zin_start, arr) to be given to transformAligned()
+        """
+        zslc = self.cropSlice[-3]
+        copy, remap, doZ, mapyx = self._alignMode(w, t)
+
+        if not doZ:
+            for z in range(zslc.start, zslc.stop):
+                a = self.img.getArr(t=t, z=z, w=w)
+                yield z, z+1, z, a.reshape((1,)+a.shape)
+
+        else:
+            shape = (self.img.nz, self.img.ny, self.img.nx)
+            tzyx, r, mag, parm = self._zParms(w, t)
+            for z0 in range(zslc.start, zslc.stop, slab):
+                z1 = min(z0 + slab, zslc.stop)
+                zs = imgResample.inputRangeZ(shape, (z0, z1), tzyx, r, mag)
+                yield z0, z1, zs[0], self.img.get3DArr(w=w, t=t, zs=list(range(*zs)))
+
+    def transformAligned(self, w, t, zout0, zout1, zin0, arr):
+        """
+        transform and crop a piece of image from iterInputAligned()
+
+        return list of (z, aligned_section)
+        """
+        zslc, yslc, xslc = self.cropSlice[-3:]
+        copy, remap, doZ, mapyx = self._alignMode(w, t)
+        parm = self.alignParms[t,w]
+
+        if remap and mapyx.ndim == 4:
+            mapyx = mapyx[zout0:zout1]
+
+        if copy:
+            pass
+        elif not doZ:
+            if remap:
+                arr = af.remapWithAffine(arr, mapyx, parm)
+            else:
+                arr = af.applyShift(arr[0], parm).reshape(arr.shape)
+        else:
+            shape = (self.img.nz, self.img.ny, self.img.nx)
+            tzyx, r, mag, parm = self._zParms(w, t)
+            arr = imgResample.trans3D_affineFused(arr, tzyx, r, mag, shape=shape, zin=zin0, zout=(zout0, zout1))
+            if remap:
+                arr = af.remapWithAffine(arr, mapyx, parm)
+
+        return [(zout0 + z - zslc.start, a[yslc,xslc]) for z, a in enumerate(arr)]
+
+    def iterSectionsAligned(self, w=0, t=0, slab=SAVE_SLAB_NZ):
+        """
+        use self.setRegionCutOut() prior to calling this function if the img is to be cutout
+
+        read, transform and crop the image in Z slabs of at most "slab" sections,
+        or section by section if only XY is transformed
+
+        yield (z, aligned_section)
+        """
+        for piece in self.iterInputAligned(w, t, slab):
+            for z, a in self.transformAligned(w, t, *piece):
+                yield z, a
+
+    def saveAlignedImage(self, fn=None, pipeline=PIPELINE):
         """
         save aligned image into a file
+        the image is read, transformed and written in Z slabs (see iterInputAligned)
+        pipeline: read, transform and write concurrently in separate threads
 
         return output file name
         """
@@ -927,33 +1131,95 @@ class Chromagnon(object):
                 fn = base + self.img_suffix + self.img_ext
             else:
                 fn = self.img.filename + self.img_suffix + self.img_ext
-        min0 = self.min_is_zero()
-                
+        # float32 images whose minimum is 0 are clipped at 0 after saving,
+        # using the minimum of the sections read on the way (see min_is_zero)
+        float32 = self.dtype == N.float32
+        mins = {}
+        negative = set()
+
         des = self.prepSaveFile(fn)
 
-        for t in range(self.img.nt):
-            for w in range(self.img.nw):
-                
+        def read():
+            for t in range(self.img.nt):
+                for w in range(self.img.nw):
+                    pieces = self.iterInputAligned(w=w, t=t)
+                    piece = next(pieces)
+                    for nextpiece in pieces:
+                        yield t, w, piece, False
+                        piece = nextpiece
+                    yield t, w, piece, True
+
+        def measure(t, w, piece):
+            zin0, arr = piece[2:]
+            known = mins.setdefault((t, w), {})
+            for z, m in enumerate(arr.reshape((arr.shape[0], -1)).min(1)):
+                known[zin0 + z] = m
+
+        def transform(item):
+            t, w, piece, last = item
+            if piece[0] == self.cropSlice[-3].start:
                 if w == self.refwave and self.nt == 1:
                     self.echo('Copying reference image, t: %i, w: %i' % (t, w))
-                    arr = self.img.get3DArr(w=w, t=t)
-                    arr = arr[self.cropSlice]
                 elif self.mapyx is None:
                     self.echo('Applying affine transformation to the target image, t: %i, w: %i' % (t, w))
-                    arr = self.get3DArrayAligned(w=w, t=t)
                 else:
                     self.echo('Remapping local alignment, t: %i, w: %i' % (t, w))
-                    arr = self.get3DArrayRemapped(w=w, t=t)
 
-                if min0:
-                    arr = N.where(arr > 0, arr, 0)
-                    
-                des.write3DArr(arr, w=w, t=t)
+            if float32:
+                measure(t, w, piece)
+            secs = self.transformAligned(w, t, *piece)
+            if float32:
+                negative.update([(t, w, z) for z, a in secs if not (a >= 0).all()])
+            if last:
                 self.progress()
-        des.close()
+            return t, w, secs
+
+        def write(item):
+            t, w, secs = item
+            for z, arr in secs:
+                des.writeArr(arr, w=w, t=t, z=z)
+
+        # bioformats readers and writers use the java VM, which is attached only to this thread
+        bio = imgio.bioformatsIO
+        if isinstance(self.img, bio.BioformatsReader) or isinstance(des, bio.BioformatsWriter):
+            pipeline = False
+
+        try:
+            if pipeline:
+                runPipeline(read(), transform, write)
+            else:
+                for item in read():
+                    write(transform(item))
+        finally:
+            des.close()
+
+        if negative and self.min_is_zero(mins):
+            self._clipSaved(fn, negative)
 
         return fn
 
+    def _clipSaved(self, fn, secs):
+        """
+        rewrite the saved file fn with negative values of the sections secs [(t, w, z)...] set to 0
+        """
+        dirname, base = os.path.split(fn)
+        tmp = os.path.join(dirname, '_' + base)
+        src = imgio.Reader(fn)
+        des = self.prepSaveFile(tmp)
+        try:
+            for t in range(src.nt):
+                for w in range(src.nw):
+                    for z in range(src.nz):
+                        arr = src.getArr(t=t, z=z, w=w)
+                        if (t, w, z) in secs:
+                            arr = N.where(arr > 0, arr, 0)
+                        des.writeArr(arr, w=w, t=t, z=z)
+        finally:
+            des.close()
+            src.close()
+        os.remove(fn)
+        os.rename(tmp, fn)
+
 
     def saveNonlinearImage(self, out=None, gridStep=10):
         """
@@ -981,3 +1247,90 @@ def hasSameWave(img):
     if len(waves) > len(set(waves)):
         return True
     
+
+
+## ---- processing of one file, shared by threads.ThreadWithExc and batch ----
+
+def checkParms(parms):
+    """
+    parms: parameters as for threads.ThreadWithExc
+    """
+    initGuess = parms[1]
+    if initGuess and not os.path.isfile(initGuess):
+        raise ValueError('The initial guess is not a valid Chromagnon file')
+
+def makeAligner(fn, parms, echofunc=None):
+    """
+    parms: parameters as for threads.ThreadWithExc
+
+    return Chromagnon of fn with the suffixes and the file format of parms
+    """
+    an = Chromagnon(fn)
+    an.setImgSuffix(parms[6])
+    an.setFileFormats(parms[8])
+    an.setParmSuffix(parms[5])
+    an.setEchofunc(echofunc)
+    return an
+
+def calibrate(an, parms, localChoice=LOCAL_CHOICE):
+    """
+    measure the alignment parameters of the reference image of "an" and save them
+    an:    Chromagnon of the reference image (see makeAligner())
+    parms: parameters as for threads.ThreadWithExc
+
+    return (the chromagnon file name, list of the time frames that failed)
+    """
+    initGuess, local, maxShift, zmag, min_pxls_yx = parms[1], parms[2], parms[3], parms[4], parms[9]
+
+    # the same stacks are read many times during the calibration
+    an.img.setCache()
+    an.setZmagSwitch(zmag)
+    an.setMaxShift(maxShift)
+
+    if initGuess:
+        an.loadParm(initGuess)
+        # mapyx should not be inherited...
+        an.mapyx = None
+
+    failed = []
+    if (an.nw > 1 and an.nt == 1):
+        an.findBestChannel()
+        an.echo('Calculating channel alignment...')
+
+        for t in range(an.nt):
+            try:
+                an.findAlignParamWave(t=t)
+            except af.AlignError: # in xcorr or else
+                an.echo('Calculation failed, skipping')
+                failed.append(t)
+                continue
+
+            if local in localChoice[1:]:
+                an.findNonLinear2D(t=t, npxls=min_pxls_yx)
+
+            if local in localChoice[2:]:
+                arr = an.findNonLinear3D(t=t, npxls=min_pxls_yx)
+                del arr
+
+    elif an.nt > 1:
+        an.echo('Calculating timelapse alignment...')
+        an.findBestChannel()
+        an.findBestTimeFrame(an.refwave)
+
+        an.findAlignParamTime(doWave=False)
+
+    return an.saveParm(), failed
+
+def applyParm(an, parmfn, parms):
+    """
+    apply the chromagnon file to the target image of "an" and save it
+    an:     Chromagnon of the target image (see makeAligner())
+    parmfn: chromagnon file, None to only crop
+    parms:  parameters as for threads.ThreadWithExc
+
+    return the output file name
+    """
+    if parmfn:
+        an.loadParm(parmfn)
+    an.setRegionCutOut(parms[0])
+    return an.saveAlignedImage()
@@ -1,10 +1,11 @@
 from __future__ import print_function
 import numpy as N
-import sys
+import sys, atexit, threading
+from multiprocessing.pool import ThreadPool
 
 try:
     from Priithon.all import U, F
-    from PriCommon import xcorr, imgResample, imgGeo,imgFilters
+    from PriCommon import xcorr, imgResample, imgGeo,imgFilters, sharedArr, kernelCache
 
     if sys.version_info.major == 2 and hasattr(sys, 'app'):
         from PriCommon import ppro
@@ -13,7 +14,7 @@ try:
         
 except ImportError:
     from Chromagnon.Priithon.all import U, F
-    from Chromagnon.PriCommon import xcorr, imgResample, imgGeo,imgFilters
+    from Chromagnon.PriCommon import xcorr, imgResample, imgGeo,imgFilters, sharedArr, kernelCache
     
     if sys.version_info.major == 2 and hasattr(sys, 'app'):
         from Chromagnon.PriCommon import ppro
@@ -37,6 +38,13 @@ MAX_SHIFT = 5 #2 #0.4 # um
 MIN_PXLS_YX = 60
 MIN_PXLS_YXS = [str(30 * (2**i)) for i in range(4)]
 MAX_SHIFT_LOCAL = 4#2 # pixel
+NTHREADS_LOCAL = ppro.NCPU # threads for tile cross correlation
+BATCH_LOCAL = True # cross correlate tiles as stacks
+BATCH_SIZE_LOCAL = 256 # number of tiles in a stack
+FOCUS_NSEC = 16 # number of sections Fourier transformed at once to find the focus
+FOCUS_MAXPXLS = 2**24 # and their maximum number of pixels
+FOCUS_DOWNSAMPLE = 1 # bin factor in YX to find the focus
+PREPARED_MAXSIZE = 20 # number of crop windows or tilings whose reference quadrants or tiles are kept
 
 QUADRATIC_AREA=['Right-Top', 'Left-Top', 'Left-Bottom', 'Right-Bottom']
 IF_FAILED=['auto', 'force_logpolar', 'force_simplex', 'terminate']
@@ -64,25 +72,20 @@ def measureSaturation(a3d, force_calc_neighbor=False, ret_fraction=False):
         return 0, 0
     
     if a3d.max() == ii.max:
-        maxdist = N.linalg.norm(a3d.shape)
         # obtain indices of saturated pixels
         ind = N.array(N.where(a3d == ii.max)).T
         spx = len(ind)
         # examine if the coordinates are next to each other
         if spx / a3d.size < 0.0001 or force_calc_neighbor:
-            dmat = spatial.distance.cdist(ind, ind, 'euclidean')
-            # a mask for the diagnal 0
-            eye = N.eye(dmat.shape[1], dmat.shape[0], dtype=dmat.dtype.type) * maxdist
-            dmat += eye
-            # obtain saturated pixels in clusters
+            # count pairs of saturated pixels in clusters with a k-d tree instead of the distance matrix
             next_pxl_cubic = N.linalg.norm((2**0.5)+1)
-            ind = N.where(dmat <= next_pxl_cubic)
-            npxl = len(ind[0]) // 2 # removing redundancy
+            tree = spatial.cKDTree(ind)
+            npxl = (int(tree.count_neighbors(tree, next_pxl_cubic)) - spx) // 2 # removing itself and redundancy
         else:
             npxl = spx
 
         if ret_fraction:
-            return spx / a3d.size, npxl / (dmat.size // 2)
+            return spx / a3d.size, npxl / ((spx * spx) // 2)
         else:
             return spx, npxl
     else:
@@ -135,8 +138,74 @@ def chopImg(a2d, center=None):
     return r1, r2, r3, r4
 
 
-def estimate2D(a2d, ref, center=None, phaseContrast=True, cqthre=CTHRE/10., max_shift_pxl=5):
+def prepareQuadrants(a2d, center, phaseContrast=True, npad=4):
     """
+    pre-treatments of the quadrants of a2d for estimate2D
+
+    return the spectrum of the quadrants stacked (n,y,x) if they have the same shape,
+    otherwise the list of the filtered quadrants
+    """
+    # in some reason, putting phaseContrastFilter here, not inside xcorr, gave better accuracy.
+    a1234p = [xcorr.paddAndApo(a, npad) for a in chopImg(a2d, center)]
+
+    # quadrants of the same shape are processed as a stack at once
+    # (the stacked Fourier transform requires even width)
+    if len(set([a.shape for a in a1234p])) == 1 and not a1234p[0].shape[-1] % 2:
+        a1234p = N.array(a1234p)
+        if phaseContrast:
+            a1234p = xcorr.phaseContrastFilter(a1234p, stack=True)
+        return xcorr.prepareStack(a1234p, phaseContrast=False)
+    elif phaseContrast:
+        a1234p = [xcorr.phaseContrastFilter(N.ascontiguousarray(a)) for a in a1234p]
+    return a1234p
+
+class PreparedRef(object):
+    """
+    reference image for iteration() and iterNonLinear()
+    the pre-treated quadrants and tiles are kept for each crop window,
+    so that they are re-used by the iterations and by the channels aligned to the same reference
+    the crop windows converge during the iterations, so that most of them are found in the cache (see stats())
+    """
+    def __init__(self, ref, maxsize=PREPARED_MAXSIZE):
+        self.ref = ref
+        self.cache = kernelCache.ArrayCache(maxsize)
+
+    def stats(self):
+        """
+        return dictionary of hits, misses, size, maxsize and nbytes of the cache
+        """
+        return self.cache.stats()
+
+    def quadrants(self, slc, center, phaseContrast=True):
+        """
+        slc:    crop window of the reference
+        center: center of the quadrants in the cropped image
+
+        return prepareQuadrants(self.ref[slc], center, phaseContrast) (read-only)
+        """
+        center = [int(c) for c in center]
+        key = ('quadrants', tuple([(s.start, s.stop) for s in slc]), tuple(center), bool(phaseContrast))
+        return self.cache.get(key, prepareQuadrants, self.ref[tuple(slc)], center, phaseContrast)
+
+    def tiles(self, slc, npxls, shiftOrigin=(0,0), batch=BATCH_LOCAL):
+        """
+        slc:    crop window of the reference, None for the whole image
+
+        return prepareTiles(self.ref[slc], npxls, shiftOrigin, batch) (read-only)
+        """
+        if slc is None:
+            ref = self.ref
+            bounds = None
+        else:
+            ref = self.ref[tuple(slc)]
+            bounds = tuple([(s.start, s.stop) for s in slc])
+        key = ('tiles', bounds, npxls, tuple(shiftOrigin), bool(batch))
+        return self.cache.get(key, prepareTiles, ref, npxls, shiftOrigin, batch)
+
+def estimate2D(a2d, ref, center=None, phaseContrast=True, cqthre=CTHRE/10., max_shift_pxl=5, aprep=None):
+    """
+    aprep: prepareQuadrants(ref, center, phaseContrast), if None, calculated here
+
     return [ty,tx,r,my,mx], offset, check
     """
     if center is None:
@@ -149,18 +218,22 @@ def estimate2D(a2d, ref, center=None, phaseContrast=True, cqthre=CTHRE/10., max_
     threshold = variance * threfact
 
     # separate quadrisection
-    a1234 = chopImg(ref, center)
+    if aprep is None:
+        aprep = prepareQuadrants(ref, center, phaseContrast)
     b1234 = chopImg(a2d, center)
-    shape = N.array(a1234[0].shape)
 
     # pre-treatments
-    # in some reason, putting phaseContrastFilter here, not inside xcorr, gave better accuracy.
     npad = 4
-    a1234p = [xcorr.paddAndApo(a, npad) for a in a1234]
     b1234p = [xcorr.paddAndApo(b, npad) for b in b1234]
 
-    if phaseContrast:
-        a1234p = [xcorr.phaseContrastFilter(N.ascontiguousarray(a)) for a in a1234p]
+    # the reference quadrants are stacked if they have the same shape
+    batch = isinstance(aprep, N.ndarray)
+    if batch:
+        b1234p = N.array(b1234p)
+
+    if phaseContrast and batch:
+        b1234p = xcorr.phaseContrastFilter(b1234p, stack=True)
+    elif phaseContrast:
         b1234p = [xcorr.phaseContrastFilter(N.ascontiguousarray(b)) for b in b1234p]
 
     center_of_mass="""
@@ -179,23 +252,27 @@ def estimate2D(a2d, ref, center=None, phaseContrast=True, cqthre=CTHRE/10., max_
     cm2 = N.array((ycm, xcm)) * 2"""
 
     # quadrisection cross correlation
-    ab = list(zip(a1234p, b1234p))
     try:
-        yxcs = [xcorr.Xcorr(a, b, phaseContrast=False, searchRad=max_shift_pxl) for a, b in ab]
+        if batch:
+            yxs, cs = xcorr.XcorrStack(None, b1234p, phaseContrast=False, searchRad=max_shift_pxl, af=aprep)
+        else:
+            yxcs = [xcorr.Xcorr(a, b, phaseContrast=False, searchRad=max_shift_pxl) for a, b in zip(aprep, b1234p)]
+            yxs = [yx for yx, c in yxcs]
+            cs = [c for yx, c in yxcs]
+            del yxcs
     except IndexError:
         return N.array((0,0,0,1,1), N.float32), [0,0], [(i, 0) for i in range(4)]
     except (ValueError, ZeroDivisionError):
         raise AlignError
-    yxs = [yx for yx, c in yxcs]
     
     # quality check
-    cqvs = [c.max() - c[c.shape[0]//4].std() for yx, c in yxcs]
+    cqvs = [c.max() - c[c.shape[0]//4].std() for c in cs]
     
     checks = [(idx, cq) for idx, cq in enumerate(cqvs) if cq < cqthre]
     #ab_vars = [(a.var(), b.var()) for a, b in ab]
     #checks += [(idx, threshold) for idx, ab_var in enumerate(ab_vars) if ab_var[0] < threshold or ab_var[1] < threshold]
     
-    del yxcs, ab#, c 
+    del cs
 
     # translation
     tyx = getTranslation(yxs)
@@ -302,7 +379,7 @@ def iteration(a2d, ref, maxErr=0.01, niter=10, phaseContrast=True, initguess=Non
     iteratively do quadratic cross correlation
 
     a2d: image to be aligned
-    ref: reference image
+    ref: reference image or PreparedRef
     maxErr: iteration is terminated when the calculated shift become less than this value (in pixel)
     niter: maximum number of iteration
     max_shift_pxl: number of pixels for you to allow the images to shift
@@ -310,6 +387,12 @@ def iteration(a2d, ref, maxErr=0.01, niter=10, phaseContrast=True, initguess=Non
 
     return [ty,tx,r,my,mx] if_failed is 'terminate' and failed, return None
     """
+    if isinstance(ref, PreparedRef):
+        pref = ref
+        ref = pref.ref
+    else:
+        pref = PreparedRef(ref)
+    
     shape = N.array(a2d.shape)
     center = shape // 2
 
@@ -351,7 +434,8 @@ def iteration(a2d, ref, maxErr=0.01, niter=10, phaseContrast=True, initguess=Non
         startYX = [maxcutY, maxcutX]
 
         if goodImg > 0:
-            ll, curroff, checks = estimate2D(b, c, center-startYX+offset, phaseContrast=phaseContrast, max_shift_pxl=max_shift_pxl, cqthre=cqthre)
+            aprep = pref.quadrants(slc, center-startYX+offset, phaseContrast)
+            ll, curroff, checks = estimate2D(b, c, center-startYX+offset, phaseContrast=phaseContrast, max_shift_pxl=max_shift_pxl, cqthre=cqthre, aprep=aprep)
 
             if len(checks) <= 1:
                 ret[:3] += ll[:3]
@@ -515,9 +599,17 @@ def simplex(a, b, phaseContrast=True, rough=True):
 
     # rough estimate
     if rough:
-        yxrm[2] = roughRotMag(b, a, yxrm, 2, 0.02, 20)
-        yxrm[3] = roughRotMag(b, a, yxrm, 3, 0.005, 20)
-        yxrm[4] = roughRotMag(b, a, yxrm, 4, 0.005, 20)
+        # images are sent to the worker processes only once
+        if ppro.NCPU > 1:
+            sa, sb = sharedArr.share(a), sharedArr.share(b)
+        else:
+            sa, sb = a, b
+        try:
+            yxrm[2] = roughRotMag(sb, sa, yxrm, 2, 0.02, 20)
+            yxrm[3] = roughRotMag(sb, sa, yxrm, 3, 0.005, 20)
+            yxrm[4] = roughRotMag(sb, sa, yxrm, 4, 0.005, 20)
+        finally:
+            sharedArr.release((sa, sb))
     
     yxrm = optimize.fmin(_compCost, yxrm, (b, a), disp=0)
 
@@ -627,7 +719,42 @@ def findBestRefZs(ref, sigma=1):
 
     return ids
 
-def findBestRefZs(ref, sigma=0.5):
+def _focusRing(shape):
+    ring = F.ringArr(shape, radius1=shape[-1]//10, radius2=shape[-2]//4, orig=(0,0), wrap=1)
+    return ring[:,:shape[-1]//2+1] > 0
+
+def focusScores(stack, downsample=FOCUS_DOWNSAMPLE):
+    """
+    stack:      3D array, each 2D section is scored
+    downsample: bin factor in YX to score on a smaller image
+
+    return sum of the amplitudes in the middle frequency ring for each section
+    """
+    if downsample > 1:
+        ny, nx = [s // downsample for s in stack.shape[-2:]]
+    else:
+        ny, nx = stack.shape[-2:]
+    ring = kernelCache.getKernel('focusRing', (ny, nx), (), _focusRing, (ny, nx))
+
+    # sections are transformed together by a multi-axis rfft
+    # blocks of the same number of sections limit memory and share one fft plan
+    nsec = max(1, min(FOCUS_NSEC, len(stack), FOCUS_MAXPXLS // (ny * nx)))
+    dtype = stack.dtype.type if stack.dtype.type in F.fftw.RTYPES else F.fftw.RTYPE
+    block = N.zeros((nsec, ny, nx), dtype)
+    ms = N.empty((len(stack),), N.float32)
+    for start in range(0, len(stack), nsec):
+        arr = stack[start:start+nsec]
+        n = len(arr)
+        if downsample > 1:
+            arr = arr[:,:ny*downsample,:nx*downsample].reshape((n, ny, downsample, nx, downsample)).mean(axis=(2,4))
+        block[:n] = arr
+        if n < nsec:
+            block[n:] = 0
+        af = F.fftw.rfft(block, axes=(-2,-1))
+        ms[start:start+n] = N.abs(af[:n,ring]).sum(axis=1)
+    return ms
+
+def findBestRefZs(ref, sigma=0.5, downsample=FOCUS_DOWNSAMPLE):
     """
     PSF spread along the Z axis is often tilted in the Y or X axis.
     Thus simple maximum intensity projection may lead to the wrong answer to estimate rotation and magnification.
@@ -639,27 +766,17 @@ def findBestRefZs(ref, sigma=0.5):
     Thus here we used sections containing higher frequency.
 
     ref: 3D array
+    downsample: bin factor in YX to score the sections (see focusScores)
     return z idx at the focus
     """
-    from Priithon.all import F
     nz = ref.shape[0]
     if ref.ndim == 2:
         return [0]
     elif nz <= 3:
         return list(range(nz))
 
-    # ring array
-    ring = F.ringArr(ref.shape[-2:], radius1=ref.shape[-1]//10, radius2=ref.shape[-2]//4, orig=(0,0), wrap=1)
-    
     # Due to the roll up after FFT, the edge sections in Z may contain different information among the channels. Thus these sections are left unused.
-    ms = N.zeros((nz -2,), N.float32)
-    for z in range(1, nz-1):
-        af = F.rfft(N.ascontiguousarray(ref[z]))
-        ar = af * ring[:,:af.shape[-1]]
-        ms[z-1] = N.sum(N.abs(ar))
-        
-        #ms[z-1] = N.prod(U.mmms(arr)[-2:]) # mean * std
-    del ring, af, ar
+    ms = focusScores(ref[1:nz-1], downsample)
 
     mi,ma,me,st = U.mmms(ms)
     thr = me + st * sigma
@@ -965,13 +1082,97 @@ def xcorNonLinear_old(arr, ref, npxls=60, threshold=None, phaseContrast=True, ct
     del arrs, refs#, c
     return yxs, regions, cs
 
-def xcorNonLinear(arr, ref, npxls=60, threshold=None, cthre=CTHRE, pxlshift_allow=MAX_SHIFT_LOCAL):
+def tileView(arr, slcs):
+    """
+    slcs: a tiling of arr made by chopShapeND
+
+    return read-only view of the tiles with shape (ny,nx,npxly,npxlx)
+    """
+    yslcs, xslcs = slcs
+    if not yslcs or not xslcs:
+        return N.zeros((len(yslcs), len(xslcs), 0, 0), arr.dtype)
+    # the tiles are consecutive windows of the same size
+    ny = yslcs[0].stop - yslcs[0].start
+    nx = xslcs[0].stop - xslcs[0].start
+    sy, sx = arr.strides
+    return N.lib.stride_tricks.as_strided(arr[yslcs[0].start:, xslcs[0].start:],
+                                          shape=(len(yslcs), len(xslcs), ny, nx),
+                                          strides=(sy * ny, sx * nx, sy, sx),
+                                          writeable=False)
+
+def tileSAT(arr):
+    """
+    return summed-area tables of arr and arr**2 for tileStats
+    """
+    # subtracting the mean keeps the precision of the variance
+    offset = arr.mean(dtype=N.float64)
+    d = N.subtract(arr, offset, dtype=N.float64)
+    return _sat(d), _sat(d * d), offset
+
+def tileStats(sats, slcs, win=0.5):
+    """
+    sats: tileSAT(arr)
+    slcs: a tiling of arr made by chopShapeND
+    win:  the center of the tiles as imgFilters.cutOutCenter(tile, win, interpolate=False)
+
+    return mean and variance of the center of the tiles (ny,nx)
+    """
+    sat1, sat2, offset = sats
+    yslcs, xslcs = slcs
+    los = []
+    his = []
+    npxls = 1.
+    for ss in (yslcs, xslcs):
+        if ss:
+            n = ss[0].stop - ss[0].start
+            nwin = int(n * win)
+            start = int(N.ceil(n / 2. - nwin / 2.))
+            npxls *= max(nwin, 1)
+        else:
+            nwin = start = 0
+        lo = N.array([sl.start + start for sl in ss], N.intp)
+        los.append(lo)
+        his.append(lo + nwin)
+
+    mean = _satRect(sat1, los[0], his[0], los[1], his[1]) / npxls
+    var = _satRect(sat2, los[0], his[0], los[1], his[1]) / npxls - mean * mean
+    return mean + offset, N.maximum(var, 0)
+
+def prepareTiles(ref, npxls=60, shiftOrigin=(0,0), batch=BATCH_LOCAL, sats=None):
+    """
+    reference side of a tiling of xcorNonLinear
+    sats: tileSAT(ref), if None, calculated here
+
+    return [variance of the center of the tiles (ny,nx), spectra of the tiles (ny*nx,y,x)]
+    spectra are calculated only for batch
+    """
+    slcs = chopShapeND(ref.shape, npxls, shiftOrigin=shiftOrigin)
+    if sats is None:
+        sats = tileSAT(ref)
+
+    # crop to throw away the tip object
+    rvar = tileStats(sats, slcs)[1]
+
+    # in stacks of the same size as the tile stacks to be cross correlated
+    tv = tileView(ref, slcs)
+    if batch and tv.size:
+        bs = tv.reshape((-1,) + tv.shape[2:])
+        spectra = N.concatenate([xcorr.prepareStack(bs[i:i+BATCH_SIZE_LOCAL]) for i in range(0, len(bs), BATCH_SIZE_LOCAL)])
+    else:
+        spectra = N.zeros((0,), N.complex64)
+    return [rvar, spectra]
+
+def xcorNonLinear(arr, ref, npxls=60, threshold=None, cthre=CTHRE, pxlshift_allow=MAX_SHIFT_LOCAL, nthreads=None, batch=BATCH_LOCAL, rtiles=None):
     """
     arr: image to be registered
     ref: iamge to find the alignment parameter
     nplxs: number of pixels to divide (y,x) or scaler
     threshold: threshold value to decide if the region is to be cross correlated
     pahseContrast: phase contrast filter in cross correlation
+    nthreads: number of threads to cross correlate tiles, if None, NTHREADS_LOCAL
+    batch: cross correlate stacks of BATCH_SIZE_LOCAL tiles at once
+    rtiles: [[prepareTiles(ref, npxls, (yi,xi), batch) for xi in range(2)] for yi in range(2)],
+            if None, calculated here
 
     return (yx_arr, px_analyzed_arr[bool,var,cqual], result_arr)
     """
@@ -986,49 +1187,140 @@ def xcorNonLinear(arr, ref, npxls=60, threshold=None, cthre=CTHRE, pxlshift_allo
     if threshold is None:
         variance = getVar(arr, ref)
         threshold = variance * threfact
-
-    taas = [[chopImage2D(arr, npxls, shiftOrigin=(yi,xi)) for xi in range(2)] for yi in range(2)]
-    tars = [[chopImage2D(ref, npxls, shiftOrigin=(yi,xi)) for xi in range(2)] for yi in range(2)]
-
-    nsplit0 = N.array((len(taas[0][0][0]), len(taas[0][0][0][0])))
-    nsplit1 = N.array((len(taas[1][1][0]), len(taas[1][1][0][0])))
+    if nthreads is None:
+        nthreads = NTHREADS_LOCAL
+
+    # tilings of arr and ref are the same, and the tiles are views
+    tslcss = [[chopShapeND(arr.shape, npxls, shiftOrigin=(yi,xi)) for xi in range(2)] for yi in range(2)]
+    if rtiles is None:
+        rsats = tileSAT(ref)
+        rtiles = [[prepareTiles(ref, npxls, (yi,xi), batch, rsats) for xi in range(2)] for yi in range(2)]
+    sats = tileSAT(arr)
+
+    nsplit0 = N.array([len(ss) for ss in tslcss[0][0]])
+    nsplit1 = N.array([len(ss) for ss in tslcss[1][1]])
     nsplit = tuple(nsplit0 + nsplit1)
     yxs = N.zeros((2,)+nsplit, N.float32)
     region = N.zeros((3,)+nsplit, N.float32)
     cs = N.zeros((2,2,) + arr.shape, N.float32)
-        
+
+    # collect tiles to be cross correlated
+    tiles = []
     for yi in range(2):
         for xi in range(2):
-            tslcs, arrs = taas[yi][xi]
-            rslcs, refs = tars[yi][xi]
-
-            for y, ay in enumerate(arrs):
-                for x, a in enumerate(ay):
-                    b = refs[y][x]
-
-                    # crop to throw away the tip object
-                    av = imgFilters.cutOutCenter(a, 0.5, interpolate=False)
-                    bv = imgFilters.cutOutCenter(b, 0.5, interpolate=False)
-
-                    var = getVar(av, bv)
-                    region[1,2*y+yi,2*x+xi] = var
-                    if var > threshold:
-                        yx, c = xcorr.Xcorr(a, b)
-                        #cs[[slice(i,i+1)]+tslcs[y][x]] += c
-                        cs[[slice(yi,yi+1),slice(xi,xi+1)]+tslcs[y][x]] += c
-                        csd = c[:c.shape[0]//4].std()
-                        cqual = (c.max() - csd) / (c.sum() / cfact)
-                        region[2,2*y+yi,2*x+xi] = cqual
-                        if cqual >= cthre: # 0.3 is the max
-                            if N.abs(yx).max() < pxlshift_allow:
-                                yxs[:,2*y+yi,2*x+xi] = yx
-                                region[0,2*y+yi,2*x+xi] = 1
-                        del c
+            yslcs, xslcs = tslcss[yi][xi]
+            rvar, spectra = rtiles[yi][xi]
+            arrs = tileView(arr, tslcss[yi][xi])
+            refs = tileView(ref, tslcss[yi][xi])
+
+            # variance of the center of the tiles to throw away the tip object
+            var = (tileStats(sats, tslcss[yi][xi])[1] + rvar) / 2.
+            region[1,yi:yi+2*len(yslcs):2,xi:xi+2*len(xslcs):2] = var
+
+            for y, x in zip(*N.nonzero(var > threshold)):
+                bf = spectra[y * len(xslcs) + x] if batch else None
+                tiles.append((yi, xi, y, x, [yslcs[y], xslcs[x]], arrs[y,x], refs[y,x], bf))
+
+    if batch:
+        jobs = [tiles[i:i+BATCH_SIZE_LOCAL] for i in range(0, len(tiles), BATCH_SIZE_LOCAL)]
+        func = _xcorTileStack
+    else:
+        jobs = tiles
+        func = _xcorTile
 
+    # tiles are views of arr and ref, so threads use them without copying
+    if nthreads > 1 and len(jobs) > 1 and not (F.fftw.SCIK or F.fftw.REIK):
+        chunk = max(1, len(jobs) // (nthreads * 4))
+        results = getTilePool(nthreads).imap(func, jobs, chunk)
+    else:
+        results = (func(job) for job in jobs)
 
-    del arrs, refs#, c
+    if batch:
+        yxcs = (yxc for result in results for yxc in result)
+    else:
+        yxcs = results
+
+    for (yi, xi, y, x, slc, a, b, bf), (yx, c) in zip(tiles, yxcs):
+        cs[tuple([yi, xi] + list(slc))] += c
+        csd = c[:c.shape[0]//4].std()
+        cqual = (c.max() - csd) / (c.sum() / cfact)
+        region[2,2*y+yi,2*x+xi] = cqual
+        if cqual >= cthre: # 0.3 is the max
+            if N.abs(yx).max() < pxlshift_allow:
+                yxs[:,2*y+yi,2*x+xi] = yx
+                region[0,2*y+yi,2*x+xi] = 1
+        del c
+
+    del tiles
     return yxs, region, cs
 
+def _xcorTile(tile):
+    """
+    tile: (yi, xi, y, x, slc, a, b, bf)
+
+    return (yx, c)
+    """
+    return xcorr.Xcorr(tile[5], tile[6])
+
+def _xcorTileStack(tiles):
+    """
+    tiles: list of tiles of the same shape, with the reference spectra bf
+
+    return list of (yx, c)
+    """
+    a = N.array([tile[5] for tile in tiles])
+    bf = N.array([tile[7] for tile in tiles])
+    yxs, cs = xcorr.XcorrStack(a, None, bf=bf)
+    return list(zip(yxs, cs))
+
+_TILE_POOL = None
+_TILE_POOL_N = 0
+
+def getTilePool(nthreads=None):
+    """
+    return a thread pool kept for tile cross correlation
+    FFT releases GIL, so threads run in parallel
+    each thread runs fftw in a single thread, so that the cpus are not oversubscribed
+    """
+    global _TILE_POOL, _TILE_POOL_N
+    if nthreads is None:
+        nthreads = NTHREADS_LOCAL
+    if _TILE_POOL is None or _TILE_POOL_N != nthreads:
+        closeTilePool()
+        _TILE_POOL = ThreadPool(nthreads, initializer=F.fftw.setMaxThreads, initargs=(1,))
+        _TILE_POOL_N = nthreads
+    return _TILE_POOL
+
+def warmupTilePool(shapes, nthreads=None):
+    """
+    make fft plans for tiles of shapes in every thread of the tile pool
+    plans are kept per thread, so that plans made by the caller are not used by the pool
+    """
+    if nthreads is None:
+        nthreads = NTHREADS_LOCAL
+    if nthreads <= 1 or not hasattr(threading, 'Barrier'): # python 2
+        xcorr.warmupFFT(shapes)
+        return
+    # threads wait for each other, so that every thread takes one task
+    barrier = threading.Barrier(nthreads)
+    getTilePool(nthreads).map(_warmupTile, [(shapes, barrier)] * nthreads, 1)
+
+def _warmupTile(args):
+    shapes, barrier = args
+    try:
+        xcorr.warmupFFT(shapes)
+    finally:
+        barrier.wait()
+
+def closeTilePool():
+    global _TILE_POOL
+    if _TILE_POOL is not None:
+        _TILE_POOL.close()
+        _TILE_POOL.join()
+        _TILE_POOL = None
+
+atexit.register(closeTilePool)
+
 def xcorNonLinear2(arr, ref, npxls=32, threshold=None, phaseContrast=True, cthre=CTHRE, pxlshift_allow=MAX_SHIFT_LOCAL):
     """
     arr: image to be registered
@@ -1167,8 +1459,11 @@ def resizeLocal3D(arr, targetShape):
             canvas[zt] = resizeLocal2D(arr[z], targetShape[1:])
         return canvas
 
-def paddYX(yx, npxl, shape, maxcutY=0, maxcutX=0):
+def paddYX(yx, npxl, shape, maxcutY=0, maxcutX=0, out=None):
     """
+    out: preallocated float32 array of (2,)+shape to be filled
+
+    return yx zoomed to the shape
     """
     npxl //= 2
     
@@ -1210,36 +1505,19 @@ def paddYX(yx, npxl, shape, maxcutY=0, maxcutX=0):
     start2 = [int(s) for s in start2]
 
     #print start, stop
-    zeros = N.zeros((2,)+tuple(shape), N.float32)
-    zeros[:,start2[0]:start2[0]+yx.shape[1],start2[1]:start2[1]+yx.shape[2]] += yx
-
-    for d in range(2):
-        # left
-        for x in range(int(start2[1])):
-            zeros[d,:start2[0],x] += yx[d,0,0]
-            zeros[d,start2[0]:start2[0]+yx.shape[1],x] += yx[d,:,0]
-            zeros[d,start2[0]+yx.shape[1]:,x] += yx[d,-1,0]
-        # right
-        for x in range(int(start2[1]+yx.shape[2]),int(zeros.shape[-1])):
-            zeros[d,:start2[0],x] += yx[d,0,-1]
-            zeros[d,start2[0]:start2[0]+yx.shape[1],x] += yx[d,:,-1]
-            zeros[d,start2[0]+yx.shape[1]:,x] += yx[d,-1,-1]
-        # bottom
-        for y in range(int(start2[0])):
-            zeros[d,y,:start2[1]] += yx[d,0,0]
-            zeros[d,y,:start2[1]] /= 2.
-            zeros[d,y,start2[1]:start2[1]+yx.shape[2]] += yx[d,0,:]
-            zeros[d,y,start2[1]+yx.shape[2]:] += yx[d,0,-1]
-            zeros[d,y,start2[1]+yx.shape[2]:] /= 2.
-        # top
-        for y in range(int(start2[0]+yx.shape[1]),int(zeros.shape[-2])):
-            zeros[d,y,:start2[1]] += yx[d,-1,0]
-            zeros[d,y,:start2[1]] /= 2.
-            zeros[d,y,start2[1]:start2[1]+yx.shape[2]] += yx[d,-1,:]
-            zeros[d,y,start2[1]+yx.shape[2]:] += yx[d,-1,-1]
-            zeros[d,y,start2[1]+yx.shape[2]:] /= 2.
-
-    return zeros
+    # the margins are filled with the values at the edges (equivalent to N.pad(mode='edge'))
+    # corners take the corner values, same as averaging the extensions from the two sides
+    if out is None:
+        out = N.empty((2,)+tuple(shape), N.float32)
+    y0, x0 = start2
+    y1, x1 = y0 + yx.shape[1], x0 + yx.shape[2]
+    out[:,y0:y1,x0:x1] = yx
+    out[:,y0:y1,:x0] = out[:,y0:y1,x0:x0+1]
+    out[:,y0:y1,x1:] = out[:,y0:y1,x1-1:x1]
+    out[:,:y0] = out[:,y0:y0+1]
+    out[:,y1:] = out[:,y1-1:y1]
+
+    return out
 
 ## ---- remove outside of significant signals -----
 
@@ -1356,7 +1634,7 @@ def iterNonLinear_old(arr, ref, npxl=MIN_PXLS_YX, affine=None, initGuess=None, t
 def iterNonLinear(arr, ref, npxl=MIN_PXLS_YX, affine=None, initGuess=None, threshold=None, phaseContrast=True, niter=5, maxErr=0.01, cthre=CTHRE, echofunc=None, debug=False):
     """
     arr: image to be registered
-    ref: image to find the alignment parameter
+    ref: image to find the alignment parameter or PreparedRef
     nplx: number of pixels to divide, a scaler
     initGuess: initGuess of the nonlinear parameter
     affine: affine transform parameter as [tz,ty,yx,r,mz,my,mx]
@@ -1367,6 +1645,12 @@ def iterNonLinear(arr, ref, npxl=MIN_PXLS_YX, affine=None, initGuess=None, thres
 
     return (yx_arr, px_analyzed_arr, resulting_arr)
     """
+    if isinstance(ref, PreparedRef):
+        pref = ref
+        ref = pref.ref
+    else:
+        pref = PreparedRef(ref)
+
     rrs=[] # quality measure
     yxs=[] # list of shifts
     #css=[]
@@ -1383,6 +1667,7 @@ def iterNonLinear(arr, ref, npxl=MIN_PXLS_YX, affine=None, initGuess=None, thres
     #nsplit = (len(tslcs), len(tslcs[0]))
 
     maxcutY = maxcutX = 0
+    slc = None
     if affine is not None:
         tyx = -affine[1:3] # minus to match cv coordinate
         r = affine[3]
@@ -1436,7 +1721,9 @@ def iterNonLinear(arr, ref, npxl=MIN_PXLS_YX, affine=None, initGuess=None, thres
             #else:
             threfact = 0.1
             threshold = variance * threfact#0.1
-        yx, region, cs = xcorNonLinear(arr2, ref2, npxl, threshold, cthre)#phaseContrast, cthre)
+        # the reference tiles are the same in all iterations
+        rtiles = [[pref.tiles(slc, npxl, (yi,xi)) for xi in range(2)] for yi in range(2)]
+        yx, region, cs = xcorNonLinear(arr2, ref2, npxl, threshold, cthre, rtiles=rtiles)#phaseContrast, cthre)
         # some window sizes simply increases errors during iteration...
         # this is not easy to predict
         # for example, using arr.shape = (1008, 1012)
@@ -1533,8 +1820,12 @@ def makeWin(shape, minwin):
     
 def iterWindowNonLinear(arr, ref, minwin=MIN_PXLS_YX, affine=None, initGuess=None, threshold=None, phaseContrast=True, niter=5, maxErr=0.01, cthre=CTHRE, echofunc=None):
     """
+    ref: reference image or PreparedRef
+
     return (yx_arr, px_analyzed_arr, result_arr)
     """
+    if not isinstance(ref, PreparedRef):
+        ref = PreparedRef(ref)
     shape = N.array(arr.shape)
 
     maxcutY = maxcutX = 0
@@ -1560,6 +1851,7 @@ def iterWindowNonLinear(arr, ref, minwin=MIN_PXLS_YX, affine=None, initGuess=Non
     #print(wins)
     if not wins:
         return N.zeros((2,)+arr.shape, N.float32), None, None
+    warmupTilePool([(win, win) for win in wins])
         
     currentGuess = initGuess
     ## After v0.5.7, window size became difficult to predict at this point
@@ -1722,6 +2014,39 @@ def _xcorNonLinear(abyx, threshold, phaseContrast):
         yx = 0
     return c, var, cqual, yx, y, x
 
+def _sat(a):
+    """
+    return summed-area table (float64) of 2D array a with a leading row and column of zeros
+    """
+    sat = N.zeros((a.shape[0]+1, a.shape[1]+1), N.float64)
+    # cumulative sums in place avoid temporary arrays
+    N.cumsum(a, 1, out=sat[1:,1:])
+    N.cumsum(sat[1:,1:], 0, out=sat[1:,1:])
+    return sat
+
+def _satRect(sat, ylo, yhi, xlo, xhi):
+    """
+    return sum of a[ylo[y]:yhi[y], xlo[x]:xhi[x]] for every (y, x) from the summed-area table of a
+    """
+    return (sat[N.ix_(yhi, xhi)] - sat[N.ix_(ylo, xhi)]
+            - sat[N.ix_(yhi, xlo)] + sat[N.ix_(ylo, xlo)])
+
+def _rectSum(a, ylo, yhi, xlo, xhi):
+    """
+    return sum of a[ylo[y]:yhi[y], xlo[x]:xhi[x]] for every (y, x) by a summed-area table
+    """
+    return _satRect(_sat(a), ylo, yhi, xlo, xhi)
+
+def _holeWindow(n, half):
+    """
+    return (start, stop) of the window for each cell along an axis of size n
+    the windows at the edges are one-sided
+    """
+    idx = N.arange(n)
+    lo = N.where(idx < half, idx, idx - half)
+    hi = N.where((idx >= half) & (idx > (n - half)), idx + 1, N.minimum(idx + half + 1, n))
+    return lo, hi
+
 def fillHoles(yx, region, win=3):
     """
     fills empty regions for local alignment
@@ -1731,37 +2056,25 @@ def fillHoles(yx, region, win=3):
     if region.max() == 0:
         return yx
     
+    ny, nx = region.shape
     while region.min() == 0:
-        region2 = N.copy(region)
         half = win//2
-        ny, nx = region.shape
+        ylo, yhi = _holeWindow(ny, half)
+        xlo, xhi = _holeWindow(nx, half)
+
+        # number of regions with values in the window of each empty region
+        full = region != 0
+        count = _rectSum(full, ylo, yhi, xlo, xhi)
+        fill = ~full & (count > 0)
+
+        # replace with mean in the window
         yx2 = N.copy(yx)
+        for i in range(2):
+            total = _rectSum(N.where(full, yx[i], 0), ylo, yhi, xlo, xhi)
+            yx2[i][fill] = total[fill] / count[fill] / (2 ** ((win-3)/2))
 
-        for y, yr in enumerate(region):
-            for x, xr in enumerate(yr):
-                yh0 = xh0 = half
-                yh1 = xh1 = half + 1
-                # if this region is empty...
-                if not xr:
-                    # edge treatment
-                    if y < half:
-                        yh0 = 0
-                    elif y > (ny - half):
-                        yh1 = 1
-
-                    if x < half:
-                        xh0 = 0
-                    elif x > (nx - half):
-                        xh1 = 1
-
-                    # indices of regions with values
-                    yi, xi = N.nonzero(region[y-yh0:y+yh1,x-xh0:x+xh1])
-                    if len(yi):
-                        # replace with mean in the window
-                        yx2[0,y,x] = N.mean(yx[0,y-yh0:y+yh1,x-xh0:x+xh1][yi,xi]) / (2 ** ((win-3)/2))
-                        yx2[1,y,x] = N.mean(yx[1,y-yh0:y+yh1,x-xh0:x+xh1][yi,xi]) / (2 ** ((win-3)/2))
-                        region2[y,x] = 1
-        region = region2
+        region = N.copy(region)
+        region[fill] = 1
         yx = yx2
         win += 2
     return yx
@@ -0,0 +1,337 @@
+### batch.py ##########################################################################
+# Headless batch processing for the command line
+#
+# Reference calibrations and targets are run as independent jobs in worker processes.
+# The number of concurrent jobs is limited by the number of processes and
+# by the memory estimated from the image dimensions.
+# Workers are started by "spawn" since the Java VM for Bio-Formats,
+# which may already run in this process, cannot be used after fork.
+##################################################################################
+
+from __future__ import print_function
+import os, time, json, traceback
+import multiprocessing as mp
+from six.moves import queue
+import numpy as N
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from PriCommon import ppro26 as ppro
+    from Priithon import fftmanager
+    import imgio
+except ImportError:
+    from Chromagnon.PriCommon import ppro26 as ppro
+    from Chromagnon.Priithon import fftmanager
+    from Chromagnon import imgio
+
+try:
+    from . import alignfuncs, chromformat, aligner
+except ValueError:
+    from Chromagnon import alignfuncs, chromformat, aligner
+except ImportError:
+    import alignfuncs, chromformat, aligner
+
+# memory used by a job is estimated as multiples of a float32 3D stack
+MEMFACTOR_REF = 3 # per channel (at least 2) for calibration
+MEMFACTOR_TARGET = 3 # for saving a target
+# memory used by a worker process without images (python, numpy, fft plans...)
+MEM_BASE = 2**28
+# fraction of the available memory used for the jobs
+MEM_USABLE = 0.8
+
+REPORT_NAME = 'Chromagnon_batch.json'
+LOG_NAME = 'Chromagnon.log'
+
+# start method of the worker processes
+START_METHOD = 'spawn'
+
+def estimateMemory(fn, what='ref'):
+    """
+    what: 'ref' or 'target'
+
+    return estimated memory (bytes) to process the image file
+    """
+    h = imgio.Reader(fn)
+    try:
+        stack = h.nz * h.ny * h.nx * 4
+        if what == 'ref':
+            nbytes = stack * max(h.nw, 2) * MEMFACTOR_REF
+            # stacks kept by the reader during the calibration
+            nbytes += min(h.nz * h.ny * h.nx * N.dtype(h.dtype).itemsize * h.nw * h.nt, imgio.stackCache.MAXBYTES)
+        else:
+            nbytes = stack * MEMFACTOR_TARGET
+    finally:
+        h.close()
+    return int(nbytes + MEM_BASE)
+
+def availableMemory():
+    """
+    return memory (bytes) available for new processes, or None if unknown
+    """
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        with open('/proc/meminfo') as h:
+            for line in h:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def makeJobs(fns, targets):
+    """
+    fns:     reference images or chromagnon files
+    targets: target images
+             as in threads.ThreadWithExc, targets[i] uses fns[i],
+             and the remaining targets use the last reference
+
+    return list of job dictionaries
+    """
+    jobs = []
+    refjobs = []
+    for fn in fns:
+        job = {'id': len(jobs), 'kind': 'calibration', 'file': fn, 'depends': None}
+        if chromformat.is_chromagnon(fn):
+            job['status'] = 'done'
+            job['output'] = fn
+        jobs.append(job)
+        refjobs.append(job['id'])
+
+    for index, target in enumerate(targets):
+        if refjobs:
+            dep = refjobs[min(index, len(refjobs)-1)]
+        else:
+            dep = None
+        jobs.append({'id': len(jobs), 'kind': 'target', 'file': target, 'depends': dep})
+    return jobs
+
+def calibrate(fn, parms, echofunc=None):
+    """
+    measure the alignment parameters of the reference image fn
+
+    return the chromagnon file name
+    """
+    an = aligner.makeAligner(fn, parms, echofunc)
+    try:
+        return aligner.calibrate(an, parms)[0]
+    finally:
+        an.close()
+
+def applyParm(target, parmfn, parms, echofunc=None):
+    """
+    apply the chromagnon file parmfn to the target image
+
+    return the output file name
+    """
+    an = aligner.makeAligner(target, parms, echofunc)
+    try:
+        return aligner.applyParm(an, parmfn, parms)
+    finally:
+        an.close()
+
+def getContext():
+    """
+    return multiprocessing context of START_METHOD
+    """
+    if hasattr(mp, 'get_context'):
+        return mp.get_context(START_METHOD)
+    return mp # python2 only forks
+
+def _log(logfn, msg, prefix=''):
+    """
+    append msg to the log file shared by the jobs
+    """
+    if logfn:
+        with open(logfn, 'a') as h:
+            h.write('%s%s\n' % (prefix, msg))
+
+def _runJob(job, parmfn, parms, nthreads, results, logfn=None):
+    """
+    run a job in a worker process and put (id, status, output, error) into results
+    """
+    # the functions read these at call time
+    ppro.NCPU = nthreads
+    aligner.NCPU = nthreads
+    alignfuncs.NTHREADS_LOCAL = nthreads
+    alignfuncs.F.fftw.setMaxThreads(nthreads)
+    ppro.initPool()
+
+    # as in threads.ThreadWithExc
+    fftmanager.SCIK = False
+    fftmanager.REIK = False
+    fftmanager.loadWisdom()
+
+    name = os.path.basename(job['file'])
+    def echo(msg, skip_notify=False):
+        _log(logfn, msg, prefix='    ')
+        print('[%s] %s' % (name, msg))
+
+    tstf = time.strftime('%Y %b %d %H:%M:%S', time.localtime())
+    try:
+        if job['kind'] == 'calibration':
+            _log(logfn, '\n**Measuring shifts in %s at %s' % (name, tstf))
+            out = calibrate(job['file'], parms, echo)
+        else:
+            if parmfn:
+                _log(logfn, '\n**Applying to %s using %s at %s' % (name, os.path.basename(parmfn), tstf))
+            else:
+                _log(logfn, '\n**Applying to %s at %s' % (name, tstf))
+            out = applyParm(job['file'], parmfn, parms, echo)
+    except:
+        results.put((job['id'], 'failed', None, traceback.format_exc()))
+    else:
+        results.put((job['id'], 'done', out, None))
+    finally:
+        imgio.uninit_javabridge()
+        try:
+            fftmanager.saveWisdom()
+        except (IOError, OSError):
+            pass
+
+def _collect(jobs, results, timeout):
+    """
+    update jobs with the results sent from the worker processes
+    """
+    finished = []
+    try:
+        finished.append(results.get(timeout=timeout))
+        while True:
+            finished.append(results.get_nowait())
+    except queue.Empty:
+        pass
+
+    for jid, status, out, err in finished:
+        job = jobs[jid]
+        job['status'] = status
+        job['output'] = out
+        job['error'] = err
+        print('%s %s %s' % (status, job['kind'], job['file']))
+
+def runBatch(fns, targets, parms, njobs=None, maxMemory=None, report=None, interval=0.2, log=True):
+    """
+    process reference and target files in parallel worker processes
+
+    fns:       reference images or chromagnon files
+    targets:   target images (see makeJobs)
+    parms:     parameters as for threads.ThreadWithExc
+    njobs:     maximum number of concurrent jobs, if None, uses all available CPU
+    maxMemory: memory (bytes) shared by the jobs, if None, a fraction of the available memory
+    report:    file name to save the job report (json), if None, REPORT_NAME in the directory of the first file
+    log:       if True, the jobs write LOG_NAME in the directory of the first file
+
+    return report dictionary
+    """
+    aligner.checkParms(parms)
+
+    if not njobs:
+        njobs = ppro.NCPU
+    nthreads = max(1, ppro.NCPU // njobs)
+
+    if maxMemory is None:
+        avail = availableMemory()
+        if avail is not None:
+            maxMemory = int(avail * MEM_USABLE)
+
+    jobs = makeJobs(fns, targets)
+    for job in jobs:
+        job.setdefault('status', 'pending')
+        job.setdefault('output', None)
+        job.update({'error': None, 'memory_estimate': None, 'start': None, 'end': None, 'seconds': None, 'pid': None})
+
+    rep = {'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'njobs': njobs,
+           'nthreads_per_job': nthreads,
+           'memory_budget': maxMemory,
+           'jobs': jobs}
+
+    logfn = None
+    if jobs:
+        dirname = os.path.dirname(os.path.abspath(jobs[0]['file']))
+        if report is None:
+            report = os.path.join(dirname, REPORT_NAME)
+        logfn = os.path.join(dirname, LOG_NAME) if log else None
+
+    ctx = getContext()
+    results = ctx.Queue()
+    running = {}
+    used = 0
+
+    try:
+        while True:
+            # start jobs whose reference is ready, as long as processes and memory allow
+            for job in jobs:
+                if job['status'] != 'pending':
+                    continue
+                dep = jobs[job['depends']] if job['depends'] is not None else None
+                if dep is not None and dep['status'] in ('failed', 'skipped'):
+                    job['status'] = 'skipped'
+                    job['error'] = 'reference %s was not calibrated' % dep['file']
+                    continue
+                elif dep is not None and dep['status'] != 'done':
+                    continue
+                if len(running) >= njobs:
+                    break
+
+                if job['memory_estimate'] is None:
+                    try:
+                        job['memory_estimate'] = estimateMemory(job['file'], 'ref' if job['kind'] == 'calibration' else 'target')
+                    except Exception as e:
+                        job['status'] = 'failed'
+                        job['error'] = repr(e)
+                        continue
+                # a job larger than the budget is run alone
+                if maxMemory is not None and running and used + job['memory_estimate'] > maxMemory:
+                    continue
+
+                parmfn = dep['output'] if dep is not None else None
+                proc = ctx.Process(target=_runJob, args=(job, parmfn, parms, nthreads, results, logfn))
+                proc.start()
+                running[job['id']] = proc
+                used += job['memory_estimate']
+                job['status'] = 'running'
+                job['pid'] = proc.pid
+                job['start'] = time.time()
+                print('started %s %s' % (job['kind'], job['file']))
+
+            if not running:
+                break
+
+            # collect finished jobs
+            _collect(jobs, results, interval)
+
+            # processes killed (eg. out of memory) do not send the result
+            for jid, proc in list(running.items()):
+                if jobs[jid]['status'] == 'running' and proc.is_alive():
+                    continue
+                proc.join()
+                job = jobs[jid]
+                if job['status'] == 'running': # the result may still be in the pipe
+                    _collect(jobs, results, 1)
+                if job['status'] == 'running':
+                    job['status'] = 'failed'
+                    job['error'] = 'worker process exited with code %s' % proc.exitcode
+                job['end'] = time.time()
+                job['seconds'] = job['end'] - job['start']
+                used -= job['memory_estimate']
+                del running[jid]
+    finally:
+        for proc in running.values():
+            proc.terminate()
+            proc.join()
+
+        rep['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        for status in ('done', 'failed', 'skipped'):
+            rep[status] = len([job for job in jobs if job['status'] == status])
+        if report:
+            with open(report, 'w') as h:
+                json.dump(rep, h, indent=1)
+
+    return rep
@@ -45,23 +45,23 @@ init_java_home()
 
 import wx
 try:
-    from PriCommon import guiFuncs as G, commonfuncs as C, listbox
+    from PriCommon import guiFuncs as G, commonfuncs as C, listbox, ppro26 as ppro
     from ndviewer import main as aui
     from Priithon.all import U, N, Mrc
     import imgio
 except (ValueError, ImportError):
-    from Chromagnon.PriCommon import guiFuncs as G, commonfuncs as C, listbox
+    from Chromagnon.PriCommon import guiFuncs as G, commonfuncs as C, listbox, ppro26 as ppro
     from Chromagnon.ndviewer import main as aui
     from Chromagnon.Priithon.all import U, N, Mrc
     from Chromagnon import imgio
 
 ## for py2exe, here the relative import was impossible to run this script as __main__
 try:
-    from .Chromagnon import aligner, cutoutAlign, alignfuncs as af, threads, chromeditor, chromformat, flatfielder, version
+    from .Chromagnon import aligner, cutoutAlign, alignfuncs as af, threads, chromeditor, chromformat, flatfielder, version, batch
 except (ValueError, ImportError):
-    from Chromagnon import aligner, cutoutAlign, alignfuncs as af, threads, chromeditor, chromformat, flatfielder, version
+    from Chromagnon import aligner, cutoutAlign, alignfuncs as af, threads, chromeditor, chromformat, flatfielder, version, batch
 except ImportError:
-    import aligner, cutoutAlign, alignfuncs as af, threads, chromeditor, chromformat, flatfielder, version
+    import aligner, cutoutAlign, alignfuncs as af, threads, chromeditor, chromformat, flatfielder, version, batch
 
             
 #----------- Global constants
@@ -82,7 +82,7 @@ else:
 
 FILTER = '*.dv*'
 
-LOCAL_CHOICE = ['None', 'Projection']#, 'Section-wise']
+LOCAL_CHOICE = aligner.LOCAL_CHOICE
 
 #----------- Execute this function to start
 def _main(sysarg=None, title="Chromagnon v%s" % version.version):
@@ -532,6 +532,8 @@ if __name__ == '__main__':
     multiprocessing.freeze_support()
 
     if len(sys.argv) == 1:
+        # the process pool is forked before the GUI and the worker threads start
+        ppro.initPool()
         main()
 
     else:
@@ -563,8 +565,18 @@ if __name__ == '__main__':
                      help='suffix for the target files (default=%s)' % aligner.IMG_SUFFIX)
         p.add_argument('--img_format', '-E', default=aligner.WRITABLE_FORMATS[0], choices=aligner.WRITABLE_FORMATS,
                      help='file extension for the target files, choose from %s (default=%s)' % (aligner.WRITABLE_FORMATS, aligner.WRITABLE_FORMATS[0]))
+        p.add_argument('--jobs', '-j', default=1, type=int,
+                     help='number of files processed in parallel, 0 uses all CPUs (default=1)')
+        p.add_argument('--maxMemory', '-M', default=None, type=float,
+                     help='GB of memory shared by the parallel jobs (default=%i%% of the available memory)' % (batch.MEM_USABLE * 100))
+        p.add_argument('--report', '-r', default=None,
+                     help='json file to save the report of the parallel jobs (default=%s next to the first file)' % batch.REPORT_NAME)
         options = p.parse_args()
 
+        if options.jobs == 1:
+            # before the java VM and the worker threads start
+            ppro.initPool()
+
         ref = glob.glob(os.path.expandvars(os.path.expanduser(options.reference)))
         
         fns = []
@@ -588,7 +600,13 @@ if __name__ == '__main__':
                 int(options.localMinWindow)]
                      # min_pxls_yx]
 
-        th = threads.ThreadWithExc(None, LOCAL_CHOICE, ref, fns, parms)
-        th.start()
+        if options.jobs == 1:
+            th = threads.ThreadWithExc(None, LOCAL_CHOICE, ref, fns, parms)
+            th.start()
+        else:
+            maxMemory = options.maxMemory
+            if maxMemory:
+                maxMemory = int(maxMemory * 2**30)
+            batch.runBatch(ref, fns, parms, njobs=options.jobs, maxMemory=maxMemory, report=options.report)
         #bioformatsIO.uninit_javabridge()
         imgio.uninit_javabridge()
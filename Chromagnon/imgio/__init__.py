@@ -7,12 +7,12 @@ import six
 import numpy as N
 
 try:
-    from . import generalIO, mrcIO, imgSeqIO, multitifIO, bioformatsIO
+    from . import generalIO, mrcIO, imgSeqIO, multitifIO, bioformatsIO, stackCache
 except ImportError:
     try:
-        import generalIO, mrcIO, imgSeqIO, multitifIO, bioformatsIO
+        import generalIO, mrcIO, imgSeqIO, multitifIO, bioformatsIO, stackCache
     except ImportError:
-        from imgio import generalIO, mrcIO, imgSeqIO, multitifIO, bioformatsIO
+        from imgio import generalIO, mrcIO, imgSeqIO, multitifIO, bioformatsIO, stackCache
 
 from .bioformatsIO import uninit_javabridge
 
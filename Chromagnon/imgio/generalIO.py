@@ -1,11 +1,17 @@
 import os, re
 import numpy as N
+try:
+    from . import stackCache
+except (ValueError, ImportError):
+    import stackCache
 
 IMGSEQ = ['WTZ', 'TZW', 'TWZ', 'WZT']
 
 WAVE_START = 400
 WAVE_END = 700
 
+TIMEBLOCK = True # interleaved channels (imgSequence 1) are read for all channels of a time point at once
+
 READABLE_FORMATS = WRITABLE_FORMATS = []
 
 class GeneralReader(object):
@@ -30,6 +36,13 @@ class GeneralReader(object):
         # current positions
         self.t = self.w = self.z = self.y = self.x = 0
 
+        # (key, 4D array) of the last time point read by readTimeBlock
+        self._tblock = None
+
+        # stacks returned by get3DArr are cached if setCache is called
+        self.cache = None
+        self._cacheId = None
+
         self.openFile()
 
     def __str__(self):
@@ -42,6 +55,8 @@ class GeneralReader(object):
         """
         closes the current file
         """
+        self._tblock = None
+        self.setCache(None)
         if hasattr(self, 'fp') and hasattr(self.fp, 'close'):
             self.fp.close()
             #del self.fp
@@ -295,6 +310,34 @@ class GeneralReader(object):
         a = N.fromfile(self.fp, self.dtype, N.prod(self.shape))
         return a.reshape((self.ny, self.nx))[xy0[0]:xy1[0], xy0[1]:xy1[1]]
 
+    def readStack(self, i, nz):
+        """
+        override this function together with readSec for format-specific reader
+
+        return nz consecutive sections from the number i in the file as a 3D array,
+        each section is the same as readSec returns
+        """
+        if self._secExtraByteSize:
+            return N.array([self.readSec(i + j) for j in range(nz)])
+
+        # one seek and one read for all sections
+        self.seekSec(i)
+
+        xy0 = self.roi_start[1:]
+        xy1 = xy0 + self.roi_size[1:]
+        a = N.fromfile(self.fp, self.dtype, N.prod(self.shape) * nz)
+        return a.reshape((nz, self.ny, self.nx))[:, xy0[0]:xy1[0], xy0[1]:xy1[1]]
+
+    def canReadStack(self):
+        """
+        return True if readStack reads the sections in the same way as getArr,
+        i.e. readStack is overridden, or neither readSec nor getArr is overridden
+        """
+        cls = type(self)
+        if _func(cls.readStack) is not _func(GeneralReader.readStack):
+            return True
+        return _func(cls.readSec) is _func(GeneralReader.readSec) and _func(cls.getArr) is _func(GeneralReader.getArr)
+
     def flipY(self, arr):
         """
         priithon uses the left-down position as the origin
@@ -320,11 +363,37 @@ class GeneralReader(object):
                           self.roi_start[-1]:self.roi_start[-1]+self.roi_size[-1]]
         return arr
 
+    def setCache(self, cache=stackCache.STACKS):
+        """
+        cache: StackCache to keep the stacks read by get3DArr, None to stop caching
+        the cached stacks are returned without copying, copy them before changing the values
+        """
+        if getattr(self, 'cache', None) is not None:
+            self.cache.discard(self._cacheId)
+        self.cache = cache
+        if cache is not None:
+            self._cacheId = cache.newId()
+
     def get3DArr(self, t=0, w=0, zs=None):
         """
         zs: if None, all z secs, else supply sequence of z sec
         
-        return a 3D stack
+        return a 3D stack, which is read-only if the cache is used (see setCache)
+        """
+        if self.cache is None:
+            return self.read3DArr(t=t, w=w, zs=zs)
+
+        if zs is not None:
+            zs = tuple([int(z) for z in zs])
+        key = (self._cacheId, int(t), int(w), zs, tuple(self.roi_start), tuple(self.roi_size), self.useROI2getArr)
+        return self.cache.get(key, self.read3DArr, t=t, w=w, zs=zs)
+
+    def read3DArr(self, t=0, w=0, zs=None):
+        """
+        override this function for format-specific reader
+        zs: if None, all z secs, else supply sequence of z sec
+
+        return a 3D stack read from the file
         """
         if zs is None:
             if self.useROI2getArr:
@@ -341,12 +410,70 @@ class GeneralReader(object):
             ny = self.ny
             nx = self.nx
             
+        if not self.canReadStack() or self.axes != 'YX':
+            arr = N.empty((nz, ny, nx), self.dtype)
+            for i, z in enumerate(zs):
+                arr[i] = self.getArr(t=t, z=z, w=w)
+            return arr
+
+        # sections consecutive in the file are read at once
+        idx = [self.findFileIdx(t=t, z=z, w=w) for z in zs]
+        runs = []
+        start = 0
+        for stop in range(1, nz + 1):
+            if stop == nz or idx[stop] != idx[stop-1] + 1:
+                runs.append((start, stop))
+                start = stop
+
+        # interleaved channels of whole time points are served from the block of the time point
+        whole = sorted(zs) == list(range(self.nz))
+        if len(runs) > 1 and TIMEBLOCK and self.imgSequence == 1 and self.nw > 1 and whole:
+            block = self.readTimeBlock(t)
+            arr = N.empty((nz,) + block.shape[-2:], self.dtype)
+            for i, z in enumerate(zs):
+                arr[i] = block[z, w]
+            return arr
+
+        # a subset of sections does not need the block
+        self._tblock = None
+
+        if len(runs) == 1:
+            return N.ascontiguousarray(self._readRun(idx[0], nz), self.dtype)
+
         arr = N.empty((nz, ny, nx), self.dtype)
-        
-        for i, z in enumerate(zs):
-            arr[i] = self.getArr(t=t, z=z, w=w)
+        for start, stop in runs:
+            arr[start:stop] = self._readRun(idx[start], stop - start)
         return arr
 
+    def _readRun(self, i, nz):
+        """
+        return nz consecutive sections from the number i in the file as getArr returns
+        """
+        a = self.readStack(i, nz)
+        if self.flip_required:
+            a = a[:, ::-1]
+        if self.useROI2getArr:
+            a = a[:,
+                  self.roi_start[-2]:self.roi_start[-2]+self.roi_size[-2],
+                  self.roi_start[-1]:self.roi_start[-1]+self.roi_size[-1]]
+        return a
+
+    def readTimeBlock(self, t=0):
+        """
+        read all sections of the time point t at once for imgSequence 1 (w changes fastest)
+        the block is kept until another time point or a subset of sections is read, so that the other channels are not read again
+
+        return 4D array (nz, nw, ny, nx) of sections as getArr returns
+        """
+        key = (t, tuple(self.roi_start), tuple(self.roi_size), self.useROI2getArr, self.flip_required)
+        if self._tblock is None or self._tblock[0] != key:
+            self._tblock = None # release the previous block before reading
+            a = self._readRun(self.findFileIdx(t=t, z=0, w=0), self.nz * self.nw)
+            a = a.reshape((self.nz, self.nw) + a.shape[-2:])
+            a.flags.writeable = False
+            self._tblock = (key, a)
+        return self._tblock[1]
+
     def get3DArrGenerator(self, ws=None, ts=None, ret_w_t=False, zs=None):
         """
         ws: indices of w
@@ -465,5 +592,11 @@ class GeneralWriter(GeneralReader):
             self.writeArr(a, t=t, w=w, z=z)
 
 
+def _func(method):
+    """
+    return the function of the method (python2 unbound method or python3 function)
+    """
+    return getattr(method, '__func__', method)
+
 def makeWaves(nw):
     return list(range(WAVE_START, WAVE_END, (WAVE_END - WAVE_START)//nw))[:nw]
@@ -12,8 +12,20 @@ except ImportError:
 READABLE_FORMATS = WRITABLE_FORMATS = ('mrc', 'dv')
 # 'Image sequence. 0=ZTW, 1=WZT, 2=ZWT (idx = [2,1,0])
 
+MEMMAP = True # read the image data through a memory map
+ZEROCOPY = False # getArr and get3DArr return read-only views of the memory map
+
 class MrcReader(generalIO.GeneralReader):
-    def __init__(self, fn, mode='r'):
+    def __init__(self, fn, mode='r', memmap=MEMMAP, zerocopy=ZEROCOPY):
+        """
+        memmap:   read the image data through a memory map in the 'r' mode,
+                  falls back to reading the file if the map is not available
+        zerocopy: getArr and get3DArr return read-only views of the memory map if possible,
+                  otherwise a copy
+        """
+        self.memmap = memmap
+        self.zerocopy = zerocopy
+        self.mm = None
         generalIO.GeneralReader.__init__(self, fn, mode)
         self.flip_required = False
 
@@ -47,6 +59,81 @@ class MrcReader(generalIO.GeneralReader):
 
         self.fp._secByteSize = self._secByteSize
 
+        if self.memmap and self.mode == 'r':
+            self.mm = self.mapData()
+
+    def mapData(self):
+        """
+        return memory map of all sections (nsec,ny,nx) in the file byte order,
+        or None if the file cannot be mapped (eg. incomplete file)
+        """
+        dtype = N.dtype(self.dtype)
+        if self.fp._fileIsByteSwapped:
+            dtype = dtype.newbyteorder()
+        try:
+            return N.memmap(self.fn, dtype, 'r', offset=self.dataOffset, shape=(self.nsec, self.ny, self.nx))
+        except (ValueError, IOError, OSError, MemoryError):
+            return None
+
+    def close(self):
+        self.mm = None
+        # module globals are already cleared when __del__ calls this at the interpreter shutdown
+        if generalIO is not None:
+            generalIO.GeneralReader.close(self)
+
+    def _fromMap(self, arr, copied=False):
+        """
+        arr: sections from the memory map
+        copied: arr is already a copy
+
+        return arr cropped by ROI, as a view if self.zerocopy else as a copy
+        """
+        if self.useROI2getArr:
+            arr = arr[Ellipsis,
+                      self.roi_start[-2]:self.roi_start[-2]+self.roi_size[-2],
+                      self.roi_start[-1]:self.roi_start[-1]+self.roi_size[-1]]
+        if (copied or self.zerocopy) and arr.dtype.isnative:
+            return arr.view(N.ndarray)
+        return N.array(arr, self.dtype)
+
+    def getArr(self, t=0, z=0, w=0):
+        """
+        return a single section according to the dimension
+        """
+        if self.mm is None:
+            return generalIO.GeneralReader.getArr(self, t=t, z=z, w=w)
+
+        idx = self.findFileIdx(t=t, z=z, w=w)
+        return self._fromMap(self.mm[idx])
+
+    def read3DArr(self, t=0, w=0, zs=None):
+        """
+        zs: if None, all z secs, else supply sequence of z sec
+
+        return a 3D stack
+        """
+        if self.mm is None:
+            return generalIO.GeneralReader.read3DArr(self, t=t, w=w, zs=zs)
+
+        if zs is None:
+            if self.useROI2getArr:
+                zs = list(range(self.roi_start[0], self.roi_start[0]+self.roi_size[0]))
+            else:
+                zs = list(range(self.nz))
+
+        # sections at a constant interval (the Z sections of any imgSequence) are a view
+        idx = [self.findFileIdx(t=t, z=z, w=w) for z in zs]
+        steps = set(N.diff(idx))
+        if len(idx) == 1:
+            return self._fromMap(self.mm[idx[0]:idx[0]+1])
+        elif len(steps) == 1 and min(steps) > 0:
+            step = int(min(steps))
+            return self._fromMap(self.mm[idx[0]:idx[-1]+1:step])
+        else:
+            arr = N.empty((len(idx), self.ny, self.nx), self.mm.dtype)
+            N.take(self.mm, idx, axis=0, out=arr)
+            return self._fromMap(arr, copied=True)
+
     def makeHdr(self):
         """
         make a Mrc header using the available dimension information to export
@@ -75,6 +162,9 @@ class MrcReader(generalIO.GeneralReader):
     def readSec(self, i):
         return self.fp.readSec(i)
 
+    def readStack(self, i, nz):
+        return self.fp.readStack(nz, i)
+
 
 class MrcWriter(generalIO.GeneralWriter):#, MrcReader):
     def __init__(self, outfn, hdr=None, extInts=None, extFloats=None):#, byteorder='='):
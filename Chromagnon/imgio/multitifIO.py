@@ -1,5 +1,7 @@
 from __future__ import division
-import sys
+import sys, threading, atexit
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 try:
     from . import generalIO
 except ImportError:
@@ -14,6 +16,17 @@ import numpy as N
 WRITABLE_FORMATS = ('tif', 'tiff')
 READABLE_FORMATS = WRITABLE_FORMATS + ('ome.tif', 'ome.tiff', 'lsm')
 
+MEMMAP = True # uncompressed pages at a constant interval are read through a memory map
+NTHREADS_DECODE = min(8, mp.cpu_count()) # threads to decode compressed pages of a stack
+
+
+def _offsetsBytecounts(page):
+    """
+    return offsets and bytecounts of the strips (or tiles) of the page for old and new tifffile
+    """
+    if hasattr(page, 'dataoffsets'):
+        return page.dataoffsets, page.databytecounts
+    return page.offsets_bytecounts
 
 def _convertUnit(val, fromwhat='mm', towhat=u'\xb5'+'m'):
     factors = {'m': 0, 'mm': -3, u'\xb5'+'m': -6, 'nm': -9, 'micron': -6}
@@ -22,10 +35,16 @@ def _convertUnit(val, fromwhat='mm', towhat=u'\xb5'+'m'):
 
 
 class MultiTiffReader(generalIO.GeneralReader):
-    def __init__(self, fn):
+    def __init__(self, fn, memmap=MEMMAP):
         """
         fn: file name
+        memmap: read uncompressed pages at a constant interval through a memory map,
+                other pages are decoded by tifffile
         """
+        self.memmap = memmap
+        self.mm = None
+        self._unchecked = None
+        self._lock = threading.RLock()
         generalIO.GeneralReader.__init__(self, fn)
 
     def openFile(self):
@@ -94,11 +113,11 @@ class MultiTiffReader(generalIO.GeneralReader):
         p = self.fp.pages[0]
 
         # byte_count, offsets = _byte_counts_offsets
-        self.dataOffset = p.offsets_bytecounts[0][0]
+        self.dataOffset = _offsetsBytecounts(p)[0][0]
         if len(self.fp.pages) > 1:
-            page1_offset     = self.fp.pages[1].offsets_bytecounts[0][0]
-            page0_offset     = self.fp.pages[0].offsets_bytecounts[0][0]
-            page0_byte_count = self.fp.pages[0].offsets_bytecounts[1][0]
+            page1_offset     = _offsetsBytecounts(self.fp.pages[1])[0][0]
+            page0_offset     = _offsetsBytecounts(self.fp.pages[0])[0][0]
+            page0_byte_count = _offsetsBytecounts(self.fp.pages[0])[1][0]
             
             self._secExtraByteSize = page1_offset - page0_offset - page0_byte_count
 
@@ -114,6 +133,9 @@ class MultiTiffReader(generalIO.GeneralReader):
         self.axes = p.axes # axis of one section
         self.compress = p.compression
 
+        if self.memmap:
+            self.mm = self.mapData()
+
         # since imageJ stores all image metadata in the first page
         #if self.fp.is_imagej or self.readSec(0).ndim > 2:
         #    self.arr = self.fp.pages[0].asarray()
@@ -225,10 +247,93 @@ class MultiTiffReader(generalIO.GeneralReader):
         return waves
 
                                 
+    def mapData(self):
+        """
+        return memory map of all sections (nsec,ny,nx) in the file byte order,
+        or None if the pages are compressed, not at a constant interval or cannot be mapped
+
+        only the first, second and last pages are parsed here,
+        and the other pages are checked when they are read (see getMap())
+        """
+        p = self.fp.pages[0]
+        dtype = N.dtype(self.dtype).newbyteorder(self.fp.byteorder)
+        secbytes = self.ny * self.nx * dtype.itemsize
+        if self.axes != 'YX' or getattr(p, 'is_tiled', False) or p.bitspersample != dtype.itemsize * 8:
+            return None
+
+        s = self.fp.series[0]
+        start = s.dataoffset if hasattr(s, 'dataoffset') else getattr(s, 'offset', None)
+        if start is not None and N.prod(s.shape) == self.nsec * self.ny * self.nx and p.compression == 1:
+            # contiguous series such as ImageJ hyperstacks, the pages need not be parsed
+            stride = secbytes
+            self._unchecked = None
+        else:
+            start = self.pageOffset(0, secbytes)
+            if start is None:
+                return None
+            stride = secbytes
+            if self.nsec > 1:
+                second = self.pageOffset(1, secbytes)
+                if second is None or second - start < secbytes:
+                    return None
+                stride = second - start
+                if self.pageOffset(self.nsec - 1, secbytes) != start + (self.nsec - 1) * stride:
+                    return None
+            self._unchecked = N.ones((self.nsec,), N.bool_)
+            self._unchecked[[0, 1, -1][:self.nsec]] = False
+            self._start = start
+            self._stride = stride
+
+        try:
+            raw = N.memmap(self.fn, N.uint8, 'r', offset=start, shape=((self.nsec - 1) * stride + secbytes,))
+        except (ValueError, IOError, OSError, MemoryError):
+            return None
+        return N.ndarray((self.nsec, self.ny, self.nx), dtype, raw, strides=(stride, self.nx * dtype.itemsize, dtype.itemsize))
+
+    def pageOffset(self, i, secbytes):
+        """
+        return the offset of the page i if it is an uncompressed section of secbytes in one piece, otherwise None
+        """
+        try:
+            page = self.fp.pages[int(i)]
+        except IndexError:
+            return None
+        offs, counts = _offsetsBytecounts(page)
+        if page.compression != 1 or N.sum(counts) != secbytes or N.any(N.add(offs[:-1], counts[:-1]) != offs[1:]):
+            return None
+        return int(offs[0])
+
+    def getMap(self, idx):
+        """
+        idx: section numbers to be read
+
+        return the memory map if the sections are read through it, otherwise None
+        the pages not yet parsed are checked here, and the map is not used any more if one of them is off the interval
+        """
+        mm = self.mm
+        if mm is None or self._unchecked is None:
+            return mm
+        secbytes = mm.strides[1] * self.ny
+        # tifffile reads the file to parse the pages
+        with self._lock:
+            for i in idx:
+                if self._unchecked[i]:
+                    if self.pageOffset(i, secbytes) != self._start + i * self._stride:
+                        self.mm = None
+                        return None
+                    self._unchecked[i] = False
+        return mm
+
+    def close(self):
+        self.mm = None
+        # module globals are already cleared when __del__ calls this at the interpreter shutdown
+        if generalIO is not None:
+            generalIO.GeneralReader.close(self)
+
     def seekSec(self, i=0):
         p = self.fp.pages[i]
         #byte_counts, offsets = p._byte_counts_offsets
-        offsets, byte_counts = p.offsets_bytecounts#_byte_counts_offsets
+        offsets, byte_counts = _offsetsBytecounts(p)#_byte_counts_offsets
 
         self.handle.seek(offsets[0])
         
@@ -243,12 +348,102 @@ class MultiTiffReader(generalIO.GeneralReader):
         #if 0:#self.fp.is_imagej or hasattr(self, 'arr'):
         #    return self.arr[int(i)]
         #else:
+
+        mm = self.getMap([int(i)])
+        if mm is not None:
+            return N.array(mm[int(i)], self.dtype)
         
-        arr = self.fp.pages[int(i)].asarray()
+        arr = _decode((self.fp.pages[int(i)], self._lock))
         if arr.ndim == 3: # h.axes == 'SYX'
             arr = arr[self.axes_w]
         return arr
 
+    def readStack(self, i, nz):
+        """
+        return nz consecutive sections from the number i in the file as a 3D array
+        compressed pages are decoded concurrently
+        """
+        mm = self.getMap(range(i, i+nz))
+        if mm is not None:
+            return N.array(mm[i:i+nz], self.dtype)
+
+        # pages are parsed in this thread since tifffile reads the file to find them
+        pages = [self.fp.pages[int(j)] for j in range(i, i+nz)]
+        if NTHREADS_DECODE > 1 and nz > 1:
+            arrs = getDecodePool().map(_decode, [(page, self._lock) for page in pages])
+        else:
+            arrs = [_decode((page, self._lock)) for page in pages]
+        return N.array(arrs)
+
+    def read3DArr(self, t=0, w=0, zs=None):
+        """
+        zs: if None, all z secs, else supply sequence of z sec
+
+        return a 3D stack
+        """
+        if zs is None:
+            if self.useROI2getArr:
+                zsecs = list(range(self.roi_start[0], self.roi_start[0]+self.roi_size[0]))
+            else:
+                zsecs = list(range(self.nz))
+        else:
+            zsecs = zs
+
+        idx = [self.findFileIdx(t=t, z=z, w=w) for z in zsecs]
+        mm = self.getMap(idx)
+        if mm is None:
+            return generalIO.GeneralReader.read3DArr(self, t=t, w=w, zs=zs)
+
+        # sections at a constant interval (the Z sections of any imgSequence) are a view
+        steps = set(N.diff(idx))
+        if len(idx) == 1:
+            arr = mm[idx[0]:idx[0]+1]
+        elif len(steps) == 1 and min(steps) > 0:
+            step = int(min(steps))
+            arr = mm[idx[0]:idx[-1]+1:step]
+        else:
+            arr = N.take(mm, idx, axis=0)
+
+        if self.flip_required:
+            arr = arr[:, ::-1]
+        if self.useROI2getArr:
+            arr = arr[:,
+                      self.roi_start[-2]:self.roi_start[-2]+self.roi_size[-2],
+                      self.roi_start[-1]:self.roi_start[-1]+self.roi_size[-1]]
+        return N.array(arr, self.dtype)
+
+def _decode(args):
+    """
+    return the section decoded from the page
+    """
+    page, lock = args
+    try:
+        return page.asarray(lock=lock)
+    except TypeError: # old tifffile without the lock keyword, the file is read and decoded under the lock
+        with lock:
+            return page.asarray()
+
+_DECODE_POOL = None
+
+def getDecodePool():
+    """
+    return a thread pool kept for decoding pages
+    the decompression releases GIL, so threads run in parallel
+    """
+    global _DECODE_POOL
+    if _DECODE_POOL is None:
+        _DECODE_POOL = ThreadPool(NTHREADS_DECODE)
+    return _DECODE_POOL
+
+def closeDecodePool():
+    global _DECODE_POOL
+    if _DECODE_POOL is not None:
+        _DECODE_POOL.close()
+        _DECODE_POOL.join()
+        _DECODE_POOL = None
+
+atexit.register(closeDecodePool)
+
 
 
 class MultiTiffWriter(generalIO.GeneralWriter):
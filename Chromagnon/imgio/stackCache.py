@@ -0,0 +1,90 @@
+### cache of 3D stacks shared by the readers
+from __future__ import print_function
+import threading, itertools
+from collections import OrderedDict
+import numpy as N
+
+# memory (bytes) used by the cached stacks
+MAXBYTES = 2**30
+
+class StackCache(object):
+    """
+    least-recently-used cache of 3D stacks keyed by (reader, t, w, zs, roi)
+    the stacks are evicted when their total size exceeds maxbytes
+    the cache is shared by threads, and the stacks are read-only
+    """
+    def __init__(self, maxbytes=MAXBYTES):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+    def newId(self):
+        """
+        return a number to identify a reader in the keys
+        """
+        return next(self._ids)
+
+    def get(self, key, func, *args, **kwds):
+        """
+        return the stack of the key, or read it by func(*args, **kwds) if not cached
+        """
+        with self._lock:
+            if key in self._cache:
+                arr = self._cache.pop(key)
+                self._cache[key] = arr
+                self.hits += 1
+                return arr
+
+        # stacks are read outside of the lock so that other threads are not blocked
+        arr = N.asarray(func(*args, **kwds))
+        arr.flags.writeable = False
+
+        with self._lock:
+            self.misses += 1
+            if arr.nbytes > self.maxbytes:
+                return arr
+            if key in self._cache:
+                self.nbytes -= self._cache.pop(key).nbytes
+            self._cache[key] = arr
+            self.nbytes += arr.nbytes
+            while self.nbytes > self.maxbytes:
+                self.nbytes -= self._cache.popitem(last=False)[1].nbytes
+                self.evictions += 1
+        return arr
+
+    def discard(self, rid):
+        """
+        remove the stacks of the reader number rid
+        """
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == rid]:
+                self.nbytes -= self._cache.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        return dictionary of hits, misses, evictions, size, nbytes and maxbytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._cache), 'nbytes': self.nbytes, 'maxbytes': self.maxbytes}
+
+STACKS = StackCache()
+
+def stats():
+    return STACKS.stats()
+
+def clear():
+    STACKS.clear()
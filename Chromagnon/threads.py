@@ -96,25 +96,20 @@ class ThreadWithExc(threading.Thread):
         OLD_REIK = fftmanager.REIK
         fftmanager.SCIK = False
         fftmanager.REIK = False
+        fftmanager.loadWisdom()
         
         fns = self.fns
         targets = self.targets
         parms = self.parms
 
         # parameters
-        cutout = parms[0]
-        initGuess = parms[1]
-        if initGuess and not os.path.isfile(initGuess):
-            raise ValueError('The initial guess is not a valid Chromagnon file')
+        aligner.checkParms(parms)
         local = parms[2]
 
-        maxShift = parms[3]
-        zmag = parms[4]
         self.parm_suffix = parms[5]
         self.img_suffix = parms[6]
         nts = parms[7]
         self.img_ext = parms[8]
-        min_pxls_yx = parms[9]
         
         saveAlignParam = True
         alignChannels = True
@@ -141,47 +136,13 @@ class ThreadWithExc(threading.Thread):
                     if self.notify_obj:
                         wx.PostEvent(self.notify_obj, MyEvent(EVT_COLOR_ID, ['ref', index, wx.RED]))
 
-                    an = aligner.Chromagnon(fn)
                     an = self.getAligner(fn, index, what='ref')
-                    an.setZmagSwitch(zmag)
-                    an.setMaxShift(maxShift)
 
                     pgen = self.progressValues(target=False, an=an, alignChannels=alignChannels, alignTimeFrames=alignTimeFrames, local=local)
                     an.setProgressfunc(pgen)
-                    
-                    if initGuess:
-                        an.loadParm(initGuess)
-                        # mapyx should not be inherited...
-                        an.mapyx = None
-                    
-                    if (an.nw > 1 and an.nt == 1):
-                        an.findBestChannel()
-                        self.echo('Calculating channel alignment...')
-                        
-                        for t in range(an.nt):
-                            try:
-                                an.findAlignParamWave(t=t)
-                            except alignfuncs.AlignError: # in xcorr or else
-                                self.echo('Calculation failed, skipping')
-                                errs.append(index)
-                                continue
-                            
-                            if local in self.localChoice[1:]:
-                                an.findNonLinear2D(t=t, npxls=min_pxls_yx)
-                                
-                            if local in self.localChoice[2:]:
-                                arr = an.findNonLinear3D(t=t, npxls=min_pxls_yx)
-                                del arr
-                            
-                        
-                    elif an.nt > 1:
-                        self.echo('Calculating timelapse alignment...')
-                        an.findBestChannel()
-                        an.findBestTimeFrame(an.refwave)
-                        
-                        an.findAlignParamTime(doWave=False)
 
-                    fn = an.saveParm()
+                    fn, failed = aligner.calibrate(an, parms, self.localChoice)
+                    errs += [index] * len(failed)
 
                     currlist = None
                     #clk1 = time.clock()
@@ -208,11 +169,7 @@ class ThreadWithExc(threading.Thread):
                     an.setProgressfunc(pgen)
                     self.progress(0)
 
-                    an.loadParm(fn)
-                    #if cutout:
-                    an.setRegionCutOut(cutout)
-
-                    out = an.saveAlignedImage()
+                    out = aligner.applyParm(an, fn, parms)
                     donetgt.append(index)
 
                     an.close()
@@ -245,12 +202,7 @@ class ThreadWithExc(threading.Thread):
                 an.setProgressfunc(pgen)
                 self.progress(0)
 
-                if len(fns):
-                    an.loadParm(fn)
-
-                an.setRegionCutOut(cutout)
-
-                out = an.saveAlignedImage()
+                out = aligner.applyParm(an, fn if len(fns) else None, parms)
 
                 donetgt.append(index)
 
@@ -296,22 +248,19 @@ class ThreadWithExc(threading.Thread):
 
         fftmanager.SCIK = OLD_SCIK
         fftmanager.REIK = OLD_REIK
+        try:
+            fftmanager.saveWisdom()
+        except (IOError, OSError):
+            pass
 
     def getAligner(self, fn, index, what='ref'):
         """
         what: 'ref' or 'tgt'
         """
         try:
-            an = aligner.Chromagnon(fn)
-            an.setImgSuffix(self.img_suffix)
-            an.setFileFormats(self.img_ext)
-            an.setParmSuffix(self.parm_suffix)
-
+            an = aligner.makeAligner(fn, self.parms, self.echo)
         except IOError:
-            raise IOError('filename %s, index %i, fns %s' % (fn, index, fns))
-
-
-        an.setEchofunc(self.echo)
+            raise IOError('filename %s, index %i, fns %s' % (fn, index, self.fns))
         return an
 
     
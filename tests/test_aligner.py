@@ -0,0 +1,218 @@
+import threading
+import numpy as N
+import pytest
+from scipy import ndimage
+
+from Chromagnon import aligner, imgio
+
+
+
+def _runPipeline(items, func, writer, depth=2, timeout=20):
+    """
+    run aligner.runPipeline in a thread, fail if it does not return in time
+
+    return the exception raised by runPipeline or None
+    """
+    errs = []
+    def run():
+        try:
+            aligner.runPipeline(items, func, writer, depth)
+        except Exception as e:
+            errs.append(e)
+    th = threading.Thread(target=run)
+    th.daemon = True
+    th.start()
+    th.join(timeout)
+    assert not th.is_alive(), 'runPipeline deadlocked'
+    return errs[0] if errs else None
+
+
+def _failAt(n, what):
+    def func(x):
+        if x == n:
+            raise ValueError('%s failed at %i' % (what, n))
+        return x
+    return func
+
+
+def test_runPipeline_equals_loop():
+    out = []
+    assert _runPipeline(iter(range(50)), lambda x: x * 2, out.append) is None
+    assert out == [x * 2 for x in range(50)]
+
+    out = []
+    assert _runPipeline(iter([]), lambda x: x, out.append) is None
+    assert out == []
+
+
+def _items(n, failAt=None):
+    for i in range(n):
+        if i == failAt:
+            raise ValueError('reader failed at %i' % i)
+        yield i
+
+
+@pytest.mark.parametrize('at', [0, 3, 40])
+def test_runPipeline_raises_errors(at):
+    out = []
+    e = _runPipeline(_items(100, at), lambda x: x, out.append)
+    assert isinstance(e, ValueError) and 'reader failed' in str(e)
+    assert out == list(range(at))
+
+    out = []
+    e = _runPipeline(_items(100), _failAt(at, 'func'), out.append)
+    assert isinstance(e, ValueError) and 'func failed' in str(e)
+    assert out == list(range(at))
+
+    # the reader and func stop after the writer fails
+    read = []
+    def items():
+        for i in range(100):
+            read.append(i)
+            yield i
+    e = _runPipeline(items(), lambda x: x, _failAt(at, 'writer'))
+    assert isinstance(e, ValueError) and 'writer failed' in str(e)
+    assert len(read) < at + 10
+
+
+def _writeDV(fn, arr):
+    """
+    arr: (nt,nw,nz,ny,nx)
+    """
+    nt, nw, nz, ny, nx = arr.shape
+    wtr = imgio.Writer(fn)
+    wtr.setDim(nx, ny, nz, nt, nw, arr.dtype.type, [500 + 100 * w for w in range(nw)], 0)
+    for t in range(nt):
+        for w in range(nw):
+            wtr.write3DArr(arr[t,w], t=t, w=w)
+    wtr.close()
+
+
+def _read(fn):
+    rdr = imgio.Reader(fn)
+    try:
+        return N.array([[rdr.get3DArr(t=t, w=w) for w in range(rdr.nw)] for t in range(rdr.nt)])
+    finally:
+        rdr.close()
+
+
+def _saveWhole(an):
+    """
+    the former saveAlignedImage, stack by stack
+    """
+    min0 = an.dtype == N.float32 and all(an.img.get3DArr(t=t, w=w).min() == 0 for t in range(an.nt) for w in range(an.nw))
+    out = []
+    for t in range(an.nt):
+        for w in range(an.nw):
+            if w == an.refwave and an.nt == 1:
+                arr = an.img.get3DArr(w=w, t=t)[tuple(an.cropSlice)]
+            elif an.mapyx is None:
+                arr = an.get3DArrayAligned(w=w, t=t)
+            else:
+                arr = an.get3DArrayRemapped(w=w, t=t)
+            if min0:
+                arr = N.where(arr > 0, arr, 0)
+            out.append(arr)
+    return N.array(out).reshape((an.nt, an.nw) + out[0].shape)
+
+
+@pytest.fixture
+def image(tmp_path):
+    """
+    smooth float32 stack of 2 channels, 40 sections (3 slabs of aligner.SAVE_SLAB_NZ)
+    """
+    rs = N.random.RandomState(0)
+    arr = ndimage.gaussian_filter(rs.rand(1, 2, 40, 48, 40), (0, 0, 2, 2, 2)).astype(N.float32)
+    arr = (arr - arr.min()) * 1000
+    return str(tmp_path), arr
+
+
+# tz, ty, tx, r, mz, my, mx
+PARMS = {'Z': [0.7, 1.3, -0.6, 0.8, 1.02, 0.99, 1.01],
+         'XY': [0, 1.3, -0.6, 0.8, 1, 0.99, 1.01]}
+
+
+def _open(image, parm, offset=10):
+    dirname, arr = image
+    fn = dirname + '/img.dv'
+    _writeDV(fn, arr + offset)
+    an = aligner.Chromagnon(fn)
+    an.setEchofunc(None)
+    an.alignParms[0,1] = parm
+    an.setRegionCutOut()
+    return an
+
+
+def _map(an, sectionwise=False):
+    """
+    smooth local shifts of less than 1 pixel
+    """
+    rs = N.random.RandomState(1)
+    shape = (an.nz,) if sectionwise else ()
+    shape += (2, an.ny, an.nx)
+    return ndimage.gaussian_filter(rs.rand(*shape) - 0.5, 4).astype(N.float32) * 4
+
+
+def _compare(an, dirname, pipeline=True):
+    out = an.saveAlignedImage(dirname + '/out.dv', pipeline=pipeline)
+    streamed = _read(out)
+    whole = _saveWhole(an)
+    assert streamed.shape == whole.shape
+    N.testing.assert_array_equal(streamed[0,0], whole[0,0])
+    N.testing.assert_allclose(streamed, whole, atol=1e-4 * whole.max())
+    return streamed, whole
+
+
+@pytest.mark.parametrize('mode', ['Z', 'XY'])
+@pytest.mark.parametrize('pipeline', [True, False])
+def test_saveAlignedImage_equals_whole(image, mode, pipeline):
+    an = _open(image, PARMS[mode])
+    try:
+        _compare(an, image[0], pipeline)
+    finally:
+        an.close()
+
+
+@pytest.mark.parametrize('mode', ['Z', 'XY'])
+@pytest.mark.parametrize('sectionwise', [False, True])
+def test_saveAlignedImage_remap_equals_whole(image, mode, sectionwise):
+    an = _open(image, PARMS[mode])
+    try:
+        an.mapyx = N.zeros((an.nt, an.nw) + _map(an, sectionwise).shape, N.float32)
+        an.mapyx[0,1] = _map(an, sectionwise)
+        _compare(an, image[0])
+    finally:
+        an.close()
+
+
+def test_saveAlignedImage_sectionwise_map_is_read_in_slabs(image, monkeypatch):
+    an = _open(image, PARMS['Z'])
+    try:
+        an.mapyx = N.zeros((an.nt, an.nw) + _map(an, True).shape, N.float32)
+        an.mapyx[0,1] = _map(an, True)
+        nzs = []
+        get3DArr = an.img.get3DArr
+        def record(*args, **kwds):
+            arr = get3DArr(*args, **kwds)
+            nzs.append(len(arr))
+            return arr
+        monkeypatch.setattr(an.img, 'get3DArr', record)
+        list(an.iterSectionsAligned(w=1))
+        assert nzs and max(nzs) < an.nz
+    finally:
+        an.close()
+
+
+@pytest.mark.parametrize('mode', ['Z', 'XY'])
+def test_saveAlignedImage_clips_min0(image, mode):
+    dirname, arr = image
+    # a sharp edge gives negative values by the interpolation
+    arr = arr + 100
+    arr[...,:15] = 0
+    an = _open((dirname, arr), PARMS[mode], offset=0)
+    try:
+        assert an.get3DArrayAligned(w=1).min() < 0
+        streamed, whole = _compare(an, dirname)
+        assert streamed.min() == 0
+    finally:
+        an.close()
@@ -0,0 +1,397 @@
+import threading
+import numpy as N
+import pytest
+from scipy import ndimage, spatial
+
+from Chromagnon import alignfuncs
+
+
+def _shiftedPair(shape=(128,128), shift=(0.6,-0.4), seed=0):
+    rs = N.random.RandomState(seed)
+    ref = (ndimage.gaussian_filter(rs.rand(*shape), 2) * 1000).astype(N.float32)
+    arr = ndimage.shift(ref, shift).astype(N.float32)
+    return arr, ref
+
+
+def _xcorNonLinearOld(arr, ref, npxls=60, cthre=alignfuncs.CTHRE, pxlshift_allow=alignfuncs.MAX_SHIFT_LOCAL):
+    """
+    the former xcorNonLinear, tile by tile in the calling thread
+    """
+    npxls = [npxls, npxls]
+    threshold = alignfuncs.getVar(arr, ref) * 0.1
+    taas = [[alignfuncs.chopImage2D(arr, npxls, shiftOrigin=(yi,xi)) for xi in range(2)] for yi in range(2)]
+    tars = [[alignfuncs.chopImage2D(ref, npxls, shiftOrigin=(yi,xi)) for xi in range(2)] for yi in range(2)]
+    nsplit0 = N.array((len(taas[0][0][0]), len(taas[0][0][0][0])))
+    nsplit1 = N.array((len(taas[1][1][0]), len(taas[1][1][0][0])))
+    nsplit = tuple(nsplit0 + nsplit1)
+    yxs = N.zeros((2,)+nsplit, N.float32)
+    region = N.zeros((3,)+nsplit, N.float32)
+    cs = N.zeros((2,2,) + arr.shape, N.float32)
+    for yi in range(2):
+        for xi in range(2):
+            tslcs, arrs = taas[yi][xi]
+            rslcs, refs = tars[yi][xi]
+            for y, ay in enumerate(arrs):
+                for x, a in enumerate(ay):
+                    b = refs[y][x]
+                    av = alignfuncs.imgFilters.cutOutCenter(a, 0.5, interpolate=False)
+                    bv = alignfuncs.imgFilters.cutOutCenter(b, 0.5, interpolate=False)
+                    var = alignfuncs.getVar(av, bv)
+                    region[1,2*y+yi,2*x+xi] = var
+                    if var > threshold:
+                        yx, c = alignfuncs.xcorr.Xcorr(a, b)
+                        cs[tuple([slice(yi,yi+1),slice(xi,xi+1)]+list(tslcs[y][x]))] += c
+                        cqual = (c.max() - c[:c.shape[0]//4].std()) / c.sum()
+                        region[2,2*y+yi,2*x+xi] = cqual
+                        if cqual >= cthre and N.abs(yx).max() < pxlshift_allow:
+                            yxs[:,2*y+yi,2*x+xi] = yx
+                            region[0,2*y+yi,2*x+xi] = 1
+    return yxs, region, cs
+
+
+@pytest.fixture
+def tilePool():
+    alignfuncs.closeTilePool()
+    yield
+    alignfuncs.closeTilePool()
+
+
+def test_xcorNonLinear_batch_equals_tiles():
+    arr, ref = _shiftedPair()
+    batch = alignfuncs.xcorNonLinear(arr, ref, npxls=32, batch=True, nthreads=1)
+    tiles = alignfuncs.xcorNonLinear(arr, ref, npxls=32, batch=False, nthreads=1)
+    for b, t in zip(batch, tiles):
+        assert N.allclose(b, t, atol=1e-4)
+
+
+@pytest.mark.parametrize('batch', [False, True])
+@pytest.mark.parametrize('nthreads', [1, 3])
+def test_xcorNonLinear_equals_former(tilePool, monkeypatch, batch, nthreads):
+    # several stacks of tiles for the pool
+    monkeypatch.setattr(alignfuncs, 'BATCH_SIZE_LOCAL', 8)
+    arr, ref = _shiftedPair((150, 170))
+    # a flat corner is not cross correlated
+    arr[:50,:50] = ref[:50,:50] = 500
+    old = _xcorNonLinearOld(arr, ref, npxls=32)
+    new = alignfuncs.xcorNonLinear(arr, ref, npxls=32, batch=batch, nthreads=nthreads)
+    assert (alignfuncs._TILE_POOL is not None) == (nthreads > 1)
+    assert old[1][0].sum() > 0 and not old[1][0].all()
+    N.testing.assert_array_equal(new[1][0], old[1][0])
+    for n, o in zip(new, old):
+        assert n.shape == o.shape
+        assert N.allclose(n, o, rtol=1e-4, atol=1e-4)
+
+
+def test_getTilePool(tilePool):
+    pool = alignfuncs.getTilePool(2)
+    assert alignfuncs.getTilePool(2) is pool
+    # a different number of threads replaces the pool
+    pool3 = alignfuncs.getTilePool(3)
+    assert pool3 is not pool and len(pool3._pool) == 3
+    alignfuncs.closeTilePool()
+    assert alignfuncs._TILE_POOL is None
+
+
+def _threadPlans(barrier):
+    """
+    return the shapes of the plans and the fftw thread limit of the calling thread
+    """
+    try:
+        man = alignfuncs.F.fftw.man
+        return threading.current_thread().ident, [key[0] for key in man._plan_cache()], getattr(man._plans, 'maxthreads', None)
+    finally:
+        barrier.wait()
+
+
+@pytest.mark.skipif(not alignfuncs.F.fftw.FFTW, reason='pyfftw is not available')
+def test_warmupTilePool(tilePool):
+    alignfuncs.warmupTilePool([(30, 34)], nthreads=3)
+    barrier = threading.Barrier(3)
+    results = alignfuncs.getTilePool(3).map(_threadPlans, [barrier] * 3, 1)
+    # every thread has its plans, and runs fftw in a single thread
+    assert len(set([ident for ident, shapes, maxthreads in results])) == 3
+    for ident, shapes, maxthreads in results:
+        assert (38, 42) in shapes
+        assert maxthreads == 1
+
+
+
+
+def _measureSaturationOld(a3d, force_calc_neighbor=False, ret_fraction=False):
+    """
+    the former measureSaturation with the distance matrix
+    """
+    try:
+        ii = N.iinfo(a3d.dtype)
+    except ValueError:
+        return 0, 0
+    if a3d.max() != ii.max:
+        return 0, 0
+    ind = N.array(N.where(a3d == ii.max)).T
+    spx = len(ind)
+    if spx / a3d.size < 0.0001 or force_calc_neighbor:
+        dmat = spatial.distance.cdist(ind, ind, 'euclidean')
+        dmat += N.eye(dmat.shape[1], dmat.shape[0], dtype=dmat.dtype.type) * N.linalg.norm(a3d.shape)
+        npxl = len(N.where(dmat <= N.linalg.norm((2**0.5)+1))[0]) // 2
+    else:
+        npxl = spx
+    if ret_fraction:
+        return spx / a3d.size, npxl / (dmat.size // 2)
+    return spx, npxl
+
+
+@pytest.mark.parametrize('dtype', [N.uint8, N.uint16, N.int16])
+def test_measureSaturation_equals_distance_matrix(dtype):
+    rs = N.random.RandomState(4)
+    ii = N.iinfo(dtype)
+    for nsat in (0, 1, 5, 30, 300):
+        a = (rs.rand(20, 64, 64) * ii.max * 0.5).astype(dtype)
+        # single pixels and small clusters, some of them touching diagonally
+        for z, y, x in rs.randint(0, (20, 63, 63), (nsat, 3)):
+            a[z, y:y+rs.randint(1, 3), x:x+rs.randint(1, 3)] = ii.max
+        for force in (False, True):
+            assert alignfuncs.measureSaturation(a, force) == _measureSaturationOld(a, force)
+        if nsat:
+            assert N.allclose(alignfuncs.measureSaturation(a, True, True), _measureSaturationOld(a, True, True))
+    assert alignfuncs.measureSaturation(a.astype(N.float32)) == (0, 0)
+
+
+
+def _focusScoresOld(ref):
+    """
+    the former scores of findBestRefZs, section by section
+    """
+    F = alignfuncs.F
+    ring = F.ringArr(ref.shape[-2:], radius1=ref.shape[-1]//10, radius2=ref.shape[-2]//4, orig=(0,0), wrap=1)
+    ms = N.zeros((len(ref),), N.float32)
+    for z in range(len(ref)):
+        af = F.rfft(N.ascontiguousarray(ref[z]))
+        ms[z] = N.sum(N.abs(af * ring[:,:af.shape[-1]]))
+    return ms
+
+
+def _focusStack(shape, seed=5):
+    """
+    blurred out of focus at both ends
+    """
+    rs = N.random.RandomState(seed)
+    a = rs.rand(*shape).astype(N.float32) * 1000
+    for z in range(shape[0]):
+        a[z] = ndimage.gaussian_filter(a[z], abs(z - shape[0] * 0.4) * 0.5 + 0.5)
+    return a
+
+
+@pytest.mark.parametrize('nsec', [16, 3])
+@pytest.mark.parametrize('shape', [(12, 64, 80), (11, 63, 65)])
+def test_focusScores_equals_sections(monkeypatch, shape, nsec):
+    # blocks of nsec sections, the last one partly filled
+    monkeypatch.setattr(alignfuncs, 'FOCUS_NSEC', nsec)
+    ref = _focusStack(shape)
+    for a in (ref, ref.T):
+        assert N.allclose(alignfuncs.focusScores(a[1:-1]), _focusScoresOld(a[1:-1]), rtol=1e-4)
+
+    old = _focusScoresOld(ref[1:-1])
+    thr = old.mean() + old.std() * 0.5
+    ids = [z for z in range(1, shape[0]-1) if old[z-1] > thr]
+    assert ids and alignfuncs.findBestRefZs(ref) == ids
+
+
+def _estimate2DOld(a2d, ref, center=None, phaseContrast=True, cqthre=alignfuncs.CTHRE/10., max_shift_pxl=5):
+    """
+    the former estimate2D, quadrant by quadrant
+    """
+    if center is None:
+        center = N.array(a2d.shape) // 2
+    a1234p = [alignfuncs.xcorr.paddAndApo(a, 4) for a in alignfuncs.chopImg(ref, center)]
+    b1234p = [alignfuncs.xcorr.paddAndApo(b, 4) for b in alignfuncs.chopImg(a2d, center)]
+    if phaseContrast:
+        a1234p = [alignfuncs.xcorr.phaseContrastFilter(N.ascontiguousarray(a)) for a in a1234p]
+        b1234p = [alignfuncs.xcorr.phaseContrastFilter(N.ascontiguousarray(b)) for b in b1234p]
+    yxcs = [alignfuncs.xcorr.Xcorr(a, b, phaseContrast=False, searchRad=max_shift_pxl) for a, b in zip(a1234p, b1234p)]
+    yxs = [yx for yx, c in yxcs]
+    cqvs = [c.max() - c[c.shape[0]//4].std() for yx, c in yxcs]
+    checks = [(idx, cq) for idx, cq in enumerate(cqvs) if cq < cqthre]
+    theta, offset = alignfuncs.getRotation(yxs, center)
+    return list(alignfuncs.getTranslation(yxs)) + [theta] + list(alignfuncs.getMagnification(yxs, center)), offset, checks
+
+
+def _assertEstimate2D(new, old):
+    # float32 FFTs of different plans differ slightly
+    assert N.allclose(new[0], old[0], rtol=1e-3, atol=2e-3)
+    assert N.allclose(new[1], old[1], rtol=1e-3, atol=1e-2)
+    assert [i for i, cq in new[2]] == [i for i, cq in old[2]]
+
+
+@pytest.mark.parametrize('phaseContrast', [True, False])
+@pytest.mark.parametrize('shape,center', [((128, 128), None), ((128, 128), (60, 70)), ((127, 131), None)])
+def test_estimate2D_equals_quadrants(shape, center, phaseContrast):
+    arr, ref = _shiftedPair(shape, (0.8, -1.3))
+    old = _estimate2DOld(arr, ref, center, phaseContrast)
+    _assertEstimate2D(alignfuncs.estimate2D(arr, ref, center, phaseContrast), old)
+
+    # the quadrants prepared once for the reference
+    c = N.array(shape) // 2 if center is None else center
+    aprep = alignfuncs.prepareQuadrants(ref, c, phaseContrast)
+    assert isinstance(aprep, N.ndarray) == (shape == (128, 128) and center is None)
+    _assertEstimate2D(alignfuncs.estimate2D(arr, ref, center, phaseContrast, aprep=aprep), old)
+
+
+
+def test_PreparedRef_quadrants_equal_former(monkeypatch):
+    arr, ref = _shiftedPair((128, 140), (1.2, -0.7))
+    pref = alignfuncs.PreparedRef(ref)
+    slc = (slice(3, 125), slice(2, 138))
+    aprep = pref.quadrants(slc, (61, 68))
+    assert not aprep.flags.writeable
+    assert N.array_equal(aprep, alignfuncs.prepareQuadrants(ref[slc], (61, 68)))
+    assert pref.quadrants(slc, (61, 68)) is aprep
+
+    # the quadrants are shared by the iterations and by the next channel
+    results = [alignfuncs.iteration(arr, pref)[0] for i in range(2)]
+    assert pref.stats()['hits'] > 1
+
+    # each estimate2D prepares the quadrants as before
+    monkeypatch.setattr(alignfuncs.PreparedRef, 'quadrants', lambda self, slc, center, phaseContrast=True: None)
+    old = alignfuncs.iteration(arr, ref)[0]
+    for ret in results:
+        assert N.allclose(ret, old, rtol=1e-3, atol=2e-3)
+
+
+def _warpedPair(shape, amp=30, sigma=10, seed=0):
+    """
+    reference and the reference distorted by smooth local shifts
+    """
+    rs = N.random.RandomState(seed)
+    ref = (ndimage.gaussian_filter(rs.rand(*shape), 2) * 1000).astype(N.float32)
+    yx = ndimage.gaussian_filter(rs.rand(2, *shape) - 0.5, (0, sigma, sigma))
+    yx *= amp / N.abs(yx).max()
+    arr = ndimage.map_coordinates(ref, N.indices(shape, N.float32) + yx, order=1).astype(N.float32)
+    return arr, ref
+
+
+def test_PreparedRef_tiles_equal_former(monkeypatch):
+    arr, ref = _warpedPair((150, 170))
+    pref = alignfuncs.PreparedRef(ref)
+    for slc in (None, (slice(2, 148), slice(3, 165))):
+        r = ref if slc is None else ref[slc]
+        for origin in ((0,0), (1,1)):
+            rvar, spectra = pref.tiles(slc, 32, origin)
+            assert not spectra.flags.writeable
+            new = alignfuncs.prepareTiles(r, 32, origin)
+            assert N.array_equal(rvar, new[0]) and N.array_equal(spectra, new[1])
+
+    results = [alignfuncs.iterNonLinear(arr, pref, npxl=32)[0] for i in range(2)]
+    assert pref.stats()['hits'] > 1
+
+    # each xcorNonLinear prepares the tiles as before
+    xcorNonLinear = alignfuncs.xcorNonLinear
+    monkeypatch.setattr(alignfuncs, 'xcorNonLinear', lambda *args, **kwds: xcorNonLinear(*args[:5]))
+    old = alignfuncs.iterNonLinear(arr, ref, npxl=32)[0]
+    assert old is not None
+    for yx in results:
+        assert N.allclose(yx, old, rtol=1e-3, atol=1e-3)
+
+
+def _fillHolesLoop(yx, region, win=3):
+    """
+    the former fillHoles, region by region
+    """
+    if region.max() == 0:
+        return yx
+    while region.min() == 0:
+        region2 = N.copy(region)
+        half = win//2
+        ny, nx = region.shape
+        yx2 = N.copy(yx)
+        for y in range(ny):
+            for x in range(nx):
+                yh0 = xh0 = half
+                yh1 = xh1 = half + 1
+                if not region[y,x]:
+                    if y < half:
+                        yh0 = 0
+                    elif y > (ny - half):
+                        yh1 = 1
+                    if x < half:
+                        xh0 = 0
+                    elif x > (nx - half):
+                        xh1 = 1
+                    yi, xi = N.nonzero(region[y-yh0:y+yh1,x-xh0:x+xh1])
+                    if len(yi):
+                        for i in range(2):
+                            yx2[i,y,x] = N.mean(yx[i,y-yh0:y+yh1,x-xh0:x+xh1][yi,xi]) / (2 ** ((win-3)/2))
+                        region2[y,x] = 1
+        region = region2
+        yx = yx2
+        win += 2
+    return yx
+
+
+def test_fillHoles_equals_loop():
+    rs = N.random.RandomState(2)
+    for i in range(50):
+        ny, nx = rs.randint(1, 12, 2)
+        region = (rs.rand(ny, nx) > rs.rand()).astype(N.float32)
+        yx = (rs.randn(2, ny, nx) * region).astype(N.float32)
+        assert N.allclose(alignfuncs.fillHoles(yx.copy(), region.copy()), _fillHolesLoop(yx.copy(), region.copy()), atol=1e-5)
+
+
+def _paddYXLoop(yx, npxl, shape, maxcutY=0, maxcutX=0):
+    """
+    the former paddYX, filling the margins column by column and row by row
+    """
+    npxl //= 2
+    yx = alignfuncs.imgFilters.zoomFourier(yx, (1,npxl,npxl))[:,3:-3,3:-3]
+    mimas = alignfuncs.chopShapeND(shape, npxls=(npxl,npxl), shiftOrigin=(1,1))
+    start = [mimas[0][0].start+npxl//2, mimas[1][0].start+npxl//2]
+    start2 = [int(s) for s in N.array(start) + N.array((int(maxcutY), int(maxcutX)))]
+    shape = [int(i) for i in shape]
+
+    zeros = N.zeros((2,)+tuple(shape), N.float32)
+    zeros[:,start2[0]:start2[0]+yx.shape[1],start2[1]:start2[1]+yx.shape[2]] += yx
+    for d in range(2):
+        for x in range(int(start2[1])):
+            zeros[d,:start2[0],x] += yx[d,0,0]
+            zeros[d,start2[0]:start2[0]+yx.shape[1],x] += yx[d,:,0]
+            zeros[d,start2[0]+yx.shape[1]:,x] += yx[d,-1,0]
+        for x in range(int(start2[1]+yx.shape[2]),int(zeros.shape[-1])):
+            zeros[d,:start2[0],x] += yx[d,0,-1]
+            zeros[d,start2[0]:start2[0]+yx.shape[1],x] += yx[d,:,-1]
+            zeros[d,start2[0]+yx.shape[1]:,x] += yx[d,-1,-1]
+        for y in range(int(start2[0])):
+            zeros[d,y,:start2[1]] += yx[d,0,0]
+            zeros[d,y,:start2[1]] /= 2.
+            zeros[d,y,start2[1]:start2[1]+yx.shape[2]] += yx[d,0,:]
+            zeros[d,y,start2[1]+yx.shape[2]:] += yx[d,0,-1]
+            zeros[d,y,start2[1]+yx.shape[2]:] /= 2.
+        for y in range(int(start2[0]+yx.shape[1]),int(zeros.shape[-2])):
+            zeros[d,y,:start2[1]] += yx[d,-1,0]
+            zeros[d,y,:start2[1]] /= 2.
+            zeros[d,y,start2[1]:start2[1]+yx.shape[2]] += yx[d,-1,:]
+            zeros[d,y,start2[1]+yx.shape[2]:] += yx[d,-1,-1]
+            zeros[d,y,start2[1]+yx.shape[2]:] /= 2.
+    return zeros
+
+
+def test_paddYX_equals_loop():
+    rs = N.random.RandomState(3)
+    for shape, cut in [((200, 230), (0, 0)), ((211, 197), (2, 3))]:
+        # the grid of the two tilings of xcorNonLinear
+        grid = [len(s0) + len(s1) for s0, s1 in zip(alignfuncs.chopShapeND(shape, 60), alignfuncs.chopShapeND(shape, 60, (1,1)))]
+        yx = rs.randn(2, *grid).astype(N.float32)
+        new = alignfuncs.paddYX(yx, 60, shape, *cut)
+        assert N.allclose(new, _paddYXLoop(yx, 60, shape, *cut), atol=1e-5)
+
+
+def test_tileStats_equals_tiles():
+    rs = N.random.RandomState(6)
+    arr = (rs.rand(130, 150) * 1000 + 500).astype(N.float32)
+    sats = alignfuncs.tileSAT(arr)
+    for npxls, origin in [(30, (0,0)), (30, (1,1)), (45, (0,1))]:
+        slcs = alignfuncs.chopShapeND(arr.shape, npxls, shiftOrigin=origin)
+        mean, var = alignfuncs.tileStats(sats, slcs)
+        for y, ys in enumerate(slcs[0]):
+            for x, xs in enumerate(slcs[1]):
+                center = alignfuncs.imgFilters.cutOutCenter(arr[ys,xs], 0.5, interpolate=False)
+                assert N.allclose(mean[y,x], N.mean(center, dtype=N.float64))
+                assert N.allclose(var[y,x], N.var(center, dtype=N.float64))
@@ -0,0 +1,135 @@
+import os, json, time
+import pytest
+
+from Chromagnon import batch
+
+# as given to threads.ThreadWithExc
+PARMS = [True, None, 'None', 5, 'Auto', '', '_ALN', [1], 'dv', 60]
+
+
+@pytest.fixture
+def fakeJobs(monkeypatch, tmp_path):
+    """
+    replace the image processing by short sleeps recorded in a file
+    """
+    events = str(tmp_path / 'events')
+    open(events, 'w').close()
+
+    def mark(kind, fn):
+        with open(events, 'a') as h:
+            h.write('%.4f %s %s\n' % (time.time(), kind, os.path.basename(fn)))
+
+    def calibrate(fn, parms, echofunc=None):
+        mark('s', fn)
+        time.sleep(0.2)
+        mark('e', fn)
+        if 'badref' in fn:
+            raise ValueError('cannot calibrate')
+        return fn + '.chromagnon.csv'
+
+    def applyParm(target, parmfn, parms, echofunc=None):
+        mark('s', target)
+        time.sleep(0.2)
+        mark('e', target)
+        if 'crash' in target:
+            os._exit(3)
+        return target + '_ALN.dv'
+
+    # the replacements are only seen by forked workers
+    monkeypatch.setattr(batch, 'START_METHOD', 'fork')
+    monkeypatch.setattr(batch, 'calibrate', calibrate)
+    monkeypatch.setattr(batch, 'applyParm', applyParm)
+    monkeypatch.setattr(batch, 'estimateMemory', lambda fn, what: 400 if 'big' in fn else 100)
+    monkeypatch.setattr(batch.chromformat, 'is_chromagnon', lambda fn: fn.endswith('.csv'))
+
+    def files(*names):
+        return [str(tmp_path / name) for name in names]
+    return files, events
+
+
+def _maxConcurrent(events):
+    ev = sorted((float(line.split()[0]), line.split()[1]) for line in open(events))
+    current = maximum = 0
+    for t, kind in ev:
+        current += 1 if kind == 's' else -1
+        maximum = max(maximum, current)
+    return maximum
+
+
+def test_makeJobs(monkeypatch):
+    monkeypatch.setattr(batch.chromformat, 'is_chromagnon', lambda fn: fn.endswith('.csv'))
+    jobs = batch.makeJobs(['r0.dv', 'r1.csv'], ['t0.dv', 't1.dv', 't2.dv'])
+
+    assert [job['kind'] for job in jobs] == ['calibration'] * 2 + ['target'] * 3
+    assert [job['id'] for job in jobs] == list(range(5))
+    # chromagnon files need no calibration
+    assert 'status' not in jobs[0]
+    assert jobs[1]['status'] == 'done' and jobs[1]['output'] == 'r1.csv'
+    # targets[i] uses fns[i], the remaining targets use the last reference
+    assert [job['depends'] for job in jobs] == [None, None, 0, 1, 1]
+
+    jobs = batch.makeJobs([], ['t0.dv', 't1.dv'])
+    assert [job['depends'] for job in jobs] == [None, None]
+
+
+def test_runBatch_skipsDependents(fakeJobs, tmp_path):
+    files, events = fakeJobs
+    refs = files('r0.dv', 'badref.dv')
+    targets = files('t0.dv', 't1.dv', 't2.dv')
+    rep = batch.runBatch(refs, targets, PARMS, njobs=2, maxMemory=None, log=False)
+
+    status = [job['status'] for job in rep['jobs']]
+    assert status == ['done', 'failed', 'done', 'skipped', 'skipped']
+    assert rep['jobs'][2]['output'] == targets[0] + '_ALN.dv'
+    assert 'cannot calibrate' in rep['jobs'][1]['error']
+    assert 'badref.dv' in rep['jobs'][3]['error']
+    # skipped targets are never started
+    started = [line.split()[2] for line in open(events) if line.split()[1] == 's']
+    assert sorted(started) == ['badref.dv', 'r0.dv', 't0.dv']
+
+
+def test_runBatch_memoryCap(fakeJobs):
+    files, events = fakeJobs
+    targets = files('t0.dv', 't1.dv', 't2.dv', 't3.dv', 'big.dv')
+    rep = batch.runBatch([], targets, PARMS, njobs=4, maxMemory=250, log=False)
+
+    assert rep['done'] == 5
+    # 2 jobs of 100 fit into 250, the big job runs alone
+    assert _maxConcurrent(events) == 2
+    big = rep['jobs'][4]
+    for job in rep['jobs'][:4]:
+        assert job['end'] <= big['start'] or job['start'] >= big['end']
+
+    open(events, 'w').close()
+    rep = batch.runBatch([], targets[:4], PARMS, njobs=4, maxMemory=None, log=False)
+    assert _maxConcurrent(events) == 4
+
+
+def test_runBatch_report(fakeJobs, tmp_path):
+    files, events = fakeJobs
+    refs = files('r0.dv', 'given.csv')
+    targets = files('t0.dv', 'crash.dv', 't2.dv')
+    rep = batch.runBatch(refs, targets, PARMS, njobs=2)
+
+    fn = str(tmp_path / batch.REPORT_NAME)
+    assert os.path.isfile(fn)
+    with open(fn) as h:
+        saved = json.load(h)
+    assert saved == json.loads(json.dumps(rep))
+    assert (saved['done'], saved['failed'], saved['skipped']) == (4, 1, 0)
+    assert saved['njobs'] == 2
+
+    crash = saved['jobs'][3]
+    assert crash['status'] == 'failed'
+    assert 'exited with code 3' in crash['error']
+    for job in saved['jobs']:
+        if job['kind'] == 'target':
+            assert job['memory_estimate'] == 100
+            assert job['seconds'] >= 0.2
+            assert job['pid']
+
+    with open(str(tmp_path / batch.LOG_NAME)) as h:
+        log = h.read()
+    assert '**Measuring shifts in r0.dv' in log
+    assert '**Applying to t0.dv using r0.dv.chromagnon.csv' in log
+    assert '**Applying to t2.dv using given.csv' in log
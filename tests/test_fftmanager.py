@@ -0,0 +1,89 @@
+import numpy as N
+import pytest
+
+from Chromagnon.Priithon import fftmanager
+
+pytestmark = pytest.mark.skipif(not fftmanager.FFTW, reason='pyfftw is not available')
+
+
+@pytest.fixture
+def man():
+    man = fftmanager.FFTManager()
+    yield man
+    man.clear_plans()
+
+
+def test_plan_reuse(man):
+    a = N.random.RandomState(0).rand(16, 24).astype(N.float32)
+    af = man.rfft(a)
+    plan, cached = man.get_plan(a.shape, a.dtype, fftmanager.pyfftw.builders.rfftn, (-2, -1))
+    assert cached and (man.hits, man.misses) == (1, 1)
+
+    af2 = man.rfft(a * 2)
+    assert (man.hits, man.misses) == (2, 1)
+    # results are not overwritten by the next call with the same plan
+    assert N.allclose(af, N.fft.rfftn(a), atol=1e-3)
+    assert N.allclose(af2, 2 * af, atol=1e-3)
+    assert af2 is not plan.output_array
+
+    assert N.allclose(man.irfft(af, axes=(-2, -1)), a, atol=1e-5)
+    assert man.misses == 2
+
+
+def test_plan_key(man):
+    rfftn = fftmanager.pyfftw.builders.rfftn
+    shape = (4, 8, 8)
+    plan = man.get_plan(shape, N.float32, rfftn, (-2, -1))[0]
+    # negative and positive axes are the same key
+    assert man.get_plan(shape, N.float32, rfftn, (1, 2))[0] is plan
+    assert man.get_plan(shape, N.float32, rfftn, (-3, -2, -1))[0] is not plan
+    assert man.get_plan(shape, N.float64, rfftn, (-2, -1))[0] is not plan
+    ncpu = fftmanager.ncpu
+    assert man.get_plan(shape, N.float32, rfftn, (-2, -1), nthreads=ncpu+1)[0] is not plan
+    assert man.get_plan(shape, N.float32, rfftn, (-2, -1), nthreads=ncpu+2)[0] is not plan
+    assert (man.hits, man.misses) == (1, 5)
+
+    # the number of threads is limited by set_max_threads
+    limited = man.get_plan(shape, N.float32, rfftn, (-2, -1), nthreads=ncpu+1)[0]
+    man.set_max_threads(ncpu+1)
+    assert man.get_plan(shape, N.float32, rfftn, (-2, -1), nthreads=ncpu+4)[0] is limited
+    man.set_max_threads(None)
+
+
+def test_plan_cache_limits(man, monkeypatch):
+    rfftn = fftmanager.pyfftw.builders.rfftn
+    nbytes = 2 * 16 * 16 * 4
+    monkeypatch.setattr(fftmanager, 'PLAN_CACHE_BYTES', nbytes * 3)
+    for n in range(5):
+        man.get_plan((16, 16 + n), N.float32, rfftn, (-2, -1))
+    assert len(man._plan_cache()) == 2
+    assert man.cached_bytes() <= nbytes * 3
+    # least recently used plans are evicted
+    assert [key[0] for key in man._plan_cache()] == [(16, 19), (16, 20)]
+
+    monkeypatch.setattr(fftmanager, 'PLAN_CACHE_SIZE', 1)
+    man.get_plan((16, 16), N.float32, rfftn, (-2, -1))
+    assert list(man._plan_cache())[0][0] == (16, 16)
+    assert len(man._plan_cache()) == 1
+
+    # too large to be cached
+    plan, cached = man.get_plan((64, 64), N.float32, rfftn, (-2, -1))
+    assert not cached and len(man._plan_cache()) == 1
+
+    man.clear_plans()
+    assert man.cached_bytes() == 0
+
+
+def test_wisdom_roundtrip(man, tmp_path):
+    fn = str(tmp_path / 'wisdom')
+    assert not fftmanager.loadWisdom(fn)
+    man.warmup((12, 20))
+    assert fftmanager.saveWisdom(fn)
+
+    fftmanager.pyfftw.forget_wisdom()
+    assert fftmanager.loadWisdom(fn)
+    assert fftmanager.pyfftw.export_wisdom()[0]
+
+    with open(fn, 'wb') as h:
+        h.write(b'broken')
+    assert not fftmanager.loadWisdom(fn)
@@ -0,0 +1,69 @@
+import numpy as N
+import pytest
+
+from Chromagnon.PriCommon import imgFilters
+
+
+def _smoothBorderLoop(arr, start, stop, smooth, value):
+    """
+    the former _smoothBorder, row by row
+    """
+    shape = N.array(arr.shape)
+    start = N.ceil(start).astype(N.int16)
+    stop = N.ceil(stop).astype(N.int16)
+    smooth_start = N.maximum(start - smooth, 0)
+    smooth_stop = N.minimum(stop + smooth, shape)
+    for d in range(arr.ndim):
+        smooth_shape = list(shape[:d]) + list(shape[d+1:])
+        edges = N.empty([2] + smooth_shape, N.float32)
+        slc = [slice(None)] * arr.ndim
+        slc[d] = slice(start[d], start[d]+1)
+        edges[0] = arr[tuple(slc)].reshape(smooth_shape)
+        slc[d] = slice(stop[d]-1, stop[d])
+        edges[1] = arr[tuple(slc)].reshape(smooth_shape)
+        edges = (edges - value) / float(smooth + 1)
+        for s in range(2):
+            if s == 0:
+                rs = sorted(range(smooth_start[d], start[d]), reverse=True)
+            else:
+                rs = list(range(stop[d], smooth_stop[d]))
+            for f, i in enumerate(rs):
+                slc[d] = slice(i, i+1)
+                arr[tuple(slc)] = arr[tuple(slc)] + edges[s].reshape(arr[tuple(slc)].shape) * (smooth - f)
+    return arr
+
+
+@pytest.mark.parametrize('dtype', [N.float32, N.uint16])
+@pytest.mark.parametrize('shape, pshape', [((20, 24), (28, 32)), ((6, 10, 12), (10, 18, 16))])
+def test_paddingValue_smooth_equals_loop(dtype, shape, pshape):
+    rs = N.random.RandomState(4)
+    img = (rs.rand(*shape) * 1000).astype(dtype)
+    value = 300
+    new = imgFilters.paddingValue(img, pshape, value=value, smooth=4)
+
+    canvas = N.empty(pshape, dtype)
+    canvas[:] = value
+    start = N.round((N.array(pshape) - shape) / 2.).astype(N.int64)
+    stop = start + shape
+    canvas[tuple([slice(s, e) for s, e in zip(start, stop)])] = img
+    assert N.array_equal(new, _smoothBorderLoop(canvas, start, stop, 4, value))
+
+
+def test_paddingValue_out():
+    rs = N.random.RandomState(5)
+    img = rs.rand(20, 24).astype(N.float32)
+    out = imgFilters.getWorkspace('test', (28, 32), N.float32)
+    ret = imgFilters.paddingMed(img, (28, 32), smooth=4, out=out)
+    assert ret is out
+    assert N.array_equal(ret, imgFilters.paddingMed(img, (28, 32), smooth=4))
+
+
+def test_getWorkspace_bytes(monkeypatch):
+    monkeypatch.setattr(imgFilters, 'WORKSPACE_MAXBYTES', 4 * 64 * 64 * 2)
+    small = imgFilters.getWorkspace('test_small', (64, 64), N.float32)
+    assert small is imgFilters.getWorkspace('test_small', (64, 64), N.float32)
+    large = imgFilters.getWorkspace('test_large', (4, 64, 64), N.float32)
+    assert large is not imgFilters.getWorkspace('test_large', (4, 64, 64), N.float32)
+    imgFilters.getWorkspace('test_small2', (64, 64), N.float32)
+    imgFilters.getWorkspace('test_small3', (64, 64), N.float32)
+    assert small is not imgFilters.getWorkspace('test_small', (64, 64), N.float32)
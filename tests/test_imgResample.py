@@ -0,0 +1,29 @@
+import numpy as N
+from scipy import ndimage
+import pytest
+
+from Chromagnon.PriCommon import imgResample
+
+
+def _stack(shape=(12,48,40), seed=0):
+    rs = N.random.RandomState(seed)
+    return (ndimage.gaussian_filter(rs.rand(*shape), 2) * 1000).astype(N.float32)
+
+
+@pytest.mark.parametrize('kwds', [dict(tzyx=(0.7,1.2,-0.4), r=2., mag=(1.02,1.01,0.99)),
+                                  dict(tzyx=(0.5,0,0), rzy=1.0, mag=(1,1,1))])
+def test_affineFused_equals_two_pass(kwds):
+    a = _stack()
+    two = imgResample.trans3D_affine(a, fused=False, ncpu=1, **kwds)
+    fused = imgResample.trans3D_affine(a, fused=True, ncpu=1, **kwds)
+    # the borders differ by the boundary handling of the intermediate stack
+    assert N.allclose(fused[2:-2,4:-4,4:-4], two[2:-2,4:-4,4:-4], atol=1e-2)
+
+
+def test_affineFused_slabs_in_processes(monkeypatch):
+    monkeypatch.setattr(imgResample, 'SLAB_NZ', 3)
+    a = _stack()
+    kwds = dict(tzyx=(0.7,1.2,-0.4), r=2., mag=(1.02,1.01,0.99))
+    one = imgResample.trans3D_affine(a, ncpu=1, **kwds)
+    two = imgResample.trans3D_affine(a, ncpu=2, **kwds)
+    assert N.array_equal(one, two)
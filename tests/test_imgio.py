@@ -0,0 +1,232 @@
+import threading
+import numpy as N
+import pytest
+import tifffile
+
+from Chromagnon import imgio
+from Chromagnon.imgio import generalIO, mrcIO, stackCache, multitifIO
+
+
+def _sectionwise(rdr, t=0, w=0, zs=None):
+    """
+    the former get3DArr, section by section
+    """
+    if zs is None:
+        if rdr.useROI2getArr:
+            zs = range(rdr.roi_start[0], rdr.roi_start[0]+rdr.roi_size[0])
+        else:
+            zs = range(rdr.nz)
+    return N.array([rdr.getArr(t=t, z=z, w=w) for z in zs])
+
+
+def _writeDV(fn, arr, imgSequence=0):
+    """
+    arr: (nt,nw,nz,ny,nx)
+    """
+    nt, nw, nz, ny, nx = arr.shape
+    wtr = imgio.Writer(fn)
+    wtr.setDim(nx, ny, nz, nt, nw, arr.dtype.type, [500 + 100 * w for w in range(nw)], imgSequence)
+    for t in range(nt):
+        for w in range(nw):
+            wtr.write3DArr(arr[t,w], t=t, w=w)
+    wtr.close()
+
+
+@pytest.mark.parametrize('imgSequence', [0, 1, 2])
+@pytest.mark.parametrize('dtype', [N.uint16, N.float32])
+def test_mrc_memmap_equals_sections(tmp_path, imgSequence, dtype):
+    rs = N.random.RandomState(7)
+    arr = (rs.rand(2, 3, 5, 20, 24) * 1000).astype(dtype)
+    fn = str(tmp_path / 'test.dv')
+    _writeDV(fn, arr, imgSequence)
+
+    mapped = mrcIO.MrcReader(fn)
+    assert mapped.mm is not None
+    plain = mrcIO.MrcReader(fn, memmap=False)
+    for t in range(2):
+        for w in range(3):
+            for zs in (None, [1, 2, 3], [4, 0], [2]):
+                b = mapped.get3DArr(t=t, w=w, zs=zs)
+                assert b.dtype == N.dtype(dtype) and b.flags.writeable
+                assert N.array_equal(b, _sectionwise(plain, t, w, zs))
+    for rdr in (mapped, plain):
+        rdr.useROI2getArr = True
+        rdr.setRoi((1, 0, 0), (3, 12, 16))
+    assert N.array_equal(mapped.get3DArr(t=1, w=2), _sectionwise(plain, 1, 2))
+    mapped.close()
+    plain.close()
+
+
+class RawReader(generalIO.GeneralReader):
+    """
+    headerless uint16 sections (nt*nw*nz,32,24) written by _writeRaw
+    """
+    dims = (1, 1, 1, 0)
+
+    def readHeader(self):
+        self.handle = self.fp
+        self.dataOffset = 0
+        self._secExtraByteSize = 0
+        nt, nw, nz, imgSequence = self.dims
+        self.setDim(24, 32, nz, nt, nw, N.uint16, [500 + 100 * w for w in range(nw)], imgSequence)
+
+
+def _writeRaw(tmp_path, nt, nw, nz, imgSequence):
+    rs = N.random.RandomState(8)
+    fn = str(tmp_path / 'test.bin')
+    (rs.rand(nt*nw*nz, 32, 24) * 1000).astype(N.uint16).tofile(fn)
+    RawReader.dims = (nt, nw, nz, imgSequence)
+    return fn
+
+
+def test_readStack_equals_sections(tmp_path):
+    fn = _writeRaw(tmp_path, 1, 1, 10, 0)
+    rdr = RawReader(fn, 'rb')
+    assert rdr.canReadStack()
+    for zs in (None, [0, 1, 2, 5, 6, 9], [3], [4, 3, 2], []):
+        b = rdr.get3DArr(zs=zs)
+        assert N.array_equal(b, _sectionwise(rdr, zs=zs).reshape(b.shape))
+    rdr.useROI2getArr = True
+    rdr.setRoi((2, 0, 0), (5, 20, 16))
+    b = rdr.get3DArr()
+    assert b.shape == (5, 20, 16)
+    assert N.array_equal(b, _sectionwise(rdr))
+    rdr.close()
+
+
+@pytest.mark.parametrize('timeblock', [True, False])
+def test_timeBlock_equals_sections(tmp_path, monkeypatch, timeblock):
+    monkeypatch.setattr(generalIO, 'TIMEBLOCK', timeblock)
+    fn = _writeRaw(tmp_path, 2, 3, 7, 1)
+    rdr = RawReader(fn, 'rb')
+    for roi in (False, True):
+        if roi:
+            rdr.useROI2getArr = True
+            rdr.setRoi((1, 0, 0), (4, 20, 16))
+        for t in range(2):
+            for w in range(3):
+                for zs in (None, [0, 2, 3], [5]):
+                    b = rdr.get3DArr(t=t, w=w, zs=zs)
+                    assert b.flags.writeable
+                    assert N.array_equal(b, _sectionwise(rdr, t, w, zs))
+    rdr.close()
+
+    # only whole time points use the block
+    rdr = RawReader(fn, 'rb')
+    rdr.get3DArr(t=1, w=2, zs=[0, 2, 3])
+    assert rdr._tblock is None
+    b = rdr.get3DArr(t=1, w=2)
+    assert (rdr._tblock is not None) == timeblock
+    rdr.get3DArr(t=1, w=2, zs=[5])
+    assert rdr._tblock is None
+    # the returned stack is not the cached block
+    b[:] = 0
+    assert N.any(rdr.get3DArr(t=1, w=2))
+    rdr.close()
+
+
+def test_stackCache_equals_reading(tmp_path):
+    fn = _writeRaw(tmp_path, 2, 3, 7, 0)
+    rdr = RawReader(fn, 'rb')
+    assert rdr.cache is None
+    cache = stackCache.StackCache()
+    rdr.setCache(cache)
+    first = {}
+    for rep in range(2):
+        for t in range(2):
+            for w in range(3):
+                b = rdr.get3DArr(t=t, w=w)
+                assert N.array_equal(b, rdr.read3DArr(t=t, w=w))
+                # the cached stacks are returned without copying, and cannot be changed
+                assert not b.flags.writeable
+                with pytest.raises(ValueError):
+                    b[:] = 0
+                assert first.setdefault((t, w), b) is b
+    assert cache.misses == 6 and cache.hits == 6
+    assert N.array_equal(rdr.get3DArr(t=1, w=1, zs=[1, 2]), rdr.read3DArr(t=1, w=1, zs=[1, 2]))
+    rdr.close()
+    assert cache.stats()['size'] == 0 and cache.nbytes == 0
+
+
+def test_stackCache_maxbytes(tmp_path):
+    fn = _writeRaw(tmp_path, 1, 3, 7, 0)
+    rdr = RawReader(fn, 'rb')
+    cache = stackCache.StackCache(maxbytes=2 * 7 * 32 * 24 * 2)
+    rdr.setCache(cache)
+    for w in range(3):
+        rdr.get3DArr(w=w)
+    stats = cache.stats()
+    assert stats['size'] == 2 and stats['evictions'] == 1 and stats['nbytes'] <= cache.maxbytes
+    rdr.get3DArr(w=2)
+    assert cache.hits == 1
+    rdr.close()
+
+
+def _tiffs(tmp_path):
+    """
+    return {name: (file name, array (nt,nz,nw,ny,nx))}
+    """
+    rs = N.random.RandomState(9)
+    arr = (rs.rand(2, 5, 3, 32, 24) * 1000).astype(N.uint16)
+    fns = {}
+    for name, kwds in [('hyperstack', {}), ('zlib', {'compression': 'zlib'})]:
+        fn = str(tmp_path / ('%s.tif' % name))
+        tifffile.imwrite(fn, arr, imagej=True, metadata={'axes': 'TZCYX'}, **kwds)
+        fns[name] = (fn, arr)
+    # pages not in one series
+    fn = str(tmp_path / 'pages.tif')
+    with tifffile.TiffWriter(fn) as tw:
+        for sec in arr[0,:,0]:
+            tw.write(sec, contiguous=False, metadata=None, description='x')
+    fns['pages'] = (fn, arr[:1,:,:1])
+    return fns
+
+
+@pytest.mark.parametrize('name', ['hyperstack', 'zlib', 'pages'])
+@pytest.mark.parametrize('nthreads', [1, 4])
+def test_multitif_equals_sections(tmp_path, monkeypatch, name, nthreads):
+    monkeypatch.setattr(multitifIO, 'NTHREADS_DECODE', nthreads)
+    fn, arr = _tiffs(tmp_path)[name]
+    rdr = multitifIO.MultiTiffReader(fn)
+    plain = multitifIO.MultiTiffReader(fn, memmap=False)
+    assert (rdr.mm is not None) == (name != 'zlib')
+    assert (rdr.nt, rdr.nz, rdr.nw) == arr.shape[:3]
+    for t in range(rdr.nt):
+        for w in range(rdr.nw):
+            for zs in (None, [1, 2, 3], [4, 0]):
+                b = rdr.get3DArr(t=t, w=w, zs=zs)
+                assert N.array_equal(b, _sectionwise(plain, t, w, zs))
+            assert N.array_equal(rdr.get3DArr(t=t, w=w), arr[t,:,w,::-1])
+    rdr.close()
+    plain.close()
+
+
+def test_multitif_pages_checked_when_read(tmp_path):
+    fn, arr = _tiffs(tmp_path)['pages']
+    rdr = multitifIO.MultiTiffReader(fn)
+    # only the first, second and last pages are parsed on open
+    assert rdr._unchecked.sum() == rdr.nsec - 3
+    pageOffset = rdr.pageOffset
+    rdr.pageOffset = lambda i, secbytes: pageOffset(i, secbytes) + (i == 3)
+    assert N.array_equal(rdr.readStack(0, 3), arr[0,:3,0])
+    assert rdr.mm is not None
+    # the map is not used after a page off the interval
+    assert N.array_equal(rdr.get3DArr(), arr[0,:,0,::-1])
+    assert rdr.mm is None
+    rdr.close()
+
+
+
+def test_decode_without_lock_keyword():
+    lock = threading.Lock()
+
+    class OldPage(object):
+        """
+        page of old tifffile, asarray has no lock keyword
+        """
+        def asarray(self):
+            assert lock.locked()
+            return N.ones((2, 3))
+
+    assert N.array_equal(multitifIO._decode((OldPage(), lock)), N.ones((2, 3)))
+    assert not lock.locked()
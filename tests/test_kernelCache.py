@@ -0,0 +1,53 @@
+import numpy as N
+import pytest
+
+from Chromagnon.PriCommon import kernelCache
+
+
+def _make(n, calls):
+    calls.append(n)
+    return N.full((n,), n, N.float32)
+
+
+def test_ArrayCache_lru():
+    cache = kernelCache.ArrayCache(maxsize=2)
+    calls = []
+    a1 = cache.get(1, _make, 1, calls)
+    cache.get(2, _make, 2, calls)
+    assert cache.get(1, _make, 1, calls) is a1 # 1 is now the most recent
+    cache.get(3, _make, 3, calls) # evicts 2
+    assert list(cache._cache) == [1, 3]
+    assert cache.get(1, _make, 1, calls) is a1
+    cache.get(2, _make, 2, calls)
+    assert calls == [1, 2, 3, 2]
+    assert list(cache._cache) == [1, 2]
+
+    st = cache.stats()
+    assert (st['hits'], st['misses'], st['size'], st['maxsize']) == (2, 4, 2, 2)
+    assert st['nbytes'] == (1 + 2) * 4
+
+    cache.clear()
+    assert cache.stats()['size'] == cache.stats()['hits'] == cache.stats()['misses'] == 0
+
+
+def test_ArrayCache_readonly():
+    cache = kernelCache.ArrayCache()
+    arr = cache.get('a', _make, 3, [])
+    with pytest.raises(ValueError):
+        arr += 1
+    # lists of arrays
+    arrs = cache.get('l', lambda: [N.zeros(2), N.ones(3)])
+    assert not any(a.flags.writeable for a in arrs)
+    assert cache.stats()['nbytes'] == 12 + 16 + 24
+
+
+def test_getKernel_key():
+    kernelCache.clear()
+    calls = []
+    k = kernelCache.getKernel('k', N.array([4]), (1,), _make, 4, calls)
+    assert kernelCache.getKernel('k', (4,), (1,), _make, 4, calls) is k
+    kernelCache.getKernel('k', (4,), (2,), _make, 4, calls)
+    kernelCache.getKernel('j', (4,), (1,), _make, 4, calls)
+    assert len(calls) == 3
+    assert (kernelCache.stats()['hits'], kernelCache.stats()['misses']) == (1, 3)
+    kernelCache.clear()
@@ -0,0 +1,53 @@
+import os, time
+import pytest
+
+from Chromagnon.PriCommon import ppro26
+
+
+def _slowSquare(x, wait=0.01):
+    """
+    later items finish first
+    """
+    time.sleep(wait * (10 - x % 10))
+    return x * x, os.getpid()
+
+
+@pytest.fixture
+def pool():
+    ppro26.closePools()
+    yield
+    ppro26.closePools()
+
+
+def test_pmap_preserves_order(pool):
+    results = ppro26.pmap(_slowSquare, range(30), 2, 0.002)
+    assert [r[0] for r in results] == [x * x for x in range(30)]
+    assert len(set(r[1] for r in results)) <= 2
+    assert os.getpid() not in [r[1] for r in results]
+
+    # kwds and the single process path
+    assert [r[0] for r in ppro26.pmap(_slowSquare, range(5), 1, wait=0)] == [0, 1, 4, 9, 16]
+
+
+def test_pmap_reuses_pool(pool):
+    ppro26.initPool(2)
+    pool2 = ppro26.POOL
+    assert ppro26.POOL_SIZE == 2
+
+    pids = set(r[1] for r in ppro26.pmap(_slowSquare, range(10), 2, 0))
+    pids |= set(r[1] for r in ppro26.pmap(_slowSquare, range(10), 2, 0))
+    assert ppro26.POOL is pool2
+    assert pids <= set(p.pid for p in pool2._pool)
+
+    # a different limit replaces the pool
+    ppro26.pmap(_slowSquare, range(10), 3, 0)
+    assert ppro26.POOL is not pool2 and ppro26.POOL_SIZE == 3
+
+    ppro26.closePools()
+    assert ppro26.POOL is None
+
+
+def test_initPool_single_process(pool, monkeypatch):
+    monkeypatch.setattr(ppro26, 'NCPU', 1)
+    ppro26.initPool()
+    assert ppro26.POOL is None
@@ -0,0 +1,113 @@
+import pickle
+import numpy as N
+import pytest
+
+from Chromagnon.PriCommon import sharedArr, ppro26
+
+pytestmark = pytest.mark.skipif(sharedArr.shared_memory is None, reason='multiprocessing.shared_memory is not available')
+
+
+def _large(seed=0):
+    return N.random.RandomState(seed).rand(64, 320).astype(N.float32) # 80 kB
+
+
+def _isLinked(name):
+    try:
+        try:
+            shm = sharedArr.shared_memory.SharedMemory(name=name, track=False)
+        except TypeError: # python < 3.13
+            shm = sharedArr.shared_memory.SharedMemory(name=name)
+    except (OSError, ValueError):
+        return False
+    shm.close()
+    return True
+
+
+def test_share_restore_release():
+    a = _large()
+    small = N.arange(10)
+    assert sharedArr.share(small) is small
+    assert sharedArr.share('text') == 'text'
+
+    sa = sharedArr.share(a)
+    assert isinstance(sa, sharedArr.SharedArray)
+    assert N.array_equal(sharedArr.restore(sa), a)
+    assert sharedArr.restore(small) is small
+
+    # only the name is pickled, the copy views the same memory
+    copy = pickle.loads(pickle.dumps(sa))
+    assert not copy.owner
+    copy.asarray()[0, 0] = -1
+    assert sa.asarray()[0, 0] == -1
+    del copy
+    sharedArr.detach()
+
+    # the arrays given by the caller are left to the caller
+    mine = sharedArr.SharedArray(a)
+    sharedArr.release([sa, mine, small], [a, mine, small])
+    assert sa.shm is None and not _isLinked(sa.name)
+    assert mine.shm is not None and _isLinked(mine.name)
+    # non owners do nothing
+    pickle.loads(pickle.dumps(mine)).unlink()
+    assert _isLinked(mine.name)
+    mine.unlink()
+    assert not _isLinked(mine.name)
+
+
+def test_unlink_with_views_alive():
+    sa = sharedArr.SharedArray(_large())
+    view = sa.asarray()
+    sub = view[10:20]
+    sa.unlink() # no BufferError
+    assert not _isLinked(sa.name)
+    assert len(sharedArr._UNCLOSED) >= 1
+    # the views are still valid
+    assert N.array_equal(sub, _large()[10:20])
+
+    del view, sub
+    sharedArr._close()
+    assert not sharedArr._UNCLOSED
+
+
+def _scale(a, factor, offset=0):
+    return a * factor + offset
+
+
+@pytest.fixture
+def pool():
+    ppro26.closePools()
+    yield
+    ppro26.closePools()
+
+
+def test_pmapArr(pool):
+    a = N.random.RandomState(1).rand(6, 64, 64).astype(N.float32)
+    out = N.empty_like(a)
+    assert ppro26.pmapArr(_scale, a, out, 2, 2., offset=1) is out
+    assert N.allclose(out, a * 2 + 1)
+
+    out1 = ppro26.pmapArr(_scale, a, N.empty_like(a), 1, 2., offset=1)
+    assert N.array_equal(out1, out)
+
+
+def test_pmap_keeps_caller_owned_SharedArray(pool):
+    # eg. an image shared once by the caller for several pmap calls
+    a = _large()
+    sa = sharedArr.SharedArray(a)
+    view = sa.asarray()
+    try:
+        for factor in (1, 2):
+            results = ppro26.pmap(_scale, [sa] * 4, 2, factor)
+            for r in results:
+                assert N.allclose(r, a * factor)
+            assert sa.shm is not None and _isLinked(sa.name)
+
+        out = N.empty((4,) + a.shape, N.float32)
+        ppro26.pmapArr(_scale, N.ones((4, 1, 1), N.float32), out, 2, sa)
+        assert N.allclose(out, a[None])
+        assert _isLinked(sa.name)
+    finally:
+        sa.unlink()
+    # the caller's view is still usable after unlinking
+    assert N.array_equal(view, a)
+    assert not _isLinked(sa.name)
@@ -0,0 +1,138 @@
+import numpy as N
+import pytest
+from scipy import ndimage
+
+from Chromagnon.PriCommon import xcorr, imgFilters, kernelCache
+from Chromagnon.Priithon.all import F
+
+
+@pytest.mark.parametrize('dtype', [N.float32, N.float64, N.uint16, N.int16, N.uint8])
+def test_paddAndApoStack_equals_paddAndApo(dtype):
+    rs = N.random.RandomState(0)
+    a = (rs.rand(5, 16, 20) * 100).astype(dtype)
+    stack = xcorr.paddAndApoStack(a, npad=4)
+    assert stack.dtype == N.float32
+    for i, sec in enumerate(a):
+        padded = xcorr.paddAndApo(sec, 4)
+        assert padded.dtype == N.float32
+        assert N.allclose(stack[i], padded, atol=1e-4)
+
+
+def test_paddAndApoStack_equals_paddAndApo_large():
+    # the median is estimated from imgFilters.MEDIAN_MAXPXLS pixels in both
+    rs = N.random.RandomState(1)
+    a = (rs.rand(2, 512, 640) * 1000).astype(N.uint16)
+    assert a[0].size > imgFilters.MEDIAN_MAXPXLS
+    stack = xcorr.paddAndApoStack(a, npad=4)
+    for i, sec in enumerate(a):
+        assert N.allclose(stack[i], xcorr.paddAndApo(sec, 4), atol=1e-3)
+
+
+def _nanFilterLoop(af, kernel=3):
+    """
+    the former nanFilter, pixel by pixel
+    """
+    af = af.copy()
+    shape = N.array(af.shape)
+    radius = N.subtract(kernel, 1) // 2
+    box = kernel * af.ndim
+    nan = N.isnan(af)
+    for nidx in N.array(N.nonzero(nan)).T:
+        slc = tuple([slice(idx, idx+1) for idx in nidx])
+        slices = tuple([slice(max(idx - radius, 0), min(idx + 1 + radius, shape[dim])) for dim, idx in enumerate(nidx)])
+        val = af[slices]
+        nanlocal = N.isnan(val)
+        af[slc] = N.sum(N.where(nanlocal, 0, val)) / float((box - N.sum(nanlocal)))
+    return af
+
+
+def _nanFilterOnce(af, kernel=3):
+    """
+    _nanFilterLoop using only the pixels that were not nan
+    """
+    ori = af
+    af = af.copy()
+    shape = N.array(af.shape)
+    radius = N.subtract(kernel, 1) // 2
+    box = kernel * af.ndim
+    for nidx in N.array(N.nonzero(N.isnan(ori))).T:
+        slices = tuple([slice(max(idx - radius, 0), min(idx + 1 + radius, shape[dim])) for dim, idx in enumerate(nidx)])
+        val = ori[slices]
+        nanlocal = N.isnan(val)
+        af[tuple(nidx)] = N.sum(N.where(nanlocal, 0, val)) / float((box - N.sum(nanlocal)))
+    return af
+
+
+def test_nanFilter_equals_loop():
+    rs = N.random.RandomState(1)
+    for shape in [(20, 24), (6, 10, 12)]:
+        a = rs.rand(*shape).astype(N.float32)
+        a[rs.rand(*shape) < 0.05] = N.nan
+        a[1, 1:3] = N.nan # neighboring nan
+
+        for arr in (a, (a + 1j * a[::-1]).astype(N.complex64)):
+            nan = N.isnan(arr)
+            isolated = nan & (ndimage.correlate(nan.astype(N.int32), N.ones((3,) * a.ndim, N.int32), mode='constant') == 1)
+            assert isolated.any() and (nan & ~isolated).any()
+
+            filtered = xcorr.nanFilter(arr)
+            assert filtered.dtype == arr.dtype
+            assert not N.isnan(filtered).any()
+            # all nan pixels are filled from the pixels that were not nan
+            assert N.allclose(filtered, _nanFilterOnce(arr))
+            # the same as the former sequential filter except for nan pixels next to each other
+            same = ~nan | isolated
+            assert N.allclose(filtered[same], _nanFilterLoop(arr)[same])
+
+    a = N.ones((8, 8), N.float32)
+    assert xcorr.nanFilter(a) is not a
+    assert N.array_equal(xcorr.nanFilter(a), a)
+
+
+_G = _G_SHAPE = None
+
+def _highPassFOld(af, highpassSigma=2.5, wiener=0.2, cutoffFreq=3):
+    """
+    the former highPassF with its module cache
+    """
+    global _G, _G_SHAPE
+    if highpassSigma:
+        shape = N.array(af.shape)
+        shape[-1] = (shape[-1] - 1) * 2
+        szyx = shape / 2.
+
+        if _G is not None and N.all(_G_SHAPE == shape):
+            g = _G
+        else:
+            g = imgFilters.gaussianArrND(shape, highpassSigma, peakVal=1, orig=szyx)
+            g = F.shift(g)[...,:af.shape[-1]]
+
+            _G = g
+            _G_SHAPE = N.asarray(g.shape)
+        g += wiener
+        af /= g
+
+    af.flat[0] = 0
+    for d in range(af.ndim-2, af.ndim):
+        af[(slice(None),) * d + (slice(0, cutoffFreq),)] = 0
+    return af
+
+
+def test_highPassF_equals_old_and_keeps_kernel():
+    global _G
+    kernelCache.clear()
+    rs = N.random.RandomState(2)
+    for shape in [(32, 40), (8, 16, 20)]:
+        _G = None
+        af = N.fft.rfftn(rs.rand(*shape)).astype(N.complex64)
+        for i in range(3): # the kernel is re-used
+            assert N.allclose(xcorr.highPassF(af.copy()), _highPassFOld(af.copy()))
+
+        key = ('highpass', shape, (2.5,))
+        g = kernelCache.KERNELS._cache[key]
+        assert not g.flags.writeable
+        g0 = g.copy()
+        xcorr.highPassF(af.copy(), wiener=0.5)
+        assert N.array_equal(g, g0)
+        assert kernelCache.getKernel('highpass', shape, (2.5,), None) is g
+    assert kernelCache.stats()['misses'] == 2